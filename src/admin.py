@@ -1,12 +1,36 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
-from flask_login import LoginManager, login_user, login_required, logout_user, current_user
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, Response, stream_with_context, abort
+from flask_login import login_user, login_required, logout_user, current_user
 from functools import wraps
 from models.models import db, Admin, User, App, ScoreConsumption, ScoreTransfer
 from werkzeug.security import generate_password_hash
+from sqlalchemy import func, case, or_, select
+from sqlalchemy.orm import joinedload, aliased
+from datetime import datetime, timedelta
+import leaderboards
+import ratelimit
 import os
+import io
+import csv
+import json
+import time
+import zlib
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
-login_manager = LoginManager()
+
+# 列表页每页条数
+ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', 50))
+ADMIN_MAX_PAGE_SIZE = 200
+# 仪表盘汇总数据的缓存时间(秒)
+ADMIN_SUMMARY_TTL = int(os.getenv('ADMIN_SUMMARY_TTL', 30))
+
+_summary_cache = {'expires_at': 0, 'data': None}
+
+# 导出时每次从数据库读取的行数
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
 
 def admin_required(f):
     @wraps(f)
@@ -17,9 +41,106 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+def parse_date(value):
+    """解析 YYYY-MM-DD 格式的日期, 无效时返回 None"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def paginate(query, sortable, default_sort):
+    """按请求参数排序并分页, 只允许 sortable 中的列参与排序"""
+    column = sortable.get(request.args.get('sort'), sortable[default_sort])
+    if request.args.get('order') == 'asc':
+        query = query.order_by(column.asc())
+    else:
+        query = query.order_by(column.desc())
+    per_page = request.args.get('per_page', ADMIN_PAGE_SIZE, type=int)
+    return query.paginate(page=request.args.get('page', 1, type=int),
+                          per_page=max(1, min(per_page, ADMIN_MAX_PAGE_SIZE)),
+                          error_out=False)
+
+def record_filters(model):
+    """消费和转账记录共用的状态和日期范围筛选"""
+    conditions = []
+    status = request.args.get('status')
+    if status:
+        conditions.append(model.status == status)
+    start = parse_date(request.args.get('start'))
+    if start:
+        conditions.append(model.created_at >= start)
+    end = parse_date(request.args.get('end'))
+    if end:
+        conditions.append(model.created_at < end + timedelta(days=1))
+    return conditions
+
+def user_id_of(username):
+    return select(User.id).where(User.username == username).scalar_subquery()
+
+def status_totals(model, conditions):
+    """按状态汇总记录数和金额"""
+    rows = db.session.query(
+        model.status,
+        func.count(model.id),
+        func.coalesce(func.sum(model.amount), 0)
+    ).filter(*conditions).group_by(model.status).all()
+    totals = {'all': {'count': 0, 'amount': 0}}
+    for status, count, amount in rows:
+        totals[status] = {'count': count, 'amount': amount}
+        totals['all']['count'] += count
+        totals['all']['amount'] += amount
+    return totals
+
+def dashboard_summary():
+    """仪表盘汇总数字, 用 SQL 聚合计算并缓存 ADMIN_SUMMARY_TTL 秒"""
+    if _summary_cache['data'] is not None and _summary_cache['expires_at'] > time.monotonic():
+        return _summary_cache['data']
+
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def totals(model, fee_column):
+        confirmed = model.status == 'confirmed'
+        confirmed_today = confirmed & (model.confirmed_at >= today)
+        return db.session.query(
+            func.count(model.id),
+            func.coalesce(func.sum(case((confirmed, model.amount), else_=0)), 0),
+            func.coalesce(func.sum(case((confirmed, fee_column), else_=0)), 0),
+            func.coalesce(func.sum(case((confirmed_today, 1), else_=0)), 0),
+            func.coalesce(func.sum(case((confirmed_today, model.amount), else_=0)), 0)
+        ).one()
+
+    consumptions = totals(ScoreConsumption, ScoreConsumption.fee_amount)
+    transfers = totals(ScoreTransfer, ScoreTransfer.fee_amount)
+    data = {
+        'users': db.session.query(func.count(User.id)).scalar(),
+        'apps': db.session.query(func.count(App.id)).scalar(),
+        'consumptions': consumptions[0],
+        'consumed_amount': consumptions[1],
+        'consumption_fees': consumptions[2],
+        'today_consumptions': consumptions[3],
+        'today_consumed': consumptions[4],
+        'transfers': transfers[0],
+        'transferred_amount': transfers[1],
+        'transfer_fees': transfers[2],
+        'today_transfers': transfers[3],
+        'today_transferred': transfers[4],
+    }
+    _summary_cache['data'] = data
+    _summary_cache['expires_at'] = time.monotonic() + ADMIN_SUMMARY_TTL
+    return data
+
+@admin_bp.app_template_global()
+def admin_page_url(**changes):
+    """保留当前筛选条件, 生成翻页或排序链接"""
+    args = request.args.to_dict()
+    args.update(changes)
+    return url_for(request.endpoint, **args)
+
+@admin_bp.app_template_global()
+def admin_sort_url(column):
+    """切换排序列, 再次点击同一列时反转顺序"""
+    order = 'asc' if request.args.get('sort') == column and request.args.get('order') != 'asc' else 'desc'
+    return admin_page_url(sort=column, order=order, page=1)
 
 @admin_bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -31,9 +152,13 @@ def login():
         if admin and admin.check_password(password):
             user = User.query.filter_by(username=username).first()
             if not user:
-                user = User(username=username, is_admin=True)
+                # 页面按 trust_level 显示菜单, 不能为空
+                user = User(username=username, trust_level=0, is_admin=True)
                 db.session.add(user)
                 db.session.commit()
+            elif not user.is_admin:
+                user.is_admin = True
+                db.session.commit()
             login_user(user)
             return redirect(url_for('admin.dashboard'))
         flash('用户名或密码错误')
@@ -50,22 +175,35 @@ def logout():
 @login_required
 @admin_required
 def dashboard():
-    users = User.query.all()
-    apps = App.query.all()
-    consumptions = ScoreConsumption.query.all()
-    transfers = ScoreTransfer.query.all()
-    return render_template('admin/dashboard.html', 
-                         users=users, 
-                         apps=apps, 
-                         consumptions=consumptions,
-                         transfers=transfers)
+    return render_template('admin/dashboard.html',
+                         summary=dashboard_summary(),
+                         users=User.query.order_by(User.id.desc()).limit(5).all(),
+                         apps=App.query.options(joinedload(App.owner))
+                             .order_by(App.id.desc()).limit(5).all(),
+                         consumptions=ScoreConsumption.query
+                             .options(joinedload(ScoreConsumption.user),
+                                      joinedload(ScoreConsumption.app))
+                             .order_by(ScoreConsumption.id.desc()).limit(5).all())
 
 @admin_bp.route('/users')
 @login_required
 @admin_required
 def users():
-    users = User.query.all()
-    return render_template('admin/users.html', users=users)
+    query = User.query
+    keyword = request.args.get('q', '').strip()
+    if keyword:
+        query = query.filter(User.username.startswith(keyword))
+    trust_level = request.args.get('trust_level', type=int)
+    if trust_level is not None:
+        query = query.filter(User.trust_level == trust_level)
+    pagination = paginate(query, {
+        'id': User.id,
+        'username': User.username,
+        'trust_level': User.trust_level,
+        'actual_score': User.actual_score,
+        'last_updated': User.last_updated,
+    }, 'id')
+    return render_template('admin/users.html', users=pagination.items, pagination=pagination)
 
 @admin_bp.route('/user/<int:id>', methods=['GET', 'POST'])
 @login_required
@@ -78,6 +216,7 @@ def edit_user(id):
         user.trust_level = int(request.form.get('trust_level'))
         user.original_score = int(request.form.get('original_score'))
         user.actual_score = int(request.form.get('actual_score'))
+        leaderboards.record_user(user)
         db.session.commit()
         flash('用户信息已更新')
         return redirect(url_for('admin.users'))
@@ -87,8 +226,16 @@ def edit_user(id):
 @login_required
 @admin_required
 def apps():
-    apps = App.query.all()
-    return render_template('admin/apps.html', apps=apps)
+    query = App.query.options(joinedload(App.owner))
+    keyword = request.args.get('q', '').strip()
+    if keyword:
+        query = query.filter(App.name.contains(keyword))
+    pagination = paginate(query, {
+        'id': App.id,
+        'name': App.name,
+        'created_at': App.created_at,
+    }, 'id')
+    return render_template('admin/apps.html', apps=pagination.items, pagination=pagination)
 
 @admin_bp.route('/app/<int:id>', methods=['GET', 'POST'])
 @login_required
@@ -99,24 +246,176 @@ def edit_app(id):
         app.name = request.form.get('name')
         app.description = request.form.get('description')
         app.redirect_uri = request.form.get('redirect_uri')
+        app.rate_limit = request.form.get('rate_limit', type=int) or None
+        app.rate_burst = request.form.get('rate_burst', type=int) or None
+        app.callback_url = request.form.get('callback_url') or None
         db.session.commit()
         flash('应用信息已更新')
         return redirect(url_for('admin.apps'))
-    return render_template('admin/edit_app.html', app=app)
+    return render_template('admin/edit_app.html', app=app,
+                           default_rate_limit=ratelimit.APP_RATE_LIMIT,
+                           default_rate_burst=ratelimit.APP_RATE_BURST)
 
 @admin_bp.route('/consumptions')
 @login_required
 @admin_required
 def consumptions():
-    consumptions = ScoreConsumption.query.all()
-    return render_template('admin/consumptions.html', consumptions=consumptions)
+    conditions = record_filters(ScoreConsumption)
+    username = request.args.get('username', '').strip()
+    if username:
+        conditions.append(ScoreConsumption.user_id == user_id_of(username))
+    app_id = request.args.get('app_id', type=int)
+    if app_id:
+        conditions.append(ScoreConsumption.app_id == app_id)
+
+    query = ScoreConsumption.query\
+        .options(joinedload(ScoreConsumption.user), joinedload(ScoreConsumption.app))\
+        .filter(*conditions)
+    pagination = paginate(query, {
+        'id': ScoreConsumption.id,
+        'amount': ScoreConsumption.amount,
+        'created_at': ScoreConsumption.created_at,
+    }, 'id')
+    return render_template('admin/consumptions.html',
+                         consumptions=pagination.items,
+                         pagination=pagination,
+                         totals=status_totals(ScoreConsumption, conditions))
 
 @admin_bp.route('/transfers')
 @login_required
 @admin_required
 def transfers():
-    transfers = ScoreTransfer.query.all()
-    return render_template('admin/transfers.html', transfers=transfers)
+    conditions = record_filters(ScoreTransfer)
+    username = request.args.get('username', '').strip()
+    if username:
+        user_id = user_id_of(username)
+        conditions.append(or_(ScoreTransfer.from_user_id == user_id,
+                              ScoreTransfer.to_user_id == user_id))
+    transfer_type = request.args.get('type')
+    if transfer_type:
+        conditions.append(ScoreTransfer.type == transfer_type)
+
+    query = ScoreTransfer.query\
+        .options(joinedload(ScoreTransfer.from_user), joinedload(ScoreTransfer.to_user))\
+        .filter(*conditions)
+    pagination = paginate(query, {
+        'id': ScoreTransfer.id,
+        'amount': ScoreTransfer.amount,
+        'created_at': ScoreTransfer.created_at,
+    }, 'id')
+    return render_template('admin/transfers.html',
+                         transfers=pagination.items,
+                         pagination=pagination,
+                         totals=status_totals(ScoreTransfer, conditions))
+
+def export_statement(kind, conditions):
+    """导出使用的查询, 只选择需要的列, 不加载 ORM 对象"""
+    if kind == 'consumptions':
+        return select(
+            ScoreConsumption.id,
+            ScoreConsumption.user_id,
+            User.username,
+            ScoreConsumption.app_id,
+            ScoreConsumption.amount,
+            ScoreConsumption.developer_amount,
+            ScoreConsumption.fee_amount,
+            ScoreConsumption.purpose,
+            ScoreConsumption.status,
+            ScoreConsumption.confirmed_at,
+            ScoreConsumption.created_at
+        ).outerjoin(User, User.id == ScoreConsumption.user_id)\
+            .where(*conditions).order_by(ScoreConsumption.id)
+
+    from_user = aliased(User)
+    to_user = aliased(User)
+    return select(
+        ScoreTransfer.id,
+        ScoreTransfer.from_user_id,
+        from_user.username.label('from_username'),
+        ScoreTransfer.to_user_id,
+        to_user.username.label('to_username'),
+        ScoreTransfer.amount,
+        ScoreTransfer.fee_amount,
+        ScoreTransfer.actual_amount,
+        ScoreTransfer.type,
+        ScoreTransfer.batch_id,
+        ScoreTransfer.message,
+        ScoreTransfer.status,
+        ScoreTransfer.confirmed_at,
+        ScoreTransfer.created_at
+    ).outerjoin(from_user, from_user.id == ScoreTransfer.from_user_id)\
+        .outerjoin(to_user, to_user.id == ScoreTransfer.to_user_id)\
+        .where(*conditions).order_by(ScoreTransfer.id)
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def encode_csv(columns, partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in partitions:
+        writer.writerows([export_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    yield buffer.getvalue()
+
+def encode_ndjson(columns, partitions):
+    for rows in partitions:
+        yield ''.join(
+            json.dumps(dict(zip(columns, map(export_value, row))), ensure_ascii=False) + '\n'
+            for row in rows
+        )
+
+def gzip_chunks(chunks):
+    """边生成边压缩"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@admin_bp.route('/export/<kind>')
+@login_required
+@admin_required
+def export(kind):
+    """流式导出消费或转账记录, 支持 CSV/NDJSON 和 gzip 压缩"""
+    if kind not in ('consumptions', 'transfers'):
+        abort(404)
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    compress = request.args.get('gzip', 'false').lower() in ('1', 'true')
+
+    model = ScoreConsumption if kind == 'consumptions' else ScoreTransfer
+    statement = export_statement(kind, record_filters(model))
+
+    def generate():
+        # yield_per 使用服务端游标分块读取, 内存占用与导出行数无关
+        result = db.session.execute(statement.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        # 客户端中途断开时生成器被关闭, 也要释放游标
+        try:
+            encode = encode_csv if export_format == 'csv' else encode_ndjson
+            chunks = encode(list(result.keys()), result.partitions())
+            if compress:
+                yield from gzip_chunks(chunks)
+            else:
+                for chunk in chunks:
+                    yield chunk.encode('utf-8')
+        finally:
+            result.close()
+
+    filename = f"{kind}-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.{export_format}"
+    mimetype = EXPORT_FORMATS[export_format]
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    current_app.logger.info(f"{current_user.username} 导出 {kind}: {request.query_string.decode()}")
+    return Response(stream_with_context(generate()),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 def init_admin(app):
     """初始化管理员账号"""
@@ -1,82 +1,214 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
-import asyncio
-from asgiref.wsgi import WsgiToAsgi
+"""DoScores 的 Flask 应用
+
+create_app() 创建并配置应用, 导入本模块不读取 .env、不连接数据库也不建表;
+建表由 run.py、init_db.py 和 migrate.py 在启动前显式执行。视图函数在导入时登记,
+由 create_app 注册到每个新建的应用上。论坛 OAuth 客户端在首次登录时才初始化,
+异步路径在 create_asgi_app 中才导入。
+
+为兼容 from app import app, asgi_app, 首次访问这两个名字时创建一个默认应用。
+"""
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, stream_with_context, current_app, g
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from authlib.integrations.flask_client import OAuth
-from models.models import db, User, App, ScoreConsumption, ScoreTransfer
+from models.models import db, User, App, ScoreConsumption, ScoreTransfer, BatchTransfer
+from app_auth import app_credentials
+from history import fetch_history, serialize_record, HISTORY_PAGE_SIZE
+import leaderboards
+import rank_index
+import rollups
+from forum_client import forum_scores
+import services
+import batch_engine
+import balances
+import tokens
+import jwt_auth
+import idempotency
+import ratelimit
+import consumption_status
+import metrics
+from admin import admin_bp
+from services import ScoreError
+import lifecycle
 import os
-import json
-import httpx
 import secrets
+import threading
+import time
 from datetime import datetime, timedelta
-import jwt
-from functools import wraps
-from urllib.parse import urlencode
-
-from dotenv import load_dotenv
-load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', os.urandom(24))
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///scores.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SESSION_COOKIE_SECURE'] = os.getenv('FLASK_ENV') == 'production'  # 生产环境才启用HTTPS-only
-app.config['SESSION_COOKIE_HTTPONLY'] = True  # 防止JavaScript访问cookie
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=5)  # session过期时间
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # 防止CSRF攻击
-
-# 初始化扩展
-db.init_app(app)
-with app.app_context():
-    db.create_all()
+from sqlalchemy import text, select
+from sqlalchemy.orm import joinedload
+from functools import wraps, partial
 
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
-
-# OAuth2配置
-oauth = OAuth(app)
-oauth.register(
-    name='linux_do',
-    client_id=os.getenv('OAUTH_CLIENT_ID'),
-    client_secret=os.getenv('OAUTH_CLIENT_SECRET'),
-    access_token_url='https://connect.linux.do/oauth2/token',
-    access_token_params=None,
-    authorize_url='https://connect.linux.do/oauth2/authorize',
-    authorize_params=None,
-    api_base_url='https://connect.linux.do/api/',
-    client_kwargs={'scope': 'user'},
-)
+login_manager.blueprint_login_views = {'admin': 'admin.login'}
+
+# 视图登记表: (路径, 视图函数, add_url_rule 参数), 端点名为函数名
+_views = []
+
+def route(rule, **options):
+    """登记视图, 与 Flask.route 用法相同"""
+    def decorator(f):
+        _views.append((rule, f, options))
+        return f
+    return decorator
+
+def create_app(config=None):
+    """创建 Flask 应用, config 中的配置覆盖环境变量"""
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', os.urandom(24))
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///scores.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SESSION_COOKIE_SECURE'] = os.getenv('FLASK_ENV') == 'production'  # 生产环境才启用HTTPS-only
+    app.config['SESSION_COOKIE_HTTPONLY'] = True  # 防止JavaScript访问cookie
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=5)  # session过期时间
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # 防止CSRF攻击
+    app.config['OAUTH_CLIENT_ID'] = os.getenv('OAUTH_CLIENT_ID')
+    app.config['OAUTH_CLIENT_SECRET'] = os.getenv('OAUTH_CLIENT_SECRET')
+
+    # 每个工作进程的数据库连接池大小
+    if os.getenv('DB_POOL_SIZE'):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.getenv('DB_POOL_SIZE')),
+            'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 0)),
+            'pool_pre_ping': True
+        }
+    if config:
+        app.config.update(config)
+    app.config['JWT_KEYS'] = jwt_auth.load_keys(app.config['SECRET_KEY'])
+
+    # 初始化扩展, 引擎在第一次查询时才连接数据库
+    db.init_app(app)
+    login_manager.init_app(app)
+
+    # 请求和查询指标, 由 /metrics 输出
+    metrics.init_app(app)
+    metrics.registry.register_collector('app_auth_cache', app_credentials.stats)
+    metrics.registry.register_collector('token_cache', tokens.token_cache.stats)
+    metrics.registry.register_collector('rate_limit', ratelimit.limiter.stats)
+    metrics.registry.register_collector('status_waiters',
+                                        lambda: {'size': consumption_status.waiters.size()})
+    metrics.registry.register_collector('jwt_revocations', jwt_auth.revocations.stats)
+    metrics.registry.register_collector('rank_index', rank_index.index.stats)
+
+    app.after_request(apply_jwt_reissue)
+
+    app.register_error_handler(404, page_not_found)
+    app.register_error_handler(500, internal_server_error)
+    app.register_error_handler(403, forbidden)
+    for rule, view, options in _views:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_blueprint(admin_bp)
+    return app
+
+def create_asgi_app(flask_app=None):
+    """创建 ASGI 应用: 热点接口走原生异步路径, 其余请求交给 Flask"""
+    from fastpath import create_fastpath
+    flask_app = flask_app or create_app()
+    asgi = create_fastpath(flask_app)
+    # 工作进程启动时在后台构建排行榜名次索引
+    asgi.router.on_startup.append(partial(rank_index.index.warm, flask_app))
+    return asgi
+
+# 默认应用, 由 __getattr__ 在首次访问时创建
+_default = {}
+_default_lock = threading.Lock()
+
+def __getattr__(name):
+    if name not in ('app', 'asgi_app'):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _default_lock:
+        if 'app' not in _default:
+            _default['app'] = create_app()
+        if name == 'asgi_app' and 'asgi_app' not in _default:
+            _default['asgi_app'] = create_asgi_app(_default['app'])
+    return _default[name]
+
+def oauth_client():
+    """论坛 OAuth2 客户端, 首次使用时导入 authlib 并注册到当前应用"""
+    client = current_app.extensions.get('linux_do')
+    if client is None:
+        from authlib.integrations.flask_client import OAuth
+        client = OAuth(current_app).register(
+            name='linux_do',
+            client_id=current_app.config['OAUTH_CLIENT_ID'],
+            client_secret=current_app.config['OAUTH_CLIENT_SECRET'],
+            access_token_url='https://connect.linux.do/oauth2/token',
+            access_token_params=None,
+            authorize_url='https://connect.linux.do/oauth2/authorize',
+            authorize_params=None,
+            api_base_url='https://connect.linux.do/api/',
+            client_kwargs={'scope': 'user'},
+        )
+        current_app.extensions['linux_do'] = client
+    return client
 
 # 错误处理
-@app.errorhandler(404)
 def page_not_found(e):
     return render_template('error.html', 
                          error_code=404,
                          error_message="页面未找到"), 404
 
-@app.errorhandler(500)
 def internal_server_error(e):
     return render_template('error.html',
                          error_code=500,
                          error_message="服务器内部错误"), 500
 
-@app.errorhandler(403)
 def forbidden(e):
     return render_template('error.html',
                          error_code=403,
                          error_message="没有权限访问此页面"), 403
 
+def set_jwt_cookie(response, token):
+    response.set_cookie(jwt_auth.JWT_COOKIE, token, max_age=jwt_auth.JWT_TTL, httponly=True,
+                        secure=current_app.config['SESSION_COOKIE_SECURE'], samesite='Lax')
+    return response
+
+def reissue_jwt(user):
+    """请求结束时为用户换发 JWT"""
+    if user is not None:
+        g.jwt_reissue = jwt_auth.encode(current_app.config['JWT_KEYS'], user)
+    return user
+
+def apply_jwt_reissue(response):
+    token = g.pop('jwt_reissue', None)
+    # 本次请求中退出登录时不再写回 cookie
+    if token is not None and current_user.is_authenticated:
+        set_jwt_cookie(response, token)
+    return response
+
+def load_jwt_identity(user_id=None):
+    """从 JWT cookie 解析当前用户, 声明需要刷新时从数据库读取并换发
+
+    JWT 已吊销时同时清除登录会话, 之后的请求不能再凭会话换发。
+    """
+    token = request.cookies.get(jwt_auth.JWT_COOKIE)
+    if not token:
+        return None
+    keys = current_app.config['JWT_KEYS']
+    claims = jwt_auth.decode(keys, token)
+    if claims is None or (user_id is not None and claims['sub'] != user_id):
+        return None
+    if jwt_auth.revocations.is_revoked(db.session, claims['jti']):
+        session.clear()
+        return None
+    if jwt_auth.needs_refresh(keys, token, claims):
+        return reissue_jwt(db.session.get(User, int(claims['sub'])))
+    return jwt_auth.Identity(claims)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # 会话与 JWT 属于同一用户时直接使用 JWT 中的身份, 不查询数据库
+    # 只有请求没有带 JWT 时才凭会话换发, 带了无效或已吊销的 JWT 时拒绝
+    if request.cookies.get(jwt_auth.JWT_COOKIE):
+        return load_jwt_identity(user_id)
+    return reissue_jwt(db.session.get(User, int(user_id)))
 
-def create_jwt_token(user_id):
-    payload = {
-        'user_id': user_id,
-        'exp': datetime.utcnow() + timedelta(days=7)
-    }
-    return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
+@login_manager.request_loader
+def load_user_from_jwt(request):
+    """没有登录会话时使用 JWT cookie"""
+    return load_jwt_identity()
 
 def require_app_auth(f):
     @wraps(f)
@@ -87,38 +219,128 @@ def require_app_auth(f):
         
         try:
             client_id, client_secret = auth.split(':')
-            app = App.query.filter_by(
-                client_id=client_id,
-                client_secret=client_secret
-            ).first()
+            cached_app = app_credentials.verify(client_id, client_secret)
             
-            if not app:
+            if not cached_app:
                 return jsonify({'error': '无效的应用认证信息'}), 401
                 
-            # 将app对象添加到请求上下文
-            request.current_app = app
-            return f(*args, **kwargs)
+            # 将应用快照添加到请求上下文
+            request.current_app = cached_app
         except ValueError:
             return jsonify({'error': '认证格式错误'}), 401
         except Exception as e:
-            app.logger.error(f"API认证错误: {str(e)}")
+            current_app.logger.error(f"API认证错误: {str(e)}")
             return jsonify({'error': '认证失败'}), 401
+        return rate_limited(ratelimit.limiter.check_app(request.current_app), f, *args, **kwargs)
             
     return decorated
 
-@app.route('/')
+def rate_limited(decision, f, *args, **kwargs):
+    """配额用尽时返回 429, 否则执行视图, 两种情况都带上限流响应头"""
+    if decision is not None and not decision.allowed:
+        response = jsonify(ratelimit.LIMITED_BODY)
+        response.status_code = 429
+    else:
+        response = current_app.make_response(f(*args, **kwargs))
+    return ratelimit.add_headers(response, decision)
+
+def user_rate_limit(f):
+    """按登录用户限流, 放在 login_required 之后"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        return rate_limited(ratelimit.limiter.check_user(current_user.id), f, *args, **kwargs)
+    return decorated
+
+def idempotent(scope_of):
+    """请求带 Idempotency-Key 时重放已保存的响应, 放在认证装饰器之后"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = request.headers.get(idempotency.HEADER)
+            if key is None:
+                return f(*args, **kwargs)
+
+            scope = scope_of()
+            request_fingerprint = idempotency.fingerprint(request.method, request.path,
+                                                          request.get_data())
+            try:
+                stored = idempotency.begin(db.session, scope, key, request_fingerprint)
+            except ScoreError as e:
+                db.session.rollback()
+                return jsonify(e.to_dict()), e.status
+            if stored is not None:
+                response = current_app.response_class(stored.body, status=stored.status_code,
+                                              mimetype='application/json')
+                response.headers[idempotency.REPLAYED_HEADER] = 'true'
+                return response
+
+            response = current_app.make_response(f(*args, **kwargs))
+            try:
+                idempotency.complete(db.session, scope, key, response.status_code,
+                                     response.get_data(as_text=True))
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"保存幂等响应失败: {str(e)}")
+            return response
+        return decorated
+    return decorator
+
+@route('/healthz')
+def healthz():
+    """存活检查"""
+    return jsonify({'status': 'ok'})
+
+@route('/readyz')
+def readyz():
+    """就绪检查, 排空中或数据库不可用时返回 503"""
+    if lifecycle.draining.is_set():
+        return jsonify({'status': 'draining'}), 503
+    try:
+        db.session.execute(text('SELECT 1'))
+    except Exception as e:
+        current_app.logger.error(f"就绪检查失败: {str(e)}")
+        return jsonify({'status': 'unavailable'}), 503
+    return jsonify({'status': 'ready'})
+
+@route('/metrics')
+def metrics_endpoint():
+    """Prometheus 格式的指标"""
+    if metrics.METRICS_TOKEN and not secrets.compare_digest(
+            request.headers.get('Authorization', ''), f'Bearer {metrics.METRICS_TOKEN}'):
+        return jsonify({'error': '无权访问'}), 401
+    return current_app.response_class(metrics.registry.render(), mimetype=None,
+                              content_type=metrics.CONTENT_TYPE)
+
+@route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/login')
+@route('/login')
 def login():
     redirect_uri = url_for('oauth2_callback', _external=True)
     # 生成随机state并存储在session中
     state = secrets.token_urlsafe(16)
     session['oauth_state'] = state
-    return oauth.linux_do.authorize_redirect(redirect_uri, state=state)
+    return oauth_client().authorize_redirect(redirect_uri, state=state)
+
+def apply_forum_score(user, gamification_score):
+    """同步论坛点数到用户"""
+    user.original_score = gamification_score
+    if user.actual_score == 0:  # 如果是首次登录
+        user.actual_score = gamification_score
+    user.last_updated = datetime.utcnow()
+
+def save_forum_score(flask_app, user_id, gamification_score):
+    """后台获取到论坛点数后写回数据库"""
+    with flask_app.app_context():
+        user = db.session.get(User, user_id)
+        if not user:
+            return
+        apply_forum_score(user, gamification_score)
+        leaderboards.record_user(user)
+        db.session.commit()
 
-@app.route('/oauth2/callback')
+@route('/oauth2/callback')
 def oauth2_callback():
     # 验证state
     state = session.pop('oauth_state', None)
@@ -127,121 +349,129 @@ def oauth2_callback():
         return redirect(url_for('index'))
     
     try:
-        token = oauth.linux_do.authorize_access_token()
+        token = oauth_client().authorize_access_token()
     except Exception as e:
-        app.logger.error(f"OAuth认证失败: {str(e)}")
+        current_app.logger.error(f"OAuth认证失败: {str(e)}")
         flash('认证失败，请重试')
         return redirect(url_for('index'))
-    resp = oauth.linux_do.get('user')
+    resp = oauth_client().get('user')
     user_info = resp.json()
     
-    # 获取用户点数
-    def get_score():
-        try:
-            import requests
-            session = requests.Session()
-            session.verify = False
-            
-            # 全局代理配置
-            use_proxy = os.getenv('USE_PROXY', 'false').lower() == 'true'
-            if use_proxy:
-                proxy = os.getenv('HTTP_PROXY')
-                if proxy:
-                    session.proxies = {
-                        "http": proxy,
-                        "https": proxy
-                    }
-                    app.logger.info(f"使用代理获取用户 {user_info['username']} 的点数信息")
-            else:
-                app.logger.info(f"开始获取用户 {user_info['username']} 的点数信息")
-            
-            score_resp = session.get(
-                f"https://linux.do/u/{user_info['username']}.json",
-                timeout=30.0
-            )
-            score_resp.raise_for_status()
-            score_data = score_resp.json()
-            
-            if not score_data or 'user' not in score_data:
-                raise ValueError("响应数据格式错误")
-                
-            return score_data['user'].get('gamification_score', 0)
-            
-        except Exception as e:
-            app.logger.error(f"获取用户点数失败: {str(e)}")
-            return 0
-    
-    gamification_score = get_score()
+    # 优先使用缓存的论坛点数, 否则沿用已有点数并在后台刷新
+    gamification_score = forum_scores.get_cached(user_info['username'])
     
     user = User.query.filter_by(forum_id=user_info['id']).first()
     if user:
         user.username = user_info['username']
         user.name = user_info['name']
         user.trust_level = user_info['trust_level']
-        user.original_score = gamification_score
-        if user.actual_score == 0:  # 如果是首次登录
-            user.actual_score = gamification_score
+        if gamification_score is not None:
+            apply_forum_score(user, gamification_score)
     else:
         user = User(
             forum_id=user_info['id'],
             username=user_info['username'],
             name=user_info['name'],
             trust_level=user_info['trust_level'],
-            original_score=gamification_score,
-            actual_score=gamification_score
+            original_score=gamification_score or 0,
+            actual_score=gamification_score or 0
         )
         db.session.add(user)
     
+    leaderboards.record_user(user)
     db.session.commit()
     login_user(user)
     
+    if gamification_score is None:
+        current_app.logger.info(f"开始获取用户 {user.username} 的点数信息")
+        forum_scores.refresh(user.username, partial(save_forum_score, current_app._get_current_object(), user.id))
+    
     # 创建JWT token并存储在cookie中
-    token = create_jwt_token(user.id)
-    response = redirect(url_for('dashboard'))
-    response.set_cookie('jwt_token', token, httponly=True, max_age=7*24*60*60)
-    return response
+    token = jwt_auth.encode(current_app.config['JWT_KEYS'], user)
+    return set_jwt_cookie(redirect(url_for('dashboard')), token)
 
-@app.route('/transfer')
+@route('/transfer')
 @login_required
 def transfer_score_page():
     return render_template('transfer.html')
 
-@app.route('/batch-transfer')
+@route('/batch-transfer')
 @login_required
 def batch_transfer():
     return render_template('batch_transfer.html')
 
-@app.route('/leaderboard')
+@route('/leaderboard')
 @login_required
 def leaderboard():
-    # 获取富豪榜(按实际积分排序)
-    richest_users = User.query.filter_by(show_in_leaderboard=True)\
-        .order_by(User.actual_score.desc())\
-        .limit(10).all()
+    # 富豪榜、慷慨榜、消费榜均读取预先计算的快照
+    richest_users = leaderboards.get_board('richest')
+    most_generous_users = leaderboards.get_board('generous')
+    most_consumed_users = leaderboards.get_board('consumed')
     
-    # 获取慷慨榜(按总转出积分排序)
-    most_generous_users = User.query.filter_by(show_in_leaderboard=True)\
-        .order_by(User.total_transferred.desc())\
-        .limit(10).all()
+    # 分页获取所有用户详细排名
+    ranking = leaderboards.get_ranking(request.args.get('page', 1, type=int))
     
-    # 获取消费榜(按总消耗积分排序)
-    most_consumed_users = User.query.filter_by(show_in_leaderboard=True)\
-        .order_by(User.total_consumed.desc())\
-        .limit(10).all()
+    # 当前用户在富豪榜中的名次, 未参与排行时不显示
+    try:
+        my_rank = rank_index.rank(db.session, 'richest', current_user.id)
+    except ScoreError:
+        my_rank = None
     
-    # 获取所有用户详细排名
-    all_users = User.query.filter_by(show_in_leaderboard=True)\
-        .order_by(User.actual_score.desc())\
-        .all()
+    # 本周慷慨榜和今日消费榜, 由按天汇总求和
+    weekly_generous_users = rollups.top(db.session, 'generous', *rollups.period('week'))
+    daily_consumed_users = rollups.top(db.session, 'consumed', *rollups.period('today'))
     
     return render_template('leaderboard.html',
                          richest_users=richest_users,
                          most_generous_users=most_generous_users,
                          most_consumed_users=most_consumed_users,
-                         all_users=all_users)
+                         weekly_generous_users=weekly_generous_users,
+                         daily_consumed_users=daily_consumed_users,
+                         all_users=ranking.items,
+                         ranking=ranking,
+                         my_rank=my_rank)
+
+@route('/api/leaderboard/<board>/rank')
+@login_required
+@user_rate_limit
+def leaderboard_rank(board):
+    """查询用户在榜单中的名次和前后的用户, 默认为当前用户"""
+    username = request.args.get('username')
+    user_id = current_user.id
+    if username:
+        user_id = db.session.execute(
+            select(User.id).where(User.username == username)
+        ).scalar()
+        if user_id is None:
+            return jsonify({'error': '用户不存在'}), 404
+    try:
+        result = rank_index.rank(db.session, board, user_id,
+                                 request.args.get('radius', 5, type=int))
+    except ScoreError as e:
+        return jsonify(e.to_dict()), e.status
+    return jsonify(result)
 
-@app.route('/api/settings/leaderboard', methods=['POST'])
+@route('/api/leaderboard/<board>/window')
 @login_required
+@user_rate_limit
+def leaderboard_window(board):
+    """时间窗口榜单, period 为 today/yesterday/week/month/7d/30d, 或用 start/end 指定日期"""
+    try:
+        start, end = rollups.parse_window(request.args)
+        users = rollups.top(db.session, board, start, end,
+                            request.args.get('limit', rollups.ROLLUP_BOARD_SIZE, type=int))
+    except ScoreError as e:
+        return jsonify(e.to_dict()), e.status
+    return jsonify({
+        'board': board,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'users': users,
+    })
+
+@route('/api/settings/leaderboard', methods=['POST'])
+@login_required
+@user_rate_limit
 def update_leaderboard_settings():
     """更新排行榜显示设置"""
     data = request.json
@@ -249,38 +479,47 @@ def update_leaderboard_settings():
         return jsonify({'error': '缺少必要参数'}), 400
     
     try:
-        current_user.show_in_leaderboard = bool(data['show'])
+        user = db.session.get(User, current_user.id)
+        user.show_in_leaderboard = bool(data['show'])
+        leaderboards.record_user(user)
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"更新排行榜设置失败: {str(e)}")
+        current_app.logger.error(f"更新排行榜设置失败: {str(e)}")
         return jsonify({'error': '操作失败'}), 500
 
-@app.route('/dashboard')
+@route('/dashboard')
 @login_required
 def dashboard():
-    # 获取消耗记录
-    consumptions = ScoreConsumption.query.filter_by(user_id=current_user.id)\
-        .order_by(ScoreConsumption.created_at.desc())\
-        .all()
-    
-    # 获取转账记录（发送和接收）
-    transfers = ScoreTransfer.query.filter(
-        (ScoreTransfer.from_user_id == current_user.id) |
-        (ScoreTransfer.to_user_id == current_user.id)
-    ).order_by(ScoreTransfer.created_at.desc()).all()
+    # 按游标分页获取消耗和转账记录
+    try:
+        records, next_cursor = fetch_history(current_user.id,
+                                             cursor=request.args.get('cursor'))
+    except ValueError:
+        return redirect(url_for('dashboard'))
     
-    # 合并记录并按时间排序
-    records = sorted(
-        consumptions + transfers,
-        key=lambda x: x.created_at,
-        reverse=True
-    )
+    return render_template('dashboard.html', records=records, next_cursor=next_cursor)
+
+@route('/api/history')
+@login_required
+@user_rate_limit
+def history():
+    """分页获取点数记录"""
+    try:
+        limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+        records, next_cursor = fetch_history(current_user.id,
+                                             limit=limit,
+                                             cursor=request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': '无效的分页参数'}), 400
     
-    return render_template('dashboard.html', records=records)
+    return jsonify({
+        'records': [serialize_record(r, current_user.id) for r in records],
+        'next_cursor': next_cursor
+    })
 
-@app.route('/developer')
+@route('/developer')
 @login_required
 def developer():
     if current_user.trust_level < 1:
@@ -289,7 +528,7 @@ def developer():
     apps = App.query.filter_by(user_id=current_user.id).all()
     return render_template('developer.html', apps=apps)
 
-@app.route('/playground')
+@route('/playground')
 @login_required
 def playground():
     if current_user.trust_level < 1:
@@ -298,195 +537,130 @@ def playground():
     apps = App.query.filter_by(user_id=current_user.id).all()
     return render_template('playground.html', apps=apps)
 
-@app.route('/logout')
+@route('/logout')
 @login_required
 def logout():
+    # 吊销当前的 JWT, 其他进程最迟在下次同步吊销列表后拒绝它
+    claims = jwt_auth.decode(current_app.config['JWT_KEYS'],
+                             request.cookies.get(jwt_auth.JWT_COOKIE, ''))
+    if claims is not None:
+        jwt_auth.revocations.revoke(db.session, claims)
+        db.session.commit()
     logout_user()
     response = redirect(url_for('index'))
-    response.delete_cookie('jwt_token')
+    response.delete_cookie(jwt_auth.JWT_COOKIE)
     return response
 
-@app.route('/api/apps', methods=['POST'])
+@route('/api/apps', methods=['POST'])
 @login_required
-def create_app():
+@user_rate_limit
+def create_developer_app():
     if current_user.trust_level < 1:
         return jsonify({'error': '需要信任等级1以上才能创建应用'}), 403
     
     data = request.json
-    app = App(
+    new_app = App(
         name=data['name'],
         description=data.get('description', ''),
         client_id=os.urandom(16).hex(),
         client_secret=os.urandom(32).hex(),
         redirect_uri=data['redirect_uri'],
+        callback_url=data.get('callback_url') or None,
         user_id=current_user.id
     )
-    db.session.add(app)
+    db.session.add(new_app)
     db.session.commit()
     return jsonify({
-        'id': app.id,
-        'client_id': app.client_id,
-        'client_secret': app.client_secret
+        'id': new_app.id,
+        'client_id': new_app.client_id,
+        'client_secret': new_app.client_secret
     })
 
-def generate_confirm_token():
-    """生成确认token"""
-    return secrets.token_urlsafe(32)
-
-@app.route('/confirm/<token>')
+@route('/confirm/<token>')
 def confirm_page(token):
     """确认页面"""
-    consumption = ScoreConsumption.query.filter_by(confirm_token=token, status='pending').first()
-    if consumption:
-        return render_template('confirm.html', 
-                             operation='consume',
-                             consumption=consumption,
-                             is_popup='popup' in request.args)
+    entry = tokens.lookup(db.session, token)
+    if entry and tokens.is_expired(entry):
+        return render_template('error.html',
+                             error_code=410,
+                             error_message="确认链接已过期"), 410
+    
+    if entry and entry.kind == 'consume':
+        consumption = db.session.get(ScoreConsumption, entry.record_id)
+        if consumption and consumption.status == 'pending':
+            return render_template('confirm.html', 
+                                 operation='consume',
+                                 consumption=consumption,
+                                 is_popup='popup' in request.args)
     
-    transfer = ScoreTransfer.query.filter_by(confirm_token=token, status='pending').first()
-    if transfer:
-        return render_template('confirm.html',
-                             operation='transfer',
-                             transfer=transfer,
-                             is_popup='popup' in request.args)
+    if entry and entry.kind == 'transfer':
+        transfer = db.session.get(ScoreTransfer, entry.record_id)
+        if transfer and transfer.status == 'pending':
+            return render_template('confirm.html',
+                                 operation='transfer',
+                                 transfer=transfer,
+                                 batch=None,
+                                 batch_transfers=[],
+                                 is_popup='popup' in request.args)
+    
+    if entry and entry.kind == 'batch':
+        batch = db.session.get(BatchTransfer, entry.record_id)
+        batch_transfers = []
+        if batch and batch.status == 'pending':
+            batch_transfers = ScoreTransfer.query\
+                .options(joinedload(ScoreTransfer.to_user))\
+                .filter_by(batch_id=batch.batch_id, status='pending')\
+                .all()
+        if batch_transfers:
+            return render_template('confirm.html',
+                                 operation='transfer',
+                                 transfer=batch_transfers[0],
+                                 batch=batch,
+                                 batch_transfers=batch_transfers,
+                                 is_popup='popup' in request.args)
     
     return render_template('error.html',
                          error_code=404,
                          error_message="无效或已使用的确认链接"), 404
 
-@app.route('/confirm/consume/<token>', methods=['POST'])
+@route('/confirm/consume/<token>', methods=['POST'])
 @login_required
+@user_rate_limit
 def confirm_consumption(token):
     """确认点数消耗"""
-    consumption = ScoreConsumption.query.filter_by(
-        confirm_token=token,
-        status='pending',
-        user_id=current_user.id
-    ).first()
-    
-    if not consumption:
-        return jsonify({'error': '无效或已使用的确认链接'}), 404
-    
-    action = request.form.get('action')
-    if action == 'confirm':
-        if current_user.actual_score < consumption.amount:
-            return jsonify({'error': '点数不足', 'current_score': current_user.actual_score}), 400
-        
-        current_user.actual_score -= consumption.amount
-        current_user.total_consumed += consumption.amount
-        current_user.total_fee_paid += consumption.fee_amount
-        consumption.status = 'confirmed'
-        consumption.confirmed_at = datetime.utcnow()
-        db.session.commit()
-        
-        return jsonify({
-            'success': True,
-            'username': current_user.username,
-            'consumed': consumption.amount,
-            'remaining_score': current_user.actual_score
-        })
-    elif action == 'reject':
-        consumption.status = 'rejected'
-        db.session.commit()
-        return jsonify({
-            'success': False,
-            'error': '用户拒绝了操作'
-        })
-    
-    return jsonify({'error': '无效的操作'}), 400
+    try:
+        result = balances.retrying(db.session, services.confirm_consumption,
+                                   current_user, token, request.form.get('action'))
+    except ScoreError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), e.status
+    return jsonify(result)
 
-@app.route('/confirm/transfer/<token>', methods=['POST'])
+@route('/confirm/transfer/<token>', methods=['POST'])
 @login_required
+@user_rate_limit
 def confirm_transfer(token):
     """确认点数转账"""
-    transfer = ScoreTransfer.query.filter_by(
-        confirm_token=token,
-        status='pending',
-        from_user_id=current_user.id
-    ).first()
-    
-    if not transfer:
-        return jsonify({'error': '无效或已使用的确认链接'}), 404
-    
-    action = request.form.get('action')
-    if action == 'confirm':
-        if current_user.actual_score < transfer.amount:
-            return jsonify({'error': '点数不足', 'current_score': current_user.actual_score}), 400
-        
-        current_user.actual_score -= transfer.amount
-        current_user.total_transferred += transfer.amount
-        current_user.total_fee_paid += transfer.fee_amount
-        
-        transfer.to_user.actual_score += transfer.actual_amount
-        transfer.to_user.total_received += transfer.actual_amount
-        
-        transfer.status = 'confirmed'
-        transfer.confirmed_at = datetime.utcnow()
-        
-        # 如果是批量转账,检查是否所有转账都已确认
-        if transfer.type == 'batch':
-            batch_transfers = ScoreTransfer.query.filter_by(
-                batch_id=transfer.batch_id,
-                status='confirmed'
-            ).all()
-            if len(batch_transfers) == ScoreTransfer.query.filter_by(batch_id=transfer.batch_id).count():
-                flash('批量转账已全部完成')
-        
-        db.session.commit()
-        
-        return jsonify({
-            'success': True,
-            'from_username': current_user.username,
-            'to_username': transfer.to_user.username,
-            'amount': transfer.amount,
-            'remaining_score': current_user.actual_score
-        })
-    elif action == 'reject':
-        transfer.status = 'rejected'
-        db.session.commit()
-        return jsonify({
-            'success': False,
-            'error': '用户拒绝了操作'
-        })
-    
-    return jsonify({'error': '无效的操作'}), 400
+    try:
+        result, batch_completed = balances.retrying(db.session, services.confirm_transfer,
+                                                    current_user, token, request.form.get('action'))
+    except ScoreError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), e.status
+    if batch_completed:
+        flash('批量转账已全部完成')
+    return jsonify(result)
 
-@app.route('/api/score/consume', methods=['POST'])
+@route('/api/score/consume', methods=['POST'])
 @require_app_auth
+@idempotent(lambda: f'app:{request.current_app.id}')
 def consume_score():
     """请求消耗点数"""
-    data = request.json
-    if not data or 'username' not in data or 'amount' not in data:
+    data = request.get_json(silent=True)
+    if data is None:
         return jsonify({'error': '缺少必要参数'}), 400
-        
-    user = User.query.filter_by(username=data['username']).first()
-    if not user:
-        return jsonify({'error': '用户不存在'}), 404
-    
     try:
-        amount = int(data['amount'])
-        if amount <= 0:
-            return jsonify({'error': '消耗点数必须大于0'}), 400
-            
-        if user.actual_score < amount:
-            return jsonify({'error': '用户点数不足', 'current_score': user.actual_score}), 400
-        
-        # 计算开发者实际收到的金额和手续费(3%)
-        fee_amount = int(amount * 0.03)
-        developer_amount = amount - fee_amount
-        
-        # 创建待确认的消耗记录
-        consumption = ScoreConsumption(
-            user_id=user.id,
-            app_id=request.current_app.id,
-            amount=amount,
-            developer_amount=developer_amount,
-            fee_amount=fee_amount,
-            purpose=data.get('purpose', '未说明用途'),
-            confirm_token=generate_confirm_token()
-        )
-        db.session.add(consumption)
-        db.session.commit()
+        consumption = services.create_consumption(db.session, request.current_app.id, data)
         
         # 生成确认URL
         confirm_url = url_for('confirm_page',
@@ -498,46 +672,90 @@ def consume_score():
             'confirm_url': confirm_url,
             'consumption_id': consumption.id
         })
-    except ValueError:
-        return jsonify({'error': '无效的点数值'}), 400
+    except ScoreError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), e.status
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"创建点数消耗请求失败: {str(e)}")
+        return jsonify({'error': '操作失败'}), 500
+
+@route('/api/score/consume/<int:consumption_id>')
+@require_app_auth
+def consume_status(consumption_id):
+    """查询消耗请求的状态, 支持 wait 参数长轮询和 text/event-stream 订阅"""
+    app_id = request.current_app.id
+    try:
+        status = consumption_status.get_status(db.session, app_id, consumption_id)
+        wait = consumption_status.parse_wait(request.args.get('wait'))
+    except ScoreError as e:
+        return jsonify(e.to_dict()), e.status
+
+    poll_interval = consumption_status.STATUS_POLL_INTERVAL
+    if request.accept_mimetypes.best == 'text/event-stream':
+        def stream(status):
+            deadline = time.monotonic() + consumption_status.STATUS_STREAM_TIMEOUT
+            yield consumption_status.sse_event(status)
+            while not consumption_status.is_settled(status) and time.monotonic() < deadline:
+                consumption_status.waiters.wait(consumption_id, poll_interval)
+                db.session.rollback()
+                latest = consumption_status.get_status(db.session, app_id, consumption_id)
+                if latest != status:
+                    status = latest
+                    yield consumption_status.sse_event(status)
+                else:
+                    yield ': keepalive\n\n'
+        return current_app.response_class(stream_with_context(stream(status)),
+                                  mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache'})
+
+    # 等待期间定期重新查询, 以发现其他进程中的确认
+    deadline = time.monotonic() + wait
+    while not consumption_status.is_settled(status) and time.monotonic() < deadline:
+        consumption_status.waiters.wait(consumption_id,
+                                        min(poll_interval, deadline - time.monotonic()))
+        db.session.rollback()
+        status = consumption_status.get_status(db.session, app_id, consumption_id)
+    return jsonify(status)
+
+@route('/api/score/consume/batch', methods=['POST'])
+@require_app_auth
+@idempotent(lambda: f'app:{request.current_app.id}')
+def consume_score_batch():
+    """批量请求消耗点数"""
+    data = request.get_json(silent=True)
+    if data is None:
+        return jsonify({'error': '缺少必要参数'}), 400
+    try:
+        result = batch_engine.create_batch_consumption(db.session, request.current_app.id, data)
+        
+        # 为每条成功的请求生成确认URL
+        for item in result['results']:
+            if 'confirm_token' in item:
+                item['confirm_url'] = url_for('confirm_page',
+                                              token=item.pop('confirm_token'),
+                                              _external=True)
+        
+        return jsonify({'success': True, **result})
+    except ScoreError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), e.status
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"创建点数消耗请求失败: {str(e)}")
+        current_app.logger.error(f"批量创建点数消耗请求失败: {str(e)}")
         return jsonify({'error': '操作失败'}), 500
 
-@app.route('/api/score/transfer', methods=['POST'])
+@route('/api/score/transfer', methods=['POST'])
 @login_required
+@user_rate_limit
+@idempotent(lambda: f'user:{current_user.id}')
 def transfer_score():
     """转账点数"""
-    data = request.json
-    if not data or 'username' not in data or 'amount' not in data:
+    data = request.get_json(silent=True)
+    if data is None:
         return jsonify({'error': '缺少必要参数'}), 400
-        
-    if data['username'] == current_user.username:
-        return jsonify({'error': '不能转账给自己'}), 400
-        
-    to_user = User.query.filter_by(username=data['username']).first()
-    if not to_user:
-        return jsonify({'error': '用户不存在'}), 404
-    
     try:
-        amount = int(data['amount'])
-        if amount <= 0:
-            return jsonify({'error': '转账点数必须大于0'}), 400
-            
-        if current_user.actual_score < amount:
-            return jsonify({'error': '点数不足', 'current_score': current_user.actual_score}), 400
-        
-        # 创建待确认的转账记录
-        transfer = ScoreTransfer(
-            from_user_id=current_user.id,
-            to_user_id=to_user.id,
-            amount=amount,
-            message=data.get('message'),
-            confirm_token=generate_confirm_token()
-        )
-        db.session.add(transfer)
-        db.session.commit()
+        transfer = services.create_transfer(db.session, current_user, data)
         
         # 生成确认URL
         confirm_url = url_for('confirm_page',
@@ -549,83 +767,47 @@ def transfer_score():
             'confirm_url': confirm_url,
             'transfer_id': transfer.id
         })
-    except ValueError:
-        return jsonify({'error': '无效的点数值'}), 400
+    except ScoreError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), e.status
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"创建转账请求失败: {str(e)}")
+        current_app.logger.error(f"创建转账请求失败: {str(e)}")
         return jsonify({'error': '操作失败'}), 500
 
-@app.route('/api/score/batch-transfer', methods=['POST'])
+@route('/api/score/batch-transfer', methods=['POST'])
 @login_required
+@user_rate_limit
+@idempotent(lambda: f'user:{current_user.id}')
 def batch_transfer_score():
     """批量转账"""
-    data = request.json
-    if not data or 'transfers' not in data:
+    data = request.get_json(silent=True)
+    if data is None:
         return jsonify({'error': '缺少必要参数'}), 400
-    
-    transfers = data['transfers']
-    if not transfers or not isinstance(transfers, list):
-        return jsonify({'error': '转账列表格式错误'}), 400
-    
-    # 计算总转账金额
-    total_amount = sum(t.get('amount', 0) for t in transfers)
-    if current_user.actual_score < total_amount:
-        return jsonify({'error': '点数不足', 'current_score': current_user.actual_score}), 400
-    
     try:
-        batch_id = secrets.token_hex(16)
-        confirm_token = generate_confirm_token()
-        
-        for transfer_data in transfers:
-            username = transfer_data.get('username')
-            amount = int(transfer_data.get('amount', 0))
-            message = transfer_data.get('message', '')
-            
-            if not username or amount <= 0:
-                continue
-                
-            to_user = User.query.filter_by(username=username).first()
-            if not to_user or to_user.id == current_user.id:
-                continue
-            
-            # 计算手续费
-            fee_amount = int(amount * 0.07) if amount > 1000 else 0
-            actual_amount = amount - fee_amount
-            
-            transfer = ScoreTransfer(
-                from_user_id=current_user.id,
-                to_user_id=to_user.id,
-                amount=amount,
-                fee_amount=fee_amount,
-                actual_amount=actual_amount,
-                type='batch',
-                batch_id=batch_id,
-                message=message,
-                confirm_token=confirm_token
-            )
-            db.session.add(transfer)
-        
-        db.session.commit()
+        batch = batch_engine.create_batch_transfer(db.session, current_user, data)
         
         # 生成确认URL
         confirm_url = url_for('confirm_page',
-                            token=confirm_token,
+                            token=batch.pop('confirm_token'),
                             _external=True)
         
         return jsonify({
             'success': True,
-            'confirm_url': confirm_url
+            'confirm_url': confirm_url,
+            **batch
         })
+    except ScoreError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), e.status
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"创建批量转账请求失败: {str(e)}")
+        current_app.logger.error(f"创建批量转账请求失败: {str(e)}")
         return jsonify({'error': '操作失败'}), 500
 
-asgi_app = WsgiToAsgi(app)
-
 if __name__ == '__main__':
     import uvicorn
-    with app.app_context():
+    flask_app = create_app()
+    with flask_app.app_context():
         db.create_all()
-    uvicorn.run(asgi_app, host='0.0.0.0', port=8181)
+    uvicorn.run(create_asgi_app(flask_app), host='0.0.0.0', port=8181)
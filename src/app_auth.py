@@ -0,0 +1,141 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+from models.models import db, App
+
+# 认证通过后放入 request.current_app 的应用快照, 避免每次请求都加载 ORM 对象
+CachedApp = namedtuple('CachedApp', ['id', 'name', 'client_id', 'user_id', 'redirect_uri',
+                                     'rate_limit', 'rate_burst'])
+
+
+def hash_secret(client_secret):
+    """计算应用密钥的摘要, 缓存中只保存摘要"""
+    return hashlib.sha256(client_secret.encode('utf-8')).digest()
+
+
+class AppCredentialCache:
+    """按 client_id 缓存应用凭据的 TTL/LRU 缓存
+
+    本进程修改应用后在事务提交时丢弃缓存; 其他进程的缓存最迟在 ttl 秒后过期。
+    """
+
+    def __init__(self, ttl=30, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0  # 每次失效加一, 读取数据库期间失效过的结果不写入缓存
+        self._lock = threading.Lock()
+
+    def _get(self, client_id):
+        with self._lock:
+            entry = self._entries.get(client_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, secret_hash, snapshot = entry
+            if expires_at < time.monotonic():
+                del self._entries[client_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(client_id)
+            self.hits += 1
+            return secret_hash, snapshot
+
+    def _put(self, client_id, secret_hash, snapshot, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[client_id] = (time.monotonic() + self.ttl, secret_hash, snapshot)
+            self._entries.move_to_end(client_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _store(self, app, generation):
+        snapshot = CachedApp(app.id, app.name, app.client_id, app.user_id, app.redirect_uri,
+                             app.rate_limit, app.rate_burst)
+        secret_hash = hash_secret(app.client_secret)
+        self._put(app.client_id, secret_hash, snapshot, generation)
+        return secret_hash, snapshot
+
+    def _check(self, entry, client_secret):
+        if entry is None:
+            return None
+        secret_hash, snapshot = entry
+        if not hmac.compare_digest(secret_hash, hash_secret(client_secret)):
+            return None
+        return snapshot
+
+    def verify(self, client_id, client_secret):
+        """校验应用凭据, 成功返回 CachedApp, 失败返回 None"""
+        entry = self._get(client_id)
+        if entry is None:
+            generation = self._generation
+            app = App.query.filter_by(client_id=client_id).first()
+            entry = self._store(app, generation) if app else None
+        return self._check(entry, client_secret)
+
+    async def verify_async(self, session, client_id, client_secret):
+        """异步接口使用的校验方法, session 为 AsyncSession"""
+        entry = self._get(client_id)
+        if entry is None:
+            generation = self._generation
+            app = (await session.execute(select(App).filter_by(client_id=client_id))).scalars().first()
+            entry = self._store(app, generation) if app else None
+        return self._check(entry, client_secret)
+
+    def invalidate(self, client_id=None):
+        """使指定应用(或全部)缓存失效"""
+        with self._lock:
+            self._generation += 1
+            if client_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(client_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+            }
+
+
+app_credentials = AppCredentialCache(
+    ttl=int(os.getenv('APP_AUTH_CACHE_TTL', 30)),
+    max_size=int(os.getenv('APP_AUTH_CACHE_SIZE', 1024))
+)
+
+
+@event.listens_for(App, 'after_insert')
+@event.listens_for(App, 'after_update')
+@event.listens_for(App, 'after_delete')
+def _stage_invalidation(mapper, connection, target):
+    # 应用创建或被修改(如 admin.edit_app)后, 在事务提交时丢弃旧缓存;
+    # 在写入时丢弃的话, 提交前的其他请求会把旧数据重新放入缓存
+    client_ids = object_session(target).info.setdefault('stale_app_credentials', set())
+    client_ids.add(target.client_id)
+    history = db.inspect(target).attrs.client_id.history
+    client_ids.update(history.deleted or ())
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    for client_id in session.info.pop('stale_app_credentials', ()):
+        app_credentials.invalidate(client_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_staged(session):
+    session.info.pop('stale_app_credentials', None)
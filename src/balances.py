@@ -0,0 +1,95 @@
+"""余额变更原语
+
+扣款和入账都是单条带条件的 UPDATE ... RETURNING, 余额检查和写入在数据库内原子完成,
+不再先在 Python 中读取余额再写回。记录状态同样用条件 UPDATE 占用, 重复确认只有一个能成功。
+每次变更同时向账本追加一条记录, 并将统计字段的变化量累加到当天的汇总(rollups)。
+遇到写锁竞争时整个事务回滚后重试。
+"""
+import os
+import random
+import time
+
+from sqlalchemy import update
+from sqlalchemy.exc import OperationalError
+
+from models.models import User
+import ledger
+import rollups
+
+# 写锁竞争时的最大尝试次数和初始退避时间(秒)
+RETRY_ATTEMPTS = int(os.getenv('BALANCE_RETRY_ATTEMPTS', 5))
+RETRY_DELAY = float(os.getenv('BALANCE_RETRY_DELAY', 0.02))
+
+# PostgreSQL 的序列化失败和死锁错误码
+CONTENTION_PGCODES = {'40001', '40P01'}
+
+
+def _apply(session, conditions, values):
+    # populate_existing 让会话中已加载的 User 对象同步为更新后的值
+    return session.execute(
+        update(User).where(*conditions).values(**values).returning(User)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    ).scalars().first()
+
+
+def debit(session, user_id, amount, reason, **totals):
+    """扣除余额并累加统计字段, 返回更新后的用户, 余额不足时返回 None
+
+    reason 为写入账本的 (类型, 关联记录类型, 关联记录id)。
+    """
+    values = {name: getattr(User, name) + value for name, value in totals.items()}
+    values['actual_score'] = User.actual_score - amount
+    user = _apply(session, [User.id == user_id, User.actual_score >= amount], values)
+    if user is not None:
+        ledger.append(session, user_id, reason, -amount, **totals)
+        rollups.record(session, user_id, **totals)
+    return user
+
+
+def credit(session, user_id, amount, reason, **totals):
+    """增加余额并累加统计字段, 返回更新后的用户, 用户不存在时返回 None"""
+    values = {name: getattr(User, name) + value for name, value in totals.items()}
+    values['actual_score'] = User.actual_score + amount
+    user = _apply(session, [User.id == user_id], values)
+    if user is not None:
+        ledger.append(session, user_id, reason, amount, **totals)
+        rollups.record(session, user_id, **totals)
+    return user
+
+
+def claim(session, model, record_id, status, **values):
+    """将待确认的记录改为 status, 记录已被处理时返回 False"""
+    result = session.execute(
+        update(model)
+        .where(model.id == record_id, model.status == 'pending')
+        .values(status=status, **values)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def is_contention(error):
+    """是否为可重试的写锁竞争错误"""
+    if not isinstance(error, OperationalError):
+        return False
+    if getattr(error.orig, 'pgcode', None) in CONTENTION_PGCODES:
+        return True
+    message = str(error.orig).lower()
+    return 'database is locked' in message or 'deadlock' in message
+
+
+def retry_delay(attempt):
+    """第 attempt 次重试前的等待时间, 指数退避加随机抖动"""
+    return RETRY_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def retrying(session, func, *args):
+    """执行 func(session, *args), 写锁竞争时回滚并重试"""
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return func(session, *args)
+        except OperationalError as e:
+            session.rollback()
+            if not is_contention(e) or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(retry_delay(attempt))
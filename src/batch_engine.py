@@ -0,0 +1,344 @@
+"""批量转账引擎
+
+一次性校验全部转账项, 用分块的 IN 查询解析收款人, 单次遍历计算手续费,
+再通过一次 executemany 批量写入 ScoreTransfer。确认时在一个事务内用 balances
+的条件 UPDATE 扣款、集合式 UPDATE 给所有收款人入账。语句数量与收款人数量无关。
+
+应用的批量消耗请求同样一次解析全部用户、批量写入 ScoreConsumption 和确认 token,
+每条消耗仍由对应用户单独确认。
+"""
+import os
+import secrets
+
+from datetime import datetime
+
+from sqlalchemy import select, insert, update, func
+
+from models.models import User, ScoreConsumption, ScoreTransfer, BatchTransfer
+import leaderboards
+import balances
+import ledger
+import rollups
+import tokens
+from services import ScoreError, generate_confirm_token, transfer_fee, consumption_fee
+
+# 单个批次的最大转账数
+BATCH_TRANSFER_MAX_SIZE = int(os.getenv('BATCH_TRANSFER_MAX_SIZE', 20000))
+# 单次批量消耗请求的最大条数
+CONSUME_BATCH_MAX_SIZE = int(os.getenv('CONSUME_BATCH_MAX_SIZE', 1000))
+# IN 查询每块的参数个数, 低于 SQLite 的绑定参数上限
+LOOKUP_CHUNK_SIZE = 900
+
+
+def _skip(report, index, username, reason):
+    report.append({'index': index, 'username': username, 'reason': reason})
+
+
+def validate_items(items, from_username):
+    """校验转账项格式, 返回 (有效项, 跳过报告)"""
+    valid = []
+    skipped = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            _skip(skipped, index, None, '转账项格式错误')
+            continue
+
+        username = item.get('username')
+        if not username or not isinstance(username, str):
+            _skip(skipped, index, username, '缺少用户名')
+            continue
+        if username == from_username:
+            _skip(skipped, index, username, '不能转账给自己')
+            continue
+
+        try:
+            amount = int(item.get('amount', 0))
+        except (TypeError, ValueError):
+            _skip(skipped, index, username, '无效的点数值')
+            continue
+        if amount <= 0:
+            _skip(skipped, index, username, '转账点数必须大于0')
+            continue
+
+        valid.append((index, username, amount, item.get('message', '')))
+    return valid, skipped
+
+
+def resolve_usernames(session, usernames):
+    """用分块的 IN 查询解析用户名, 返回 {username: user_id}"""
+    usernames = list(usernames)
+    resolved = {}
+    for start in range(0, len(usernames), LOOKUP_CHUNK_SIZE):
+        chunk = usernames[start:start + LOOKUP_CHUNK_SIZE]
+        resolved.update(session.execute(
+            select(User.username, User.id).where(User.username.in_(chunk))
+        ).all())
+    return resolved
+
+
+def resolve_balances(session, usernames):
+    """用分块的 IN 查询解析用户名, 返回 {username: (user_id, 当前点数)}"""
+    usernames = list(usernames)
+    resolved = {}
+    for start in range(0, len(usernames), LOOKUP_CHUNK_SIZE):
+        chunk = usernames[start:start + LOOKUP_CHUNK_SIZE]
+        for username, user_id, score in session.execute(
+            select(User.username, User.id, User.actual_score).where(User.username.in_(chunk))
+        ):
+            resolved[username] = (user_id, score)
+    return resolved
+
+
+def _consume_error(index, username, message, **extra):
+    return {'index': index, 'username': username, 'error': message, **extra}
+
+
+def create_batch_consumption(session, app_id, data):
+    """为多个用户创建待确认的消耗记录, 返回按请求顺序排列的结果
+
+    每项结果包含 consumption_id 和 confirm_token, 或者 error。
+    """
+    if not data or 'consumptions' not in data:
+        raise ScoreError('缺少必要参数')
+
+    items = data['consumptions']
+    if not items or not isinstance(items, list):
+        raise ScoreError('消耗列表格式错误')
+    if len(items) > CONSUME_BATCH_MAX_SIZE:
+        raise ScoreError(f'单次最多创建 {CONSUME_BATCH_MAX_SIZE} 条消耗请求')
+
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = _consume_error(index, None, '消耗项格式错误')
+            continue
+        username = item.get('username')
+        if not username or not isinstance(username, str) or 'amount' not in item:
+            results[index] = _consume_error(index, username, '缺少必要参数')
+            continue
+        try:
+            amount = int(item['amount'])
+        except (TypeError, ValueError):
+            results[index] = _consume_error(index, username, '无效的点数值')
+            continue
+        if amount <= 0:
+            results[index] = _consume_error(index, username, '消耗点数必须大于0')
+            continue
+        valid.append((index, username, amount, item.get('purpose') or '未说明用途'))
+
+    users = resolve_balances(session, {username for _, username, _, _ in valid})
+    rows = []
+    indexes = []
+    for index, username, amount, purpose in valid:
+        if username not in users:
+            results[index] = _consume_error(index, username, '用户不存在')
+            continue
+        user_id, score = users[username]
+        if score < amount:
+            results[index] = _consume_error(index, username, '用户点数不足', current_score=score)
+            continue
+
+        # 计算开发者实际收到的金额和手续费(3%)
+        fee_amount = consumption_fee(amount)
+        rows.append({
+            'user_id': user_id,
+            'app_id': app_id,
+            'amount': amount,
+            'developer_amount': amount - fee_amount,
+            'fee_amount': fee_amount,
+            'purpose': purpose,
+            'confirm_token': generate_confirm_token(),
+        })
+        indexes.append(index)
+
+    if rows:
+        # 按 token 对应新记录的 id, 不要求数据库按参数顺序返回, 保持批量写入
+        consumption_ids = dict(session.execute(
+            insert(ScoreConsumption).returning(ScoreConsumption.confirm_token, ScoreConsumption.id),
+            rows
+        ).all())
+        tokens.issue_many(session, 'consume', [
+            (row['confirm_token'], consumption_ids[row['confirm_token']], row['user_id'])
+            for row in rows
+        ])
+        session.commit()
+
+        for index, row in zip(indexes, rows):
+            results[index] = {
+                'index': index,
+                'username': items[index]['username'],
+                'consumption_id': consumption_ids[row['confirm_token']],
+                'confirm_token': row['confirm_token'],
+            }
+
+    return {
+        'count': len(rows),
+        'failed': len(items) - len(rows),
+        'results': results,
+    }
+
+
+def plan_batch(session, from_user, items):
+    """生成待写入的转账行和跳过报告"""
+    valid, skipped = validate_items(items, from_user.username)
+    user_ids = resolve_usernames(session, {username for _, username, _, _ in valid})
+
+    batch_id = secrets.token_hex(16)
+    confirm_token = generate_confirm_token()
+    rows = []
+    total_amount = 0
+    total_fee = 0
+    for index, username, amount, message in valid:
+        to_user_id = user_ids.get(username)
+        if to_user_id is None:
+            _skip(skipped, index, username, '用户不存在')
+            continue
+        if to_user_id == from_user.id:
+            _skip(skipped, index, username, '不能转账给自己')
+            continue
+
+        # 计算手续费
+        fee_amount = transfer_fee(amount)
+        rows.append({
+            'from_user_id': from_user.id,
+            'to_user_id': to_user_id,
+            'amount': amount,
+            'fee_amount': fee_amount,
+            'actual_amount': amount - fee_amount,
+            'type': 'batch',
+            'batch_id': batch_id,
+            'message': message,
+            'confirm_token': confirm_token,
+        })
+        total_amount += amount
+        total_fee += fee_amount
+
+    skipped.sort(key=lambda entry: entry['index'])
+    return {
+        'batch_id': batch_id,
+        'confirm_token': confirm_token,
+        'rows': rows,
+        'total_amount': total_amount,
+        'total_fee': total_fee,
+        'skipped': skipped,
+    }
+
+
+def create_batch_transfer(session, from_user, data):
+    """创建批量转账, 返回批次摘要和跳过报告"""
+    if not data or 'transfers' not in data:
+        raise ScoreError('缺少必要参数')
+
+    items = data['transfers']
+    if not items or not isinstance(items, list):
+        raise ScoreError('转账列表格式错误')
+    if len(items) > BATCH_TRANSFER_MAX_SIZE:
+        raise ScoreError(f'单次最多转账给 {BATCH_TRANSFER_MAX_SIZE} 位用户')
+
+    plan = plan_batch(session, from_user, items)
+    if not plan['rows']:
+        raise ScoreError('没有有效的转账记录', skipped=plan['skipped'])
+    if from_user.actual_score < plan['total_amount']:
+        raise ScoreError('点数不足', current_score=from_user.actual_score,
+                         total_amount=plan['total_amount'])
+
+    batch = BatchTransfer(
+        batch_id=plan['batch_id'],
+        from_user_id=from_user.id,
+        total_amount=plan['total_amount'],
+        total_fee=plan['total_fee'],
+        total_count=len(plan['rows']),
+        confirm_token=plan['confirm_token'],
+        message=data.get('message')
+    )
+    session.add(batch)
+    session.flush()
+    tokens.issue(session, plan['confirm_token'], 'batch', batch.id, from_user.id)
+    session.execute(insert(ScoreTransfer), plan['rows'])
+    session.commit()
+
+    return {
+        'batch_id': plan['batch_id'],
+        'confirm_token': plan['confirm_token'],
+        'count': len(plan['rows']),
+        'total_amount': plan['total_amount'],
+        'total_fee': plan['total_fee'],
+        'skipped': plan['skipped'],
+    }
+
+
+def confirm_batch(session, user, batch, action):
+    """确认或拒绝整个批量转账"""
+    now = datetime.utcnow()
+    status = {'confirm': 'confirmed', 'reject': 'rejected'}.get(action)
+    if status is None:
+        raise ScoreError('无效的操作')
+
+    # 先以条件更新占用批次, 并发的重复确认只有一个能成功
+    if not balances.claim(session, BatchTransfer, batch.id, status, confirmed_at=now):
+        session.rollback()
+        raise ScoreError('无效或已使用的确认链接', 404)
+    tokens.revoke(session, batch.confirm_token)
+
+    pending = (ScoreTransfer.batch_id == batch.batch_id) & (ScoreTransfer.status == 'pending')
+
+    if status == 'rejected':
+        session.execute(
+            update(ScoreTransfer).where(pending).values(status='rejected')
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return {
+            'success': False,
+            'error': '用户拒绝了操作'
+        }
+
+    # 扣款: 余额不足时不更新任何行
+    from_user = balances.debit(session, user.id, batch.total_amount,
+                               ('transfer_out', 'batch', batch.id),
+                               total_transferred=batch.total_amount,
+                               total_fee_paid=batch.total_fee)
+    if from_user is None:
+        session.rollback()
+        raise ScoreError('点数不足', current_score=user.actual_score)
+
+    # 入账: 一条语句为所有收款人累加实际到账金额
+    received = select(func.sum(ScoreTransfer.actual_amount))\
+        .where(pending, ScoreTransfer.to_user_id == User.id)\
+        .scalar_subquery()
+    session.execute(
+        update(User)
+        .where(User.id.in_(select(ScoreTransfer.to_user_id).where(pending)))
+        .values(
+            actual_score=User.actual_score + received,
+            total_received=User.total_received + received
+        )
+        .execution_options(synchronize_session=False)
+    )
+    ledger.append_transfer_credits(session, pending)
+    rollups.record_transfer_credits(session, pending, now)
+
+    confirmed = session.execute(
+        update(ScoreTransfer).where(pending).values(status='confirmed', confirmed_at=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    session.execute(
+        update(BatchTransfer).where(BatchTransfer.id == batch.id)
+        .values(confirmed_count=BatchTransfer.confirmed_count + confirmed)
+        .execution_options(synchronize_session=False)
+    )
+
+    # 收款人数量可能很大, 富豪榜改由后台任务重建
+    leaderboards.record_user(from_user, session)
+    leaderboards.mark_dirty('richest', session)
+    session.commit()
+
+    return {
+        'success': True,
+        'from_username': from_user.username,
+        'batch_id': batch.batch_id,
+        'count': confirmed,
+        'amount': batch.total_amount,
+        'remaining_score': from_user.actual_score
+    }
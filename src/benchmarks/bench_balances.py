@@ -0,0 +1,190 @@
+"""并发确认转账的压力测试, 检查余额不变量
+
+每笔转账由两个线程同时提交确认, 模拟重复点击。测试结束后检查:
+  - 余额总和 + 手续费总和保持不变
+  - 没有负余额
+  - 每个用户的余额等于初始余额 - 已确认转出 + 已确认转入
+  - 每笔转账最多被确认一次
+  - 账本快照加账本记录与用户余额一致
+
+在 src 目录下运行:
+    python -m benchmarks.bench_balances --transfers 2000 --concurrency 1 4 16
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import use_temp_database, summarize, print_table
+
+use_temp_database()
+
+from sqlalchemy import func
+
+from app import app
+from models.models import db, User, ScoreTransfer
+from services import ScoreError, generate_confirm_token, transfer_fee
+import balances
+import ledger
+import services
+import tokens
+
+INITIAL_SCORE = 10000
+
+
+def seed(users):
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([
+            User(username=f'bench{i}', forum_id=i, trust_level=1, actual_score=INITIAL_SCORE,
+                 total_transferred=0, total_received=0, total_fee_paid=0)
+            for i in range(users)
+        ])
+        db.session.commit()
+        return [user.id for user in User.query.all()]
+
+
+def create_transfers(user_ids, count):
+    """生成待确认的转账, 部分金额超过 1000 以覆盖手续费"""
+    rows = []
+    for _ in range(count):
+        from_id, to_id = random.sample(user_ids, 2)
+        amount = random.choice([random.randint(1, 1000), random.randint(1001, 3000)])
+        fee = transfer_fee(amount)
+        rows.append({
+            'from_user_id': from_id,
+            'to_user_id': to_id,
+            'amount': amount,
+            'fee_amount': fee,
+            'actual_amount': amount - fee,
+            'confirm_token': generate_confirm_token(),
+        })
+    with app.app_context():
+        transfers = [ScoreTransfer(**row) for row in rows]
+        db.session.add_all(transfers)
+        db.session.flush()
+        for transfer in transfers:
+            tokens.issue(db.session, transfer.confirm_token, 'transfer', transfer.id,
+                         transfer.from_user_id)
+        db.session.commit()
+    return [(row['from_user_id'], row['confirm_token']) for row in rows]
+
+
+def confirm(from_id, token):
+    """返回 (耗时, 结果), 结果为 confirmed / insufficient / used / error"""
+    start = time.perf_counter()
+    with app.app_context():
+        try:
+            user = db.session.get(User, from_id)
+            balances.retrying(db.session, services.confirm_transfer, user, token, 'confirm')
+            outcome = 'confirmed'
+        except ScoreError as e:
+            db.session.rollback()
+            outcome = 'used' if e.status == 404 else 'insufficient'
+        except Exception as e:
+            db.session.rollback()
+            print(f"确认失败: {e}", file=sys.stderr)
+            outcome = 'error'
+    return time.perf_counter() - start, outcome
+
+
+def run_round(user_ids, transfers, concurrency):
+    # 每笔转账提交两次, 打乱顺序后并发执行
+    tasks = transfers * 2
+    random.shuffle(tasks)
+    outcomes = {'confirmed': 0, 'insufficient': 0, 'used': 0, 'error': 0}
+    latencies = []
+    lock = threading.Lock()
+
+    def work(task):
+        elapsed, outcome = confirm(*task)
+        with lock:
+            latencies.append(elapsed)
+            outcomes[outcome] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(work, tasks))
+    result = summarize(f'confirm x{concurrency}', latencies, time.perf_counter() - start,
+                       outcomes['error'])
+    result.update(outcomes)
+    return result
+
+
+def check_invariants(users, confirmed_total):
+    """返回不变量检查失败的描述列表"""
+    failures = []
+    with app.app_context():
+        total_score, total_fee = db.session.query(
+            func.sum(User.actual_score), func.sum(User.total_fee_paid)
+        ).one()
+        if total_score + total_fee != users * INITIAL_SCORE:
+            failures.append(f"点数不守恒: 余额 {total_score} + 手续费 {total_fee} "
+                            f"!= {users * INITIAL_SCORE}")
+
+        negative = User.query.filter(User.actual_score < 0).count()
+        if negative:
+            failures.append(f"{negative} 个用户余额为负")
+
+        confirmed = ScoreTransfer.status == 'confirmed'
+        sent = dict(db.session.query(ScoreTransfer.from_user_id, func.sum(ScoreTransfer.amount))
+                    .filter(confirmed).group_by(ScoreTransfer.from_user_id).all())
+        received = dict(db.session.query(ScoreTransfer.to_user_id,
+                                         func.sum(ScoreTransfer.actual_amount))
+                        .filter(confirmed).group_by(ScoreTransfer.to_user_id).all())
+        for user in User.query.all():
+            expected = INITIAL_SCORE - sent.get(user.id, 0) + received.get(user.id, 0)
+            if user.actual_score != expected:
+                failures.append(f"{user.username} 余额 {user.actual_score} != 账目 {expected}")
+            rebuilt = ledger.snapshot(db.session, user.id)
+            if rebuilt['actual_score'] != user.actual_score:
+                failures.append(f"{user.username} 余额 {user.actual_score} != 账本 {rebuilt['actual_score']}")
+
+        rows = ScoreTransfer.query.filter(confirmed).count()
+        if rows != confirmed_total:
+            failures.append(f"确认成功 {confirmed_total} 次, 但有 {rows} 笔转账为已确认")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--transfers', type=int, default=2000, help='每轮的转账笔数')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--json', help='将结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    user_ids = seed(args.users)
+    results = []
+    confirmed_total = 0
+    failures = []
+    for concurrency in args.concurrency:
+        transfers = create_transfers(user_ids, args.transfers)
+        result = run_round(user_ids, transfers, concurrency)
+        confirmed_total += result['confirmed']
+        results.append(result)
+        failures = check_invariants(args.users, confirmed_total)
+        if failures:
+            break
+
+    print_table(results)
+    for r in results:
+        print(f"{r['name']:<32}confirmed={r['confirmed']} insufficient={r['insufficient']} "
+              f"used={r['used']} errors={r['error']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if failures:
+        print('\n不变量检查失败:')
+        for failure in failures[:20]:
+            print(f"  {failure}")
+        sys.exit(1)
+    print('\n不变量检查通过')
+
+
+if __name__ == '__main__':
+    main()
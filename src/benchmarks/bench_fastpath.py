@@ -0,0 +1,74 @@
+"""对比 WsgiToAsgi 路径与原生异步路径处理 /api/score/consume 的性能
+
+在 src 目录下运行:
+    python -m benchmarks.bench_fastpath --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import os
+
+from benchmarks.common import use_temp_database, drive, print_table
+
+use_temp_database()
+# 限流会让并发请求得到 429, 测试中关闭
+os.environ['RATE_LIMIT_ENABLED'] = 'false'
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app, asgi_app
+from models.models import db, User, App
+
+
+def seed(users):
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([
+            User(username=f'bench{i}', forum_id=i, trust_level=1, actual_score=10 ** 9)
+            for i in range(users)
+        ])
+        db.session.commit()
+        db.session.add(App(name='bench', client_id='bench-id', client_secret='bench-secret',
+                           redirect_uri='http://localhost', user_id=1))
+        db.session.commit()
+
+
+async def bench(name, asgi, total, concurrency, users):
+    transport = httpx.ASGITransport(app=asgi)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        async def send(i):
+            resp = await client.post(
+                '/api/score/consume',
+                headers={'Authorization': 'bench-id:bench-secret'},
+                json={'username': f'bench{i % users}', 'amount': 1, 'purpose': 'bench'}
+            )
+            return resp.status_code
+        # 预热
+        await send(0)
+        return await drive(name, send, total, concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--json', help='将结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    seed(args.users)
+    results = [
+        asyncio.run(bench('wsgi-to-asgi /api/score/consume', WsgiToAsgi(app),
+                          args.requests, args.concurrency, args.users)),
+        asyncio.run(bench('fastpath /api/score/consume', asgi_app,
+                          args.requests, args.concurrency, args.users)),
+    ]
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
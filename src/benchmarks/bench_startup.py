@@ -0,0 +1,127 @@
+"""工作进程冷启动耗时
+
+每轮启动一个新的 Python 进程, 分别计时: 导入 app 模块、create_app()、create_asgi_app()
+和第一个请求(/healthz), 并检查导入和创建应用期间是否访问了数据库(临时 SQLite 文件
+是否被创建)。--top 列出导入最慢的模块(python -X importtime)。
+
+在 src 目录下运行:
+    python -m benchmarks.bench_startup --runs 10
+    python -m benchmarks.bench_startup --top 15 --json startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks.common import SRC_DIR, use_temp_database
+
+PHASES = ('import', 'create_app', 'create_asgi_app', 'first_request')
+
+# 在子进程中执行, 输出各阶段耗时(毫秒)和数据库文件是否存在
+CHILD = r'''
+import json, os, sys, time
+path = sys.argv[1]
+timings = {}
+start = time.perf_counter()
+import app
+timings['import'] = time.perf_counter() - start
+touched = os.path.exists(path)
+
+start = time.perf_counter()
+flask_app = app.create_app()
+timings['create_app'] = time.perf_counter() - start
+
+start = time.perf_counter()
+app.create_asgi_app(flask_app)
+timings['create_asgi_app'] = time.perf_counter() - start
+touched = touched or os.path.exists(path)
+
+start = time.perf_counter()
+status = flask_app.test_client().get('/healthz').status_code
+timings['first_request'] = time.perf_counter() - start
+
+print(json.dumps({'ms': {k: v * 1000 for k, v in timings.items()},
+                  'status': status, 'db_touched': touched}))
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='启动次数')
+    parser.add_argument('--top', type=int, default=0, help='列出导入最慢的 N 个模块')
+    parser.add_argument('--json', help='将结果写入 JSON 文件')
+    return parser.parse_args()
+
+
+def run_once():
+    url = use_temp_database()
+    path = url[len('sqlite:///'):]
+    try:
+        output = subprocess.run([sys.executable, '-c', CHILD, path], cwd=SRC_DIR,
+                                env=os.environ, capture_output=True, text=True, check=True).stdout
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(top):
+    """用 -X importtime 统计 import app 中各模块的累计耗时(毫秒)"""
+    use_temp_database()
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=SRC_DIR, env=os.environ, capture_output=True, text=True,
+                            check=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line.split(':', 1)[1].split('|'))
+        modules.append((int(cumulative_us) / 1000, int(self_us) / 1000, name))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    args = parse_args()
+    runs = [run_once() for _ in range(args.runs)]
+
+    results = []
+    print(f"{'phase':<20}{'median_ms':>12}{'min_ms':>10}{'max_ms':>10}")
+    print('-' * 52)
+    for phase in PHASES:
+        values = [run['ms'][phase] for run in runs]
+        result = {
+            'name': phase,
+            'median_ms': round(statistics.median(values), 2),
+            'min_ms': round(min(values), 2),
+            'max_ms': round(max(values), 2),
+        }
+        results.append(result)
+        print(f"{phase:<20}{result['median_ms']:>12}{result['min_ms']:>10}{result['max_ms']:>10}")
+
+    touched = any(run['db_touched'] for run in runs)
+    failed = [run['status'] for run in runs if run['status'] != 200]
+    print(f"导入和创建应用时访问数据库: {'是' if touched else '否'}")
+    if failed:
+        print(f"/healthz 返回 HTTP {failed[0]}")
+
+    imports = slowest_imports(args.top) if args.top else []
+    if imports:
+        print(f"\n{'module':<48}{'cumulative_ms':>15}{'self_ms':>10}")
+        for cumulative, self_ms, name in imports:
+            print(f"{name:<48}{cumulative:>15.1f}{self_ms:>10.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'runs': args.runs, 'db_touched': touched, 'results': results,
+                       'imports': [{'name': name, 'cumulative_ms': cumulative, 'self_ms': self_ms}
+                                   for cumulative, self_ms, name in imports]},
+                      f, indent=2, ensure_ascii=False)
+    if touched or failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
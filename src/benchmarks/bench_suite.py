@@ -0,0 +1,315 @@
+"""核心流程的负载测试套件
+
+在临时 SQLite 数据库(或 --database-url 指定的空数据库)中按 --users 生成用户、应用和
+历史消耗/转账记录, 再通过 ASGI 应用并发请求真实接口: 消耗、确认、状态查询、转账、
+批量转账、个人面板、历史记录、排行榜、名次查询、时间窗口榜单和管理后台列表。每个场景输出吞吐量和 p50/p95/p99
+延迟, --json 保存结果, 用 benchmarks.compare 对比两次运行。
+
+生成数据使用固定的随机种子, 同样的参数得到同样的数据。限流在测试中关闭。
+
+在 src 目录下运行:
+    python -m benchmarks.bench_suite --users 10000 --json base.json
+    python -m benchmarks.bench_suite --users 1000000 --scenarios consume confirm --json big.json
+    python -m benchmarks.compare base.json new.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.common import SRC_DIR, use_temp_database, drive, print_table
+
+# 每次写入的行数
+SEED_CHUNK_SIZE = 10000
+SCENARIOS = ('consume', 'status', 'confirm', 'transfer', 'batch_transfer', 'dashboard',
+             'history', 'leaderboard', 'rank', 'window', 'admin_users', 'admin_consumptions',
+             'admin_transfers')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000, help='生成的用户数')
+    parser.add_argument('--apps', type=int, default=20, help='生成的应用数')
+    parser.add_argument('--history', type=int, default=5,
+                        help='平均每个用户的历史消耗和转账记录数')
+    parser.add_argument('--requests', type=int, default=2000, help='每个场景的请求数')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=100, help='批量转账的收款人数')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=42, help='生成数据的随机种子')
+    parser.add_argument('--database-url', help='使用指定的空数据库, 默认为临时 SQLite 文件')
+    parser.add_argument('--json', help='将结果写入 JSON 文件')
+    return parser.parse_args()
+
+
+def seed(app, db, args):
+    """批量写入测试数据, 返回耗时(秒)"""
+    from sqlalchemy import insert
+    from models.models import User, App, ScoreConsumption, ScoreTransfer
+    import leaderboards
+    import rollups
+
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    start = time.perf_counter()
+
+    def write(model, rows):
+        for index in range(0, len(rows), SEED_CHUNK_SIZE):
+            db.session.execute(insert(model), rows[index:index + SEED_CHUNK_SIZE])
+        db.session.commit()
+
+    with app.app_context():
+        db.create_all()
+        for index in range(0, args.users, SEED_CHUNK_SIZE):
+            write(User, [{
+                'username': f'bench{i}',
+                'forum_id': i,
+                'trust_level': rng.randint(0, 4),
+                'original_score': 0,
+                'actual_score': rng.randint(10 ** 6, 10 ** 9),
+                'total_transferred': 0,
+                'total_received': 0,
+                'total_consumed': 0,
+                'total_fee_paid': 0,
+                # 管理后台场景以第一个用户登录
+                'is_admin': i == 0,
+            } for i in range(index, min(index + SEED_CHUNK_SIZE, args.users))])
+
+        write(App, [{
+            'name': f'bench-app-{i}',
+            'client_id': f'bench-id-{i}',
+            'client_secret': f'bench-secret-{i}',
+            'redirect_uri': 'http://localhost',
+            'user_id': i % args.users + 1,
+        } for i in range(args.apps)])
+
+        # 历史记录: 一半消耗一半转账, 大部分已确认, 时间分布在最近 90 天
+        total = args.users * args.history
+        for index in range(0, total, SEED_CHUNK_SIZE):
+            consumptions = []
+            transfers = []
+            for _ in range(index, min(index + SEED_CHUNK_SIZE, total)):
+                created_at = now - timedelta(seconds=rng.randint(0, 90 * 86400))
+                status = rng.choices(('confirmed', 'rejected', 'pending'), (8, 1, 1))[0]
+                confirmed_at = created_at if status == 'confirmed' else None
+                amount = rng.randint(1, 2000)
+                if rng.random() < 0.5:
+                    fee = int(amount * 0.03)
+                    consumptions.append({
+                        'user_id': rng.randint(1, args.users),
+                        'app_id': rng.randint(1, args.apps),
+                        'amount': amount,
+                        'developer_amount': amount - fee,
+                        'fee_amount': fee,
+                        'purpose': 'bench',
+                        'status': status,
+                        'confirmed_at': confirmed_at,
+                        'created_at': created_at,
+                    })
+                else:
+                    fee = int(amount * 0.07) if amount > 1000 else 0
+                    from_id, to_id = rng.sample(range(1, args.users + 1), 2)
+                    transfers.append({
+                        'from_user_id': from_id,
+                        'to_user_id': to_id,
+                        'amount': amount,
+                        'fee_amount': fee,
+                        'actual_amount': amount - fee,
+                        'status': status,
+                        'confirmed_at': confirmed_at,
+                        'created_at': created_at,
+                    })
+            write(ScoreConsumption, consumptions)
+            write(ScoreTransfer, transfers)
+
+        leaderboards.rebuild_all()
+        # 种子数据中没有并发的确认操作, 今天的汇总也一并重建
+        rollups.backfill(db.session, until=rollups.day_of(now) + timedelta(days=1))
+    return time.perf_counter() - start
+
+
+class Context:
+    """场景之间共享的状态: 登录 cookie 和待确认的消耗"""
+
+    def __init__(self, app, args):
+        self.args = args
+        self.rng = random.Random(args.seed + 1)
+        self.serializer = app.session_interface.get_signing_serializer(app)
+        self.cookie_name = app.config['SESSION_COOKIE_NAME']
+        self.app_auth = {'Authorization': 'bench-id-0:bench-secret-0'}
+        self.pending = []  # (user_id, consumption_id, confirm_token)
+        self._cookies = {}
+
+    def user(self):
+        return self.rng.randint(1, self.args.users)
+
+    def login(self, user_id):
+        """构造 Flask-Login 会话 cookie, 返回请求头"""
+        cookie = self._cookies.get(user_id)
+        if cookie is None:
+            cookie = self._cookies[user_id] = self.serializer.dumps(
+                {'_user_id': str(user_id), '_fresh': True}
+            )
+        return {'Cookie': f'{self.cookie_name}={cookie}'}
+
+
+async def scenario_consume(client, ctx, i):
+    user_id = ctx.user()
+    resp = await client.post('/api/score/consume', headers=ctx.app_auth,
+                             json={'username': f'bench{user_id - 1}', 'amount': 1,
+                                   'purpose': 'bench'})
+    if resp.status_code == 200:
+        data = resp.json()
+        ctx.pending.append((user_id, data['consumption_id'],
+                            data['confirm_url'].rsplit('/', 1)[1]))
+    return resp.status_code
+
+
+async def scenario_confirm(client, ctx, i):
+    user_id, _, token = ctx.pending.pop()
+    resp = await client.post(f'/confirm/consume/{token}', headers=ctx.login(user_id),
+                             data={'action': 'confirm'})
+    return resp.status_code
+
+
+async def scenario_status(client, ctx, i):
+    _, consumption_id, _ = ctx.pending[i % len(ctx.pending)]
+    resp = await client.get(f'/api/score/consume/{consumption_id}', headers=ctx.app_auth)
+    return resp.status_code
+
+
+async def scenario_transfer(client, ctx, i):
+    from_id = ctx.user()
+    to_id = from_id % ctx.args.users + 1
+    resp = await client.post('/api/score/transfer', headers=ctx.login(from_id),
+                             json={'username': f'bench{to_id - 1}', 'amount': 1})
+    return resp.status_code
+
+
+async def scenario_batch_transfer(client, ctx, i):
+    from_id = ctx.user()
+    recipients = ctx.rng.sample(range(ctx.args.users), min(ctx.args.batch_size, ctx.args.users - 1))
+    resp = await client.post('/api/score/batch-transfer', headers=ctx.login(from_id), json={
+        'transfers': [{'username': f'bench{index}', 'amount': 1}
+                      for index in recipients if index != from_id - 1]
+    })
+    return resp.status_code
+
+
+def page_scenario(path, admin=False):
+    async def scenario(client, ctx, i):
+        user_id = 1 if admin else ctx.user()
+        resp = await client.get(path, headers=ctx.login(user_id))
+        return resp.status_code
+    return scenario
+
+
+SCENARIO_FUNCS = {
+    'consume': scenario_consume,
+    'status': scenario_status,
+    'confirm': scenario_confirm,
+    'transfer': scenario_transfer,
+    'batch_transfer': scenario_batch_transfer,
+    'dashboard': page_scenario('/dashboard'),
+    'history': page_scenario('/api/history'),
+    'leaderboard': page_scenario('/leaderboard'),
+    'rank': page_scenario('/api/leaderboard/richest/rank?radius=5'),
+    'window': page_scenario('/api/leaderboard/generous/window?period=30d'),
+    'admin_users': page_scenario('/admin/users?page=2', admin=True),
+    'admin_consumptions': page_scenario('/admin/consumptions?status=confirmed', admin=True),
+    'admin_transfers': page_scenario('/admin/transfers?sort=amount&order=desc', admin=True),
+}
+
+
+def request_count(name, ctx):
+    total = ctx.args.requests
+    if name == 'batch_transfer':
+        # 每个请求包含 batch_size 笔转账
+        total = max(1, total // 20)
+    elif name == 'confirm':
+        total = min(total, len(ctx.pending) - 1)
+    return total
+
+
+async def run_scenarios(asgi, ctx, names):
+    import httpx
+
+    results = []
+    transport = httpx.ASGITransport(app=asgi)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for name in names:
+            send = SCENARIO_FUNCS[name]
+            if name in ('confirm', 'status') and len(ctx.pending) < 2:
+                results.append({'name': name, 'skipped': '需要先运行 consume 场景'})
+                continue
+            # 预热, 同时确认接口可用; 重定向说明未登录或没有权限
+            status = await send(client, ctx, 0)
+            if status >= 300:
+                results.append({'name': name, 'skipped': f'预热请求返回 HTTP {status}'})
+                continue
+            total = request_count(name, ctx)
+            result = await drive(name, lambda i: send(client, ctx, i), total,
+                                 ctx.args.concurrency)
+            results.append(result)
+            print(f"{name}: {result['rps']} rps, p95 {result['p95_ms']} ms", file=sys.stderr)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    database_url = use_temp_database(args.database_url)
+    # 限流会让并发请求得到 429, 测试中关闭; 其余配置与生产一致
+    os.environ['RATE_LIMIT_ENABLED'] = 'false'
+
+    import sqlalchemy
+    from app import app, asgi_app
+    from models.models import db
+
+    seed_seconds = seed(app, db, args)
+    print(f"生成数据耗时 {seed_seconds:.1f} 秒", file=sys.stderr)
+
+    ctx = Context(app, args)
+    names = [name for name in SCENARIOS if name in args.scenarios]
+    results = asyncio.run(run_scenarios(asgi_app, ctx, names))
+
+    measured = [result for result in results if 'skipped' not in result]
+    print_table(measured)
+    for result in results:
+        if 'skipped' in result:
+            print(f"{result['name']:<32}跳过: {result['skipped']}")
+
+    if args.json:
+        report = {
+            'meta': {
+                'created_at': datetime.utcnow().isoformat(),
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'sqlalchemy': sqlalchemy.__version__,
+                'database': sqlalchemy.engine.make_url(database_url).get_backend_name(),
+                'seed_seconds': round(seed_seconds, 3),
+                'args': {key: value for key, value in vars(args).items()
+                         if key not in ('json', 'database_url')},
+            },
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""基准测试共用工具"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# 基准测试以 src 为根目录导入应用模块
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+def use_temp_database(url=None):
+    """在导入 app 之前调用, 将数据库指向临时文件"""
+    if url is None:
+        fd, path = tempfile.mkstemp(prefix='scores-bench-', suffix='.db')
+        os.close(fd)
+        os.remove(path)
+        url = f"sqlite:///{path}"
+    os.environ['DATABASE_URL'] = url
+    return url
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(name, latencies, elapsed, errors=0):
+    """汇总一组请求的吞吐量和延迟(毫秒)"""
+    count = len(latencies)
+    return {
+        'name': name,
+        'requests': count,
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'rps': round(count / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def drive(name, send, total, concurrency):
+    """并发执行 total 次 send(i), send 返回 HTTP 状态码"""
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            status = await send(i)
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(name, latencies, time.perf_counter() - start, errors)
+
+
+def print_table(results):
+    header = f"{'name':<32}{'requests':>10}{'errors':>8}{'rps':>10}{'p50_ms':>10}{'p95_ms':>10}{'p99_ms':>10}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['name']:<32}{r['requests']:>10}{r['errors']:>8}{r['rps']:>10}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
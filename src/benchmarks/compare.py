@@ -0,0 +1,83 @@
+"""对比两次 bench_suite 的结果, 发现性能回退
+
+吞吐量下降或 p95 延迟上升超过 --threshold(默认 15%)、或者出现新的错误时记为回退,
+存在回退时以状态码 1 退出, 可以直接用在 CI 中。
+
+在 src 目录下运行:
+    python -m benchmarks.compare base.json new.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    results = report['results'] if isinstance(report, dict) else report
+    return report.get('meta', {}) if isinstance(report, dict) else {}, {
+        result['name']: result for result in results if 'skipped' not in result
+    }
+
+
+def change(base, new):
+    if not base:
+        return 0.0
+    return (new - base) / base
+
+
+def compare(base, new, threshold):
+    """返回 (对比行, 回退描述列表)"""
+    rows = []
+    regressions = []
+    for name, before in base.items():
+        after = new.get(name)
+        if after is None:
+            continue
+        rps = change(before['rps'], after['rps'])
+        p95 = change(before['p95_ms'], after['p95_ms'])
+        rows.append((name, before['rps'], after['rps'], rps, before['p95_ms'], after['p95_ms'], p95))
+        if rps < -threshold:
+            regressions.append(f"{name}: 吞吐量 {before['rps']} -> {after['rps']} ({rps:+.1%})")
+        if p95 > threshold:
+            regressions.append(f"{name}: p95 {before['p95_ms']} -> {after['p95_ms']} ms ({p95:+.1%})")
+        if after['errors'] > before['errors']:
+            regressions.append(f"{name}: 错误数 {before['errors']} -> {after['errors']}")
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base', help='基准结果 JSON')
+    parser.add_argument('new', help='新结果 JSON')
+    parser.add_argument('--threshold', type=float, default=0.15, help='允许的相对变化')
+    args = parser.parse_args()
+
+    base_meta, base = load(args.base)
+    new_meta, new = load(args.new)
+    if base_meta.get('args') != new_meta.get('args'):
+        print('注意: 两次运行的参数不同, 结果可能不可比', file=sys.stderr)
+
+    rows, regressions = compare(base, new, args.threshold)
+    header = f"{'name':<24}{'rps':>10}{'-> rps':>10}{'change':>9}{'p95_ms':>10}{'-> p95':>10}{'change':>9}"
+    print(f"{base_meta.get('revision') or args.base} -> {new_meta.get('revision') or args.new}")
+    print(header)
+    print('-' * len(header))
+    for name, rps_before, rps_after, rps, p95_before, p95_after, p95 in rows:
+        print(f"{name:<24}{rps_before:>10}{rps_after:>10}{rps:>+9.1%}"
+              f"{p95_before:>10}{p95_after:>10}{p95:>+9.1%}")
+    missing = sorted(set(base) ^ set(new))
+    if missing:
+        print(f"\n只在一次运行中出现的场景: {', '.join(missing)}")
+
+    if regressions:
+        print('\n性能回退:')
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print('\n没有超过阈值的回退')
+
+
+if __name__ == '__main__':
+    main()
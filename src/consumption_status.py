@@ -0,0 +1,120 @@
+"""消耗请求的状态查询和等待
+
+应用通过 GET /api/score/consume/<id> 查询消耗请求的结果, 可以用 wait 参数长轮询,
+或者以 Accept: text/event-stream 订阅状态变化。同一进程内确认消耗时会立即唤醒等待者;
+在其他工作进程确认的请求, 等待者每隔 STATUS_POLL_INTERVAL 秒重新查询一次。
+"""
+import asyncio
+import json
+import os
+import threading
+from collections import defaultdict
+
+from models.models import ScoreConsumption, ScoreConsumptionArchive
+from services import ScoreError
+
+# 长轮询的最长等待时间(秒)
+STATUS_MAX_WAIT = int(os.getenv('STATUS_MAX_WAIT', 30))
+# 等待期间重新查询数据库的间隔(秒)
+STATUS_POLL_INTERVAL = float(os.getenv('STATUS_POLL_INTERVAL', 2))
+# 事件流的最长持续时间(秒)
+STATUS_STREAM_TIMEOUT = int(os.getenv('STATUS_STREAM_TIMEOUT', 300))
+
+
+def serialize(record):
+    return {
+        'consumption_id': record.id,
+        'status': record.status,
+        'user_id': record.user_id,
+        'amount': record.amount,
+        'developer_amount': record.developer_amount,
+        'fee_amount': record.fee_amount,
+        'purpose': record.purpose,
+        'created_at': record.created_at.isoformat() if record.created_at else None,
+        'confirmed_at': record.confirmed_at.isoformat() if record.confirmed_at else None,
+    }
+
+
+def get_status(session, app_id, consumption_id):
+    """查询应用的消耗请求, 已归档的过期请求同样返回"""
+    record = session.get(ScoreConsumption, consumption_id)
+    if record is None:
+        record = session.get(ScoreConsumptionArchive, consumption_id)
+    if record is None or record.app_id != app_id:
+        raise ScoreError('消耗请求不存在', 404)
+    return serialize(record)
+
+
+def is_settled(status):
+    return status['status'] != 'pending'
+
+
+def parse_wait(value):
+    """wait 参数, 限制在 0 到 STATUS_MAX_WAIT 秒之间"""
+    try:
+        return min(max(float(value or 0), 0), STATUS_MAX_WAIT)
+    except ValueError:
+        raise ScoreError('无效的等待时间')
+
+
+def sse_event(status):
+    return f"event: status\ndata: {json.dumps(status, ensure_ascii=False)}\n\n"
+
+
+class StatusWaiters:
+    """按消耗 id 登记的等待者, 状态变化时在确认所在的进程内唤醒"""
+
+    def __init__(self):
+        self._callbacks = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def _subscribe(self, consumption_id, callback):
+        with self._lock:
+            self._callbacks[consumption_id].add(callback)
+
+    def _unsubscribe(self, consumption_id, callback):
+        with self._lock:
+            callbacks = self._callbacks.get(consumption_id)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._callbacks[consumption_id]
+
+    def notify(self, consumption_id):
+        with self._lock:
+            callbacks = list(self._callbacks.get(consumption_id, ()))
+        for callback in callbacks:
+            callback()
+
+    def wait(self, consumption_id, timeout):
+        """阻塞等待通知, 被唤醒时返回 True"""
+        event = threading.Event()
+        self._subscribe(consumption_id, event.set)
+        try:
+            return event.wait(timeout)
+        finally:
+            self._unsubscribe(consumption_id, event.set)
+
+    async def wait_async(self, consumption_id, timeout):
+        """在事件循环上等待通知, 被唤醒时返回 True"""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(event.set)
+
+        self._subscribe(consumption_id, wake)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._unsubscribe(consumption_id, wake)
+
+    def size(self):
+        with self._lock:
+            return sum(len(callbacks) for callbacks in self._callbacks.values())
+
+
+waiters = StatusWaiters()
@@ -0,0 +1,428 @@
+"""热点接口的原生异步实现
+
+机器对机器调用的接口(消耗、批量消耗、状态查询、转账、批量转账和确认)直接运行在事件循环上,
+通过异步 SQLAlchemy 引擎访问数据库, 不再经过 WsgiToAsgi 的线程池。
+业务逻辑与 Flask 视图共用 services 模块, 其余请求仍交给 Flask 处理。
+"""
+import asyncio
+import os
+from urllib.parse import urlencode
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from starlette.applications import Starlette
+from starlette.responses import Response, JSONResponse, RedirectResponse, StreamingResponse
+from starlette.routing import Route, Mount
+
+from models.models import db, User
+from app_auth import app_credentials
+import services
+import batch_engine
+import balances
+import idempotency
+import jwt_auth
+import ratelimit
+import consumption_status
+import metrics
+from services import ScoreError
+
+# 同步驱动 -> 异步驱动
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+
+def async_database_url(flask_app):
+    """根据 Flask 应用的数据库配置推导异步引擎的连接地址"""
+    if os.getenv('ASYNC_DATABASE_URL'):
+        return make_url(os.getenv('ASYNC_DATABASE_URL'))
+    with flask_app.app_context():
+        # 使用 Flask-SQLAlchemy 解析后的地址, 相对路径的 SQLite 文件位于 instance 目录
+        url = db.engine.url
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"不支持的异步数据库: {backend}")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+class FastPath:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.engine = None
+        self.sessions = None
+
+    def startup(self):
+        url = async_database_url(self.flask_app)
+        options = {}
+        if url.get_backend_name() == 'sqlite':
+            # SQLite 同一时间只允许一个写者, 在进程内排队比在文件锁上轮询等待更快
+            options = {'pool_size': int(os.getenv('FASTPATH_POOL_SIZE', 1)), 'max_overflow': 0}
+        elif os.getenv('DB_POOL_SIZE'):
+            options = {
+                'pool_size': int(os.getenv('DB_POOL_SIZE')),
+                'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 0)),
+                'pool_pre_ping': True
+            }
+        self.engine = create_async_engine(url, **options)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def shutdown(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+
+    def session(self):
+        if self.sessions is None:
+            self.startup()
+        return self.sessions()
+
+    def session_user_id(self, request):
+        """从 Flask 会话 cookie 中解析已登录用户的 id"""
+        cookie = request.cookies.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return None
+        serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        try:
+            data = serializer.loads(
+                cookie,
+                max_age=int(self.flask_app.permanent_session_lifetime.total_seconds())
+            )
+        except Exception:
+            return None
+        return data.get('_user_id')
+
+    async def jwt_user_id(self, session, request):
+        """从 JWT cookie 中解析用户 id, 无效或已吊销时返回 None"""
+        token = request.cookies.get(jwt_auth.JWT_COOKIE)
+        if not token:
+            return None
+        claims = jwt_auth.decode(self.flask_app.config['JWT_KEYS'], token)
+        if claims is None:
+            return None
+        if await session.run_sync(jwt_auth.revocations.is_revoked, claims['jti']):
+            return None
+        return claims['sub']
+
+    async def load_user(self, session, request):
+        """解析已登录用户; 这些接口都要读写余额, 直接加载完整的 User
+
+        与 Flask 的 user_loader 一致: 带了 JWT 时以 JWT 为准, 无效、已吊销或与会话不是同一用户
+        时拒绝; 没有 JWT 时才使用登录会话。
+        """
+        session_user_id = self.session_user_id(request)
+        if request.cookies.get(jwt_auth.JWT_COOKIE):
+            user_id = await self.jwt_user_id(session, request)
+            if session_user_id is not None and user_id != session_user_id:
+                return None
+        else:
+            user_id = session_user_id
+        if not user_id:
+            return None
+        return await session.get(User, int(user_id))
+
+    async def authenticate_app(self, session, request):
+        """校验应用凭据, 返回 (CachedApp, 错误响应)"""
+        auth = request.headers.get('Authorization')
+        if not auth:
+            return None, JSONResponse({'error': '缺少认证信息'}, status_code=401)
+        try:
+            client_id, client_secret = auth.split(':')
+        except ValueError:
+            return None, JSONResponse({'error': '认证格式错误'}, status_code=401)
+        cached_app = await app_credentials.verify_async(session, client_id, client_secret)
+        if not cached_app:
+            return None, JSONResponse({'error': '无效的应用认证信息'}, status_code=401)
+        return cached_app, None
+
+    @staticmethod
+    def unauthorized(request):
+        # 与 Flask-Login 保持一致, 未登录时跳转到登录页
+        return RedirectResponse(f"/login?{urlencode({'next': str(request.url)})}", status_code=302)
+
+    @staticmethod
+    async def json_body(request):
+        try:
+            return await request.json()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def confirm_url(request, token):
+        return f"{request.base_url}confirm/{token}"
+
+    async def run(self, session, func, *args, error_message=None):
+        """在会话中执行同步的业务函数, 将业务错误转换为 JSON 响应
+
+        写锁竞争时回滚并在事件循环上等待后重试, 不阻塞其他请求。
+        """
+        for attempt in range(balances.RETRY_ATTEMPTS):
+            try:
+                return await session.run_sync(func, *args), None
+            except ScoreError as e:
+                await session.rollback()
+                return None, JSONResponse(e.to_dict(), status_code=e.status)
+            except Exception as e:
+                await session.rollback()
+                if balances.is_contention(e) and attempt < balances.RETRY_ATTEMPTS - 1:
+                    await asyncio.sleep(balances.retry_delay(attempt))
+                    continue
+                self.flask_app.logger.error(f"{error_message}: {str(e)}")
+                return None, JSONResponse({'error': '操作失败'}, status_code=500)
+
+    @staticmethod
+    async def rate_limited(check, subject, respond):
+        """用 check(subject) 检查配额, 用尽时返回 429, 否则执行 respond, 两种情况都带上限流响应头
+
+        共享存储的检查会等待其他进程的写锁, 放到线程池中执行, 不阻塞事件循环。
+        """
+        if ratelimit.limiter.blocking:
+            decision = await asyncio.to_thread(check, subject)
+        else:
+            decision = check(subject)
+        if decision is not None and not decision.allowed:
+            response = JSONResponse(ratelimit.LIMITED_BODY, status_code=429)
+        else:
+            response = await respond()
+        return ratelimit.add_headers(response, decision)
+
+    async def idempotent(self, session, request, scope, respond):
+        """请求带 Idempotency-Key 时重放已保存的响应, 否则执行 respond 并保存其响应"""
+        key = request.headers.get(idempotency.HEADER)
+        if key is None:
+            return await respond()
+
+        request_fingerprint = idempotency.fingerprint(request.method, request.url.path,
+                                                      await request.body())
+        try:
+            stored = await session.run_sync(idempotency.begin, scope, key, request_fingerprint)
+        except ScoreError as e:
+            await session.rollback()
+            return JSONResponse(e.to_dict(), status_code=e.status)
+        if stored is not None:
+            return Response(stored.body, status_code=stored.status_code,
+                            media_type='application/json',
+                            headers={idempotency.REPLAYED_HEADER: 'true'})
+
+        response = await respond()
+        try:
+            await session.run_sync(idempotency.complete, scope, key, response.status_code,
+                                   response.body.decode())
+        except Exception as e:
+            await session.rollback()
+            self.flask_app.logger.error(f"保存幂等响应失败: {str(e)}")
+        return response
+
+    async def consume_score(self, request):
+        """请求消耗点数"""
+        async with self.session() as session:
+            cached_app, error = await self.authenticate_app(session, request)
+            if error:
+                return error
+
+            async def respond():
+                data = await self.json_body(request)
+                consumption, error = await self.run(session, services.create_consumption,
+                                                    cached_app.id, data,
+                                                    error_message='创建点数消耗请求失败')
+                if error:
+                    return error
+                return JSONResponse({
+                    'success': True,
+                    'confirm_url': self.confirm_url(request, consumption.confirm_token),
+                    'consumption_id': consumption.id
+                })
+
+            return await self.rate_limited(
+                ratelimit.limiter.check_app, cached_app,
+                lambda: self.idempotent(session, request, f'app:{cached_app.id}', respond)
+            )
+
+    async def consume_score_batch(self, request):
+        """批量请求消耗点数"""
+        async with self.session() as session:
+            cached_app, error = await self.authenticate_app(session, request)
+            if error:
+                return error
+
+            async def respond():
+                data = await self.json_body(request)
+                result, error = await self.run(session, batch_engine.create_batch_consumption,
+                                               cached_app.id, data,
+                                               error_message='批量创建点数消耗请求失败')
+                if error:
+                    return error
+                for item in result['results']:
+                    if 'confirm_token' in item:
+                        item['confirm_url'] = self.confirm_url(request, item.pop('confirm_token'))
+                return JSONResponse({'success': True, **result})
+
+            return await self.rate_limited(
+                ratelimit.limiter.check_app, cached_app,
+                lambda: self.idempotent(session, request, f'app:{cached_app.id}', respond)
+            )
+
+    async def consume_status(self, request):
+        """查询消耗请求的状态, 支持 wait 参数长轮询和 text/event-stream 订阅
+
+        等待时不占用线程; 同一进程内的确认会立即唤醒, 否则每隔 STATUS_POLL_INTERVAL 秒重新查询。
+        """
+        consumption_id = request.path_params['consumption_id']
+        async with self.session() as session:
+            cached_app, error = await self.authenticate_app(session, request)
+            if error:
+                return error
+
+            async def respond():
+                try:
+                    status = await session.run_sync(consumption_status.get_status,
+                                                    cached_app.id, consumption_id)
+                    wait = consumption_status.parse_wait(request.query_params.get('wait'))
+                except ScoreError as e:
+                    return JSONResponse(e.to_dict(), status_code=e.status)
+
+                if 'text/event-stream' in request.headers.get('accept', ''):
+                    return StreamingResponse(self.status_stream(cached_app.id, status),
+                                             media_type='text/event-stream',
+                                             headers={'Cache-Control': 'no-cache'})
+
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + wait
+                while not consumption_status.is_settled(status) and loop.time() < deadline:
+                    await consumption_status.waiters.wait_async(
+                        consumption_id,
+                        min(consumption_status.STATUS_POLL_INTERVAL, deadline - loop.time())
+                    )
+                    await session.rollback()
+                    status = await session.run_sync(consumption_status.get_status,
+                                                    cached_app.id, consumption_id)
+                return JSONResponse(status)
+
+            return await self.rate_limited(ratelimit.limiter.check_app, cached_app, respond)
+
+    async def status_stream(self, app_id, status):
+        """事件流: 先发送当前状态, 之后每次状态变化发送一次, 请求结束或超时后关闭"""
+        yield consumption_status.sse_event(status)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + consumption_status.STATUS_STREAM_TIMEOUT
+        async with self.session() as session:
+            while not consumption_status.is_settled(status) and loop.time() < deadline:
+                await consumption_status.waiters.wait_async(status['consumption_id'],
+                                                            consumption_status.STATUS_POLL_INTERVAL)
+                await session.rollback()
+                latest = await session.run_sync(consumption_status.get_status, app_id,
+                                                status['consumption_id'])
+                if latest != status:
+                    status = latest
+                    yield consumption_status.sse_event(status)
+                else:
+                    yield ': keepalive\n\n'
+
+    async def transfer_score(self, request):
+        """转账点数"""
+        async with self.session() as session:
+            user = await self.load_user(session, request)
+            if not user:
+                return self.unauthorized(request)
+
+            async def respond():
+                data = await self.json_body(request)
+                transfer, error = await self.run(session, services.create_transfer, user, data,
+                                                 error_message='创建转账请求失败')
+                if error:
+                    return error
+                return JSONResponse({
+                    'success': True,
+                    'confirm_url': self.confirm_url(request, transfer.confirm_token),
+                    'transfer_id': transfer.id
+                })
+
+            return await self.rate_limited(
+                ratelimit.limiter.check_user, user.id,
+                lambda: self.idempotent(session, request, f'user:{user.id}', respond)
+            )
+
+    async def batch_transfer_score(self, request):
+        """批量转账"""
+        async with self.session() as session:
+            user = await self.load_user(session, request)
+            if not user:
+                return self.unauthorized(request)
+
+            async def respond():
+                data = await self.json_body(request)
+                batch, error = await self.run(session, batch_engine.create_batch_transfer, user,
+                                              data, error_message='创建批量转账请求失败')
+                if error:
+                    return error
+                return JSONResponse({
+                    'success': True,
+                    'confirm_url': self.confirm_url(request, batch.pop('confirm_token')),
+                    **batch
+                })
+
+            return await self.rate_limited(
+                ratelimit.limiter.check_user, user.id,
+                lambda: self.idempotent(session, request, f'user:{user.id}', respond)
+            )
+
+    async def confirm_consumption(self, request):
+        """确认点数消耗"""
+        async with self.session() as session:
+            user = await self.load_user(session, request)
+            if not user:
+                return self.unauthorized(request)
+
+            async def respond():
+                form = await request.form()
+                result, error = await self.run(session, services.confirm_consumption, user,
+                                               request.path_params['token'], form.get('action'),
+                                               error_message='确认点数消耗失败')
+                return error or JSONResponse(result)
+
+            return await self.rate_limited(ratelimit.limiter.check_user, user.id, respond)
+
+    async def confirm_transfer(self, request):
+        """确认点数转账"""
+        async with self.session() as session:
+            user = await self.load_user(session, request)
+            if not user:
+                return self.unauthorized(request)
+
+            async def respond():
+                form = await request.form()
+                result, error = await self.run(session, services.confirm_transfer, user,
+                                               request.path_params['token'], form.get('action'),
+                                               error_message='确认点数转账失败')
+                if error:
+                    return error
+                result, _ = result
+                return JSONResponse(result)
+
+            return await self.rate_limited(ratelimit.limiter.check_user, user.id, respond)
+
+    def routes(self):
+        routes = [
+            ('/api/score/consume', self.consume_score, 'POST'),
+            ('/api/score/consume/batch', self.consume_score_batch, 'POST'),
+            ('/api/score/consume/{consumption_id:int}', self.consume_status, 'GET'),
+            ('/api/score/transfer', self.transfer_score, 'POST'),
+            ('/api/score/batch-transfer', self.batch_transfer_score, 'POST'),
+            ('/confirm/consume/{token}', self.confirm_consumption, 'POST'),
+            ('/confirm/transfer/{token}', self.confirm_transfer, 'POST'),
+        ]
+        # 端点名与 Flask 视图函数名一致, 两条路径的指标合并在一起
+        return [Route(path, metrics.instrument(handler.__name__, handler), methods=[method])
+                for path, handler, method in routes]
+
+
+def create_fastpath(flask_app):
+    """创建 ASGI 应用: 热点接口走异步路径, 其余请求挂载到 Flask"""
+    fastpath = FastPath(flask_app)
+    asgi = Starlette(
+        routes=fastpath.routes() + [Mount('/', app=WsgiToAsgi(flask_app))],
+        on_shutdown=[fastpath.shutdown]
+    )
+    asgi.state.fastpath = fastpath
+    return asgi
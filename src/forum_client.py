@@ -0,0 +1,154 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ForumScoreFetcher:
+    """论坛点数获取器
+
+    所有请求共用一个带连接池的 httpx.AsyncClient, 运行在独立的后台事件循环中,
+    并发数受信号量限制, 结果按用户名缓存 ttl 秒, 最多保留 cache_size 个用户(LRU)。
+    """
+
+    def __init__(self, base_url='https://linux.do', ttl=600, max_concurrency=8,
+                 timeout=30.0, proxy=None, cache_size=10000):
+        self.base_url = base_url.rstrip('/')
+        self.ttl = ttl
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.proxy = proxy
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._client = None
+        self._semaphore = None
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is not None:
+                return self._loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            # httpx 只在第一次获取点数时导入, 不拖慢应用启动
+            import httpx
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._client = httpx.AsyncClient(
+                    verify=False,
+                    proxies=self.proxy,
+                    timeout=self.timeout,
+                    limits=httpx.Limits(
+                        max_connections=self.max_concurrency,
+                        max_keepalive_connections=self.max_concurrency
+                    )
+                )
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                ready.set()
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name='forum-score-fetcher', daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+            return loop
+
+    def get_cached(self, username):
+        """返回未过期的缓存点数, 没有则返回 None"""
+        with self._cache_lock:
+            entry = self._cache.get(username)
+            if entry is None:
+                return None
+            expires_at, score = entry
+            if expires_at < time.monotonic():
+                self._cache.pop(username, None)
+                return None
+            self._cache.move_to_end(username)
+            return score
+
+    def _put(self, username, score):
+        with self._cache_lock:
+            self._cache[username] = (time.monotonic() + self.ttl, score)
+            self._cache.move_to_end(username)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    async def fetch(self, username):
+        """从论坛获取用户点数"""
+        async with self._semaphore:
+            resp = await self._client.get(f"{self.base_url}/u/{username}.json")
+        resp.raise_for_status()
+        score_data = resp.json()
+
+        if not score_data or 'user' not in score_data:
+            raise ValueError("响应数据格式错误")
+
+        score = score_data['user'].get('gamification_score', 0)
+        self._put(username, score)
+        return score
+
+    async def _refresh(self, username, on_score):
+        try:
+            score = await self.fetch(username)
+        except Exception as e:
+            logger.error(f"获取用户 {username} 的点数失败: {str(e)}")
+            return None
+        finally:
+            with self._lock:
+                self._inflight.pop(username, None)
+
+        if on_score is not None:
+            # 回调通常会访问数据库, 放到线程池中执行以免阻塞事件循环
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, on_score, score)
+            except Exception as e:
+                logger.error(f"保存用户 {username} 的点数失败: {str(e)}")
+        return score
+
+    def refresh(self, username, on_score=None):
+        """在后台刷新用户点数并立即返回, 同一用户的并发刷新会被合并"""
+        loop = self._ensure_loop()
+        with self._lock:
+            future = self._inflight.get(username)
+            if future is None or future.done():
+                future = asyncio.run_coroutine_threadsafe(self._refresh(username, on_score), loop)
+                self._inflight[username] = future
+        return future
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(timeout=5)
+
+
+def _proxy_from_env():
+    # 全局代理配置
+    if os.getenv('USE_PROXY', 'false').lower() == 'true':
+        return os.getenv('HTTP_PROXY') or None
+    return None
+
+
+forum_scores = ForumScoreFetcher(
+    base_url=os.getenv('FORUM_BASE_URL', 'https://linux.do'),
+    ttl=int(os.getenv('FORUM_SCORE_TTL', 600)),
+    max_concurrency=int(os.getenv('FORUM_MAX_CONCURRENCY', 8)),
+    timeout=float(os.getenv('FORUM_TIMEOUT', 30)),
+    proxy=_proxy_from_env(),
+    cache_size=int(os.getenv('FORUM_CACHE_SIZE', 10000))
+)
+atexit.register(forum_scores.close)
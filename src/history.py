@@ -0,0 +1,143 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import select, literal, union_all, and_, or_
+from sqlalchemy.orm import joinedload
+
+from models.models import db, ScoreConsumption, ScoreTransfer
+
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+# 记录类型, 排序时按字符串倒序作为同一时间点的次级排序键
+KIND_CONSUME = 'consume'
+KIND_TRANSFER_IN = 'transfer_in'
+KIND_TRANSFER_OUT = 'transfer_out'
+
+
+def encode_cursor(created_at, kind, record_id):
+    raw = f"{created_at.isoformat()}|{kind}|{record_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """解析游标, 格式错误时抛出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, kind, record_id = base64.urlsafe_b64decode(padded).decode().split('|')
+        if kind not in (KIND_CONSUME, KIND_TRANSFER_IN, KIND_TRANSFER_OUT):
+            raise ValueError(kind)
+        return datetime.fromisoformat(created_at), kind, int(record_id)
+    except Exception as e:
+        raise ValueError(f"无效的游标: {cursor}") from e
+
+
+def _branch(kind, model, user_column, user_id, limit, cursor):
+    """单个来源的分页子查询, 利用 (user_id, created_at) 复合索引"""
+    stmt = select(
+        literal(kind).label('kind'),
+        model.id.label('id'),
+        model.created_at.label('created_at')
+    ).where(user_column == user_id)
+
+    if cursor:
+        c_created_at, c_kind, c_id = cursor
+        if kind < c_kind:
+            stmt = stmt.where(model.created_at <= c_created_at)
+        elif kind == c_kind:
+            stmt = stmt.where(or_(
+                model.created_at < c_created_at,
+                and_(model.created_at == c_created_at, model.id < c_id)
+            ))
+        else:
+            stmt = stmt.where(model.created_at < c_created_at)
+
+    return select(
+        stmt.order_by(model.created_at.desc(), model.id.desc()).limit(limit).subquery()
+    )
+
+
+def fetch_history(user_id, limit=HISTORY_PAGE_SIZE, cursor=None):
+    """按时间倒序获取用户的消耗和转账记录
+
+    返回 (records, next_cursor), 每页的开销只与 limit 有关。
+    """
+    limit = max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+    position = decode_cursor(cursor) if cursor else None
+
+    branches = union_all(
+        _branch(KIND_CONSUME, ScoreConsumption, ScoreConsumption.user_id,
+                user_id, limit + 1, position),
+        _branch(KIND_TRANSFER_IN, ScoreTransfer, ScoreTransfer.to_user_id,
+                user_id, limit + 1, position),
+        _branch(KIND_TRANSFER_OUT, ScoreTransfer, ScoreTransfer.from_user_id,
+                user_id, limit + 1, position),
+    ).subquery()
+
+    rows = db.session.execute(
+        select(branches.c.kind, branches.c.id, branches.c.created_at)
+        .order_by(branches.c.created_at.desc(), branches.c.kind.desc(), branches.c.id.desc())
+        .limit(limit + 1)
+    ).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    consumption_ids = [row.id for row in rows if row.kind == KIND_CONSUME]
+    transfer_ids = [row.id for row in rows if row.kind != KIND_CONSUME]
+
+    consumptions = {}
+    if consumption_ids:
+        consumptions = {
+            c.id: c for c in ScoreConsumption.query
+            .options(joinedload(ScoreConsumption.app))
+            .filter(ScoreConsumption.id.in_(consumption_ids))
+        }
+    transfers = {}
+    if transfer_ids:
+        transfers = {
+            t.id: t for t in ScoreTransfer.query
+            .options(joinedload(ScoreTransfer.from_user), joinedload(ScoreTransfer.to_user))
+            .filter(ScoreTransfer.id.in_(transfer_ids))
+        }
+
+    records = [
+        consumptions[row.id] if row.kind == KIND_CONSUME else transfers[row.id]
+        for row in rows
+    ]
+
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1]
+        next_cursor = encode_cursor(last.created_at, last.kind, last.id)
+
+    return records, next_cursor
+
+
+def serialize_record(record, user_id):
+    """将记录转换为 JSON 可序列化的字典"""
+    if isinstance(record, ScoreConsumption):
+        return {
+            'kind': KIND_CONSUME,
+            'id': record.id,
+            'app': record.app.name if record.app else None,
+            'amount': -record.amount,
+            'fee_amount': record.fee_amount,
+            'note': record.purpose,
+            'status': record.status,
+            'created_at': record.created_at.isoformat(),
+            'confirmed_at': record.confirmed_at.isoformat() if record.confirmed_at else None,
+        }
+
+    outgoing = record.from_user_id == user_id
+    return {
+        'kind': KIND_TRANSFER_OUT if outgoing else KIND_TRANSFER_IN,
+        'id': record.id,
+        'counterparty': (record.to_user if outgoing else record.from_user).username,
+        'amount': -record.amount if outgoing else record.actual_amount,
+        'fee_amount': record.fee_amount,
+        'note': record.message,
+        'status': record.status,
+        'created_at': record.created_at.isoformat(),
+        'confirmed_at': record.confirmed_at.isoformat() if record.confirmed_at else None,
+    }
@@ -0,0 +1,128 @@
+"""写接口的 Idempotency-Key 支持
+
+客户端在请求头中携带 Idempotency-Key 时, 首次请求先登记 (作用域, 键, 请求指纹),
+处理完成后保存响应。相同键的重试直接返回保存的响应, 不再访问业务表; 键相同但请求内容
+不同时返回 422, 首次请求仍在处理时返回 409。保存的响应在 IDEMPOTENCY_TTL 秒后失效,
+由 run.py 中的后台清理线程删除。
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from models.models import IdempotencyKey
+from services import ScoreError
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+# 保存响应的时间(秒)
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 86400))
+# 处理中的键在该秒数后可被重新占用, 防止进程退出后键被永久锁住
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+
+StoredResponse = namedtuple('StoredResponse', ['status_code', 'body'])
+
+
+def fingerprint(method, path, body):
+    """请求指纹: 方法、路径和请求体的摘要
+
+    JSON 请求体先规范化, 字段顺序和空白不同的重试视为同一请求。
+    """
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode()
+    except ValueError:
+        pass
+    digest = hashlib.sha256()
+    for part in (method.encode(), path.encode(), body or b''):
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def validate_key(key):
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise ScoreError(f'{HEADER} 长度必须在 1 到 {MAX_KEY_LENGTH} 之间')
+
+
+def begin(session, scope, key, request_fingerprint):
+    """登记幂等键
+
+    已有完成的响应时返回 StoredResponse, 成功占用时返回 None。
+    """
+    validate_key(key)
+    now = datetime.utcnow()
+    record = session.execute(
+        select(IdempotencyKey).filter_by(scope=scope, key=key)
+    ).scalars().first()
+
+    if record is not None and record.expires_at < now:
+        # 已过期或处理中断的键, 删除后重新占用; 同时移出会话, 新记录可能复用同一 id
+        session.execute(
+            delete(IdempotencyKey)
+            .where(IdempotencyKey.id == record.id, IdempotencyKey.expires_at < now)
+            .execution_options(synchronize_session='evaluate')
+        )
+        session.commit()
+        record = None
+
+    if record is None:
+        try:
+            session.add(IdempotencyKey(
+                scope=scope,
+                key=key,
+                fingerprint=request_fingerprint,
+                expires_at=now + timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT)
+            ))
+            session.commit()
+            return None
+        except IntegrityError:
+            # 并发的相同请求已经占用
+            session.rollback()
+            record = session.execute(
+                select(IdempotencyKey).filter_by(scope=scope, key=key)
+            ).scalars().first()
+            if record is None:
+                raise ScoreError('请求正在处理中, 请稍后重试', 409)
+
+    if record.fingerprint != request_fingerprint:
+        raise ScoreError(f'{HEADER} 已用于不同的请求', 422)
+    if record.status_code is None:
+        raise ScoreError('请求正在处理中, 请稍后重试', 409)
+    return StoredResponse(record.status_code, record.response)
+
+
+def complete(session, scope, key, status_code, body):
+    """保存响应; 服务器错误不保存, 释放键以便客户端重试"""
+    if status_code >= 500:
+        session.execute(
+            delete(IdempotencyKey).filter_by(scope=scope, key=key)
+            .execution_options(synchronize_session='evaluate')
+        )
+    else:
+        session.execute(
+            update(IdempotencyKey).filter_by(scope=scope, key=key)
+            .values(status_code=status_code, response=body,
+                    expires_at=datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL))
+            .execution_options(synchronize_session=False)
+        )
+    session.commit()
+
+
+def purge_expired(session, limit, now=None):
+    """删除最多 limit 个已过期的键, 返回删除数量"""
+    expired = session.execute(
+        select(IdempotencyKey.id)
+        .where(IdempotencyKey.expires_at < (now or datetime.utcnow()))
+        .limit(limit)
+    ).scalars().all()
+    if expired:
+        session.execute(
+            delete(IdempotencyKey).where(IdempotencyKey.id.in_(expired))
+            .execution_options(synchronize_session=False)
+        )
+    return len(expired)
@@ -1,7 +1,8 @@
-from app import app, db
+from app import create_app, db
 from models.models import User, App, ScoreConsumption, ScoreTransfer, RedPacket, RedPacketClaim, PaymentRequest, Authorization, AuthorizationExecution
 
 def init_db():
+    app = create_app()
     with app.app_context():
         # 删除所有表
         db.drop_all()
@@ -0,0 +1,199 @@
+"""登录 JWT 的签发、校验和吊销
+
+登录后 jwt_token cookie 中保存用户的 id、用户名、昵称和信任等级。校验通过的请求直接用
+这些声明构造 Identity, 不查询数据库; 需要余额等最新数据时, Identity 在第一次访问这些属性时
+才加载完整的 User。声明签发超过 JWT_REFRESH_INTERVAL 秒或签名密钥已轮换时, 从数据库
+重新读取用户并换发新的 JWT, 信任等级等变化最迟在这段时间后生效。
+
+JWT_SECRET_KEYS 格式为 kid:secret,kid:secret, 第一个密钥用于签发, 其余只用于校验,
+轮换时把新密钥放在最前面, 旧密钥保留到已签发的 JWT 全部过期或换发。未设置时使用 Flask 的
+SECRET_KEY。
+
+退出登录时 JWT 的 jti 写入 revoked_token 表。每个进程在内存中保存吊销列表, 每隔
+JWT_REVOCATION_REFRESH 秒增量读取一次, 在其他进程吊销的 JWT 最迟在这段时间后失效。
+"""
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask_login import UserMixin
+from sqlalchemy import select, delete
+
+from models.models import db, User, RevokedToken
+
+JWT_COOKIE = 'jwt_token'
+JWT_ALGORITHM = 'HS256'
+# 有效期(秒)
+JWT_TTL = int(os.getenv('JWT_TTL', 7 * 24 * 3600))
+# 超过该时间(秒)的声明从数据库刷新
+JWT_REFRESH_INTERVAL = int(os.getenv('JWT_REFRESH_INTERVAL', 3600))
+# 重新读取吊销列表的间隔(秒)
+JWT_REVOCATION_REFRESH = float(os.getenv('JWT_REVOCATION_REFRESH', 10))
+
+REQUIRED_CLAIMS = ['sub', 'exp', 'iat', 'jti', 'username', 'trust_level']
+
+
+def load_keys(fallback_secret):
+    """解析 JWT_SECRET_KEYS, 返回 kid -> 密钥的有序字典, 第一个为签发密钥"""
+    keys = OrderedDict()
+    for entry in os.getenv('JWT_SECRET_KEYS', '').split(','):
+        kid, _, secret = entry.strip().partition(':')
+        if kid and secret:
+            keys[kid] = secret
+    if not keys:
+        keys['default'] = fallback_secret
+    return keys
+
+
+def encode(keys, user, now=None):
+    """为用户签发 JWT"""
+    now = int(now or time.time())
+    kid, secret = next(iter(keys.items()))
+    payload = {
+        'sub': str(user.id),
+        'username': user.username,
+        'name': user.name,
+        'trust_level': user.trust_level,
+        'jti': secrets.token_hex(16),
+        'iat': now,
+        'exp': now + JWT_TTL,
+    }
+    import jwt  # PyJWT 会导入 cryptography, 首次签发或校验时才加载
+
+    return jwt.encode(payload, secret, algorithm=JWT_ALGORITHM, headers={'kid': kid})
+
+
+def decode(keys, token):
+    """校验签名和有效期, 返回声明; 无效时返回 None"""
+    import jwt
+
+    try:
+        secret = keys.get(jwt.get_unverified_header(token).get('kid'))
+        if secret is None:
+            return None
+        return jwt.decode(token, secret, algorithms=[JWT_ALGORITHM],
+                          options={'require': REQUIRED_CLAIMS})
+    except jwt.PyJWTError:
+        return None
+
+
+def needs_refresh(keys, token, claims, now=None):
+    """声明过旧或不是用当前签发密钥签名时需要换发"""
+    import jwt
+
+    if (now or time.time()) - claims['iat'] >= JWT_REFRESH_INTERVAL:
+        return True
+    return jwt.get_unverified_header(token).get('kid') != next(iter(keys))
+
+
+class Identity(UserMixin):
+    """JWT 声明中的轻量身份, 访问其他属性时才从数据库加载完整的 User"""
+
+    def __init__(self, claims):
+        self.id = int(claims['sub'])
+        self.username = claims['username']
+        self.name = claims.get('name')
+        self.trust_level = claims['trust_level']
+        self.claims = claims
+        self._user = None
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = db.session.get(User, self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        # 只有实例上没有的属性才会走到这里, 例如余额和统计字段
+        if name.startswith('_'):
+            raise AttributeError(name)
+        user = self.user
+        if user is None:
+            raise AttributeError(name)
+        return getattr(user, name)
+
+
+class RevocationList:
+    """进程内的吊销列表, 定期从 revoked_token 表增量同步"""
+
+    def __init__(self, refresh=JWT_REVOCATION_REFRESH):
+        self.refresh_interval = refresh
+        self._revoked = {}  # jti -> expires_at
+        self._loaded_until = None
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self.refreshes = 0
+        self.rejected = 0
+
+    def _refresh(self, session, now):
+        query = select(RevokedToken.jti, RevokedToken.expires_at, RevokedToken.created_at)\
+            .where(RevokedToken.expires_at > now)
+        if self._loaded_until is not None:
+            # 往前多读一个刷新间隔, 覆盖提交晚于 created_at 的记录
+            query = query.where(RevokedToken.created_at
+                                >= self._loaded_until - timedelta(seconds=self.refresh_interval))
+        rows = session.execute(query).all()
+        with self._lock:
+            for row in rows:
+                self._revoked[row.jti] = row.expires_at
+                if self._loaded_until is None or row.created_at > self._loaded_until:
+                    self._loaded_until = row.created_at
+            for jti in [jti for jti, expires_at in self._revoked.items() if expires_at <= now]:
+                del self._revoked[jti]
+            if self._loaded_until is None:
+                self._loaded_until = now
+            self._refreshed_at = time.monotonic()
+            self.refreshes += 1
+
+    def is_revoked(self, session, jti):
+        """jti 是否已吊销, 距上次同步超过刷新间隔时先同步"""
+        if (self._refreshed_at is None
+                or time.monotonic() - self._refreshed_at >= self.refresh_interval):
+            self._refresh(session, datetime.utcnow())
+        with self._lock:
+            revoked = jti in self._revoked
+            if revoked:
+                self.rejected += 1
+        return revoked
+
+    def revoke(self, session, claims):
+        """吊销一个 JWT, 随调用方的事务提交"""
+        expires_at = datetime.utcfromtimestamp(claims['exp'])
+        if session.get(RevokedToken, claims['jti']) is None:
+            session.add(RevokedToken(jti=claims['jti'], user_id=int(claims['sub']),
+                                     expires_at=expires_at))
+        with self._lock:
+            self._revoked[claims['jti']] = expires_at
+
+    def size(self):
+        with self._lock:
+            return len(self._revoked)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._revoked),
+                'refreshes': self.refreshes,
+                'rejected': self.rejected,
+            }
+
+
+revocations = RevocationList()
+
+
+def purge_expired(session, limit, now=None):
+    """删除最多 limit 条已过期的吊销记录, 返回删除数量"""
+    expired = session.execute(
+        select(RevokedToken.jti)
+        .where(RevokedToken.expires_at < (now or datetime.utcnow()))
+        .limit(limit)
+    ).scalars().all()
+    if expired:
+        session.execute(
+            delete(RevokedToken).where(RevokedToken.jti.in_(expired))
+            .execution_options(synchronize_session=False)
+        )
+    return len(expired)
@@ -0,0 +1,199 @@
+import os
+from datetime import datetime, timedelta
+from importlib import import_module
+
+from sqlalchemy import select, insert, delete, update, func, literal
+
+from models.models import db, User, LeaderboardEntry, LeaderboardState
+
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 10))
+# 快照的最长有效时间(秒), 超过后由后台任务全量重建
+LEADERBOARD_REBUILD_INTERVAL = int(os.getenv('LEADERBOARD_REBUILD_INTERVAL', 600))
+# 后台任务检查失效快照的间隔(秒)
+LEADERBOARD_REFRESH_INTERVAL = int(os.getenv('LEADERBOARD_REFRESH_INTERVAL', 10))
+RANKING_PAGE_SIZE = 50
+
+# 榜单名称 -> 排序字段
+BOARDS = {
+    'richest': User.actual_score,
+    'generous': User.total_transferred,
+    'consumed': User.total_consumed,
+}
+
+
+def rebuild(board, session=None):
+    """从用户表全量重建单个榜单的快照"""
+    session = session or db.session
+    column = BOARDS[board]
+    # 锁住榜单状态, 并发的重建依次执行, 不会插入重复的记录
+    state = session.execute(
+        select(LeaderboardState).where(LeaderboardState.board == board).with_for_update()
+    ).scalars().first()
+    session.execute(delete(LeaderboardEntry).where(LeaderboardEntry.board == board))
+    top = select(
+        literal(board), User.id, User.username, func.coalesce(column, 0), literal(datetime.utcnow())
+    ).where(User.show_in_leaderboard == True)\
+        .order_by(column.desc(), User.id)\
+        .limit(LEADERBOARD_SIZE)
+    session.execute(insert(LeaderboardEntry).from_select(
+        ['board', 'user_id', 'username', 'value', 'updated_at'], top
+    ))
+
+    if state is None:
+        state = LeaderboardState(board=board)
+        session.add(state)
+    state.refreshed_at = datetime.utcnow()
+    state.dirty = False
+
+
+def rebuild_all():
+    for board in BOARDS:
+        rebuild(board)
+    db.session.commit()
+
+
+def rebuild_due(session, now=None):
+    """重建已失效或超过 LEADERBOARD_REBUILD_INTERVAL 的榜单, 每个榜单一个事务, 返回重建数量"""
+    stale_before = (now or datetime.utcnow()) - timedelta(seconds=LEADERBOARD_REBUILD_INTERVAL)
+    states = dict(session.execute(
+        select(LeaderboardState.board, LeaderboardState)
+    ).all())
+    rebuilt = 0
+    for board in BOARDS:
+        state = states.get(board)
+        if state is None or state.dirty or state.refreshed_at is None \
+                or state.refreshed_at < stale_before:
+            rebuild(board, session)
+            session.commit()
+            rebuilt += 1
+    return rebuilt
+
+
+def mark_dirty(board, session=None):
+    """标记榜单需要由后台任务重建"""
+    session = session or db.session
+    session.execute(
+        update(LeaderboardState).where(LeaderboardState.board == board).values(dirty=True)
+    )
+
+
+def _upsert_entry(session, board, user_id, username, value):
+    """写入或更新用户在榜单中的记录
+
+    同一用户的并发确认可能同时插入, 用 INSERT ... ON CONFLICT DO UPDATE 避免唯一约束冲突。
+    """
+    values = {'board': board, 'user_id': user_id, 'username': username, 'value': value,
+              'updated_at': datetime.utcnow()}
+    # 方言模块在创建引擎时已导入, 导入本模块时不加载其他数据库的方言
+    dialect = session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        statement = import_module(f'sqlalchemy.dialects.{dialect}').insert(LeaderboardEntry)\
+            .values(**values)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['board', 'user_id'],
+            set_={name: getattr(statement.excluded, name)
+                  for name in ('username', 'value', 'updated_at')}
+        ))
+        return
+    updated = session.execute(
+        update(LeaderboardEntry)
+        .where(LeaderboardEntry.board == board, LeaderboardEntry.user_id == user_id)
+        .values(username=username, value=value, updated_at=values['updated_at'])
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not updated:
+        session.execute(insert(LeaderboardEntry).values(**values))
+
+
+def _trim(session, board):
+    """删除排在 LEADERBOARD_SIZE 名之后的记录"""
+    extra = select(LeaderboardEntry.id).where(LeaderboardEntry.board == board)\
+        .order_by(LeaderboardEntry.value.desc(), LeaderboardEntry.user_id)\
+        .offset(LEADERBOARD_SIZE)
+    session.execute(
+        delete(LeaderboardEntry).where(LeaderboardEntry.id.in_(extra))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _replace_with_best_outsider(session, board, user_id, value):
+    """榜内用户数值下降后, 检查榜外是否有人应当补位"""
+    column = BOARDS[board]
+    members = select(LeaderboardEntry.user_id).where(LeaderboardEntry.board == board)
+    outsider = session.execute(
+        select(User.id, User.username, column)
+        .where(User.show_in_leaderboard == True, User.id.not_in(members))
+        .order_by(column.desc(), User.id)
+        .limit(1)
+    ).first()
+    if outsider is None or (outsider[2] or 0) <= value:
+        return
+    session.execute(delete(LeaderboardEntry).where(
+        LeaderboardEntry.board == board, LeaderboardEntry.user_id == user_id
+    ))
+    _upsert_entry(session, board, outsider.id, outsider.username, outsider[2] or 0)
+
+
+def _update_board(session, board, user):
+    column_name = BOARDS[board].key
+    value = getattr(user, column_name) or 0
+    entry = session.execute(
+        select(LeaderboardEntry).filter_by(board=board, user_id=user.id)
+    ).scalars().first()
+
+    if not user.show_in_leaderboard:
+        if entry:
+            session.delete(entry)
+            # 空出的名额需要由榜外用户补上
+            mark_dirty(board, session)
+        return
+
+    if entry:
+        previous = entry.value
+        entry.value = value
+        entry.username = user.username
+        entry.updated_at = datetime.utcnow()
+        if value < previous:
+            _replace_with_best_outsider(session, board, user.id, value)
+        return
+
+    count, lowest = session.execute(
+        select(func.count(LeaderboardEntry.id), func.min(LeaderboardEntry.value))
+        .where(LeaderboardEntry.board == board)
+    ).one()
+    if count >= LEADERBOARD_SIZE and value <= (lowest or 0):
+        return
+
+    _upsert_entry(session, board, user.id, user.username, value)
+    if count >= LEADERBOARD_SIZE:
+        _trim(session, board)
+
+
+def record_user(user, session=None):
+    """用户余额或统计数据变化后增量更新快照, 需在同一事务内提交"""
+    import rank_index
+
+    session = session or db.session
+    for board in BOARDS:
+        _update_board(session, board, user)
+    # 名次索引在提交后更新
+    rank_index.stage(session, user)
+
+
+def get_board(board):
+    """获取榜单快照, 重建由后台任务完成(rebuild_due)"""
+    return LeaderboardEntry.query.filter_by(board=board)\
+        .order_by(LeaderboardEntry.value.desc(), LeaderboardEntry.user_id)\
+        .all()
+
+
+def get_ranking(page):
+    """分页获取详细排名, 启用名次索引时只读取当前页的用户"""
+    import rank_index
+
+    ranking = rank_index.paginate(db.session, 'richest', page, RANKING_PAGE_SIZE)
+    if ranking is not None:
+        return ranking
+    return User.query.filter_by(show_in_leaderboard=True)\
+        .order_by(User.actual_score.desc(), User.id)\
+        .paginate(page=page, per_page=RANKING_PAGE_SIZE, error_out=False)
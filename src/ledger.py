@@ -0,0 +1,182 @@
+"""余额账本
+
+每次余额变化都会向 ledger_entry 追加一条记录, 保存 actual_score 和四个统计字段的变化量:
+确认操作由 balances 写入, 论坛点数同步和后台修改等直接修改 User 的情况由映射事件写入
+adjustment 记录。定期为有新记录的用户写入 balance_checkpoint, 任意用户在任意时刻的余额
+和统计字段都可以由"最近的快照 + 之后的账本记录"算出, 不需要扫描转账和消耗表。
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, select, insert, func, literal, DateTime
+
+from models.models import db, User, ScoreTransfer, LedgerEntry, BalanceCheckpoint
+
+# User 统计字段 -> 账本中的变化量列
+COUNTERS = {
+    'total_transferred': 'transferred',
+    'total_received': 'received',
+    'total_consumed': 'consumed',
+    'total_fee_paid': 'fee_paid',
+}
+FIELDS = ('actual_score',) + tuple(COUNTERS)
+
+# 快照只覆盖写入超过该秒数的账本记录, 避免遗漏仍未提交的事务
+CHECKPOINT_LAG = int(os.getenv('LEDGER_CHECKPOINT_LAG', 60))
+# 写入快照的间隔(秒), 由 run.py 中的后台清理线程执行
+CHECKPOINT_INTERVAL = int(os.getenv('LEDGER_CHECKPOINT_INTERVAL', 3600))
+# IN 查询每块的参数个数
+CHUNK_SIZE = 900
+
+
+def append(session, user_id, reason, delta, **totals):
+    """追加一条账本记录
+
+    reason 为 (类型, 关联记录类型, 关联记录id), totals 为 User 统计字段的变化量。
+    """
+    kind, ref_type, ref_id = reason
+    session.execute(insert(LedgerEntry).values(
+        user_id=user_id,
+        kind=kind,
+        ref_type=ref_type,
+        ref_id=ref_id,
+        delta=delta,
+        created_at=datetime.utcnow(),
+        **{COUNTERS[name]: value for name, value in totals.items()}
+    ))
+
+
+def append_transfer_credits(session, condition):
+    """为满足条件的每笔转账的收款人追加入账记录, 一条 INSERT ... SELECT"""
+    session.execute(insert(LedgerEntry).from_select(
+        ['user_id', 'kind', 'ref_type', 'ref_id', 'delta', 'received', 'created_at'],
+        select(
+            ScoreTransfer.to_user_id,
+            literal('transfer_in'),
+            literal('transfer'),
+            ScoreTransfer.id,
+            ScoreTransfer.actual_amount,
+            ScoreTransfer.actual_amount,
+            literal(datetime.utcnow(), DateTime)
+        ).where(condition)
+    ))
+
+
+def _write_adjustment(connection, user_id, deltas):
+    if not any(deltas.values()):
+        return
+    connection.execute(insert(LedgerEntry).values(
+        user_id=user_id,
+        kind='adjustment',
+        ref_type='user',
+        ref_id=user_id,
+        delta=deltas.pop('actual_score', 0),
+        created_at=datetime.utcnow(),
+        **{COUNTERS[name]: value for name, value in deltas.items()}
+    ))
+
+
+@event.listens_for(User, 'after_insert')
+def _record_new_user(mapper, connection, target):
+    # 新用户的初始点数
+    _write_adjustment(connection, target.id,
+                      {name: getattr(target, name) or 0 for name in FIELDS})
+
+
+@event.listens_for(User, 'after_update')
+def _record_user_update(mapper, connection, target):
+    # 直接修改 User 字段(论坛点数同步、后台编辑)时记录差额
+    state = db.inspect(target)
+    deltas = {}
+    for name in FIELDS:
+        history = state.attrs[name].history
+        if not history.added or not history.deleted:
+            continue
+        new, old = history.added[0], history.deleted[0]
+        if isinstance(new, int) and isinstance(old, int):
+            deltas[name] = new - old
+    _write_adjustment(connection, target.id, deltas)
+
+
+def _entry_sums(conditions):
+    return select(
+        LedgerEntry.user_id,
+        func.coalesce(func.sum(LedgerEntry.delta), 0),
+        *(func.coalesce(func.sum(getattr(LedgerEntry, column)), 0) for column in COUNTERS.values())
+    ).where(*conditions).group_by(LedgerEntry.user_id)
+
+
+def _latest_checkpoints(session, user_ids, at=None):
+    """每个用户最近的快照, 返回 {user_id: BalanceCheckpoint}"""
+    latest = {}
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), CHUNK_SIZE):
+        chunk = user_ids[start:start + CHUNK_SIZE]
+        conditions = [BalanceCheckpoint.user_id.in_(chunk)]
+        if at is not None:
+            conditions.append(BalanceCheckpoint.as_of <= at)
+        newest = select(
+            BalanceCheckpoint.user_id,
+            func.max(BalanceCheckpoint.ledger_id).label('ledger_id')
+        ).where(*conditions).group_by(BalanceCheckpoint.user_id).subquery()
+        rows = session.execute(
+            select(BalanceCheckpoint).join(newest, (BalanceCheckpoint.user_id == newest.c.user_id)
+                                           & (BalanceCheckpoint.ledger_id == newest.c.ledger_id))
+        ).scalars()
+        for checkpoint in rows:
+            latest[checkpoint.user_id] = checkpoint
+    return latest
+
+
+def checkpoint(session, now=None):
+    """为上次快照之后有新账本记录的用户写入快照, 返回写入数量
+
+    工作量只与新增的账本记录数有关。调用方负责提交事务。
+    """
+    now = now or datetime.utcnow()
+    watermark = session.execute(
+        select(func.coalesce(func.max(BalanceCheckpoint.ledger_id), 0))
+    ).scalar()
+    upper = session.execute(
+        select(func.max(LedgerEntry.id)).where(
+            LedgerEntry.id > watermark,
+            LedgerEntry.created_at < now - timedelta(seconds=CHECKPOINT_LAG)
+        )
+    ).scalar()
+    if upper is None:
+        return 0
+    as_of = session.get(LedgerEntry, upper).created_at
+
+    sums = session.execute(
+        _entry_sums([LedgerEntry.id > watermark, LedgerEntry.id <= upper])
+    ).all()
+    previous = _latest_checkpoints(session, [row[0] for row in sums])
+
+    rows = []
+    for user_id, *deltas in sums:
+        base = previous.get(user_id)
+        row = {'user_id': user_id, 'ledger_id': upper, 'as_of': as_of, 'created_at': now}
+        for name, delta in zip(FIELDS, deltas):
+            row[name] = (getattr(base, name) if base else 0) + delta
+        rows.append(row)
+    session.execute(insert(BalanceCheckpoint), rows)
+    return len(rows)
+
+
+def snapshot(session, user_id, at=None):
+    """由最近的快照加上之后的账本记录计算余额和统计字段
+
+    at 为 None 时返回当前值, 否则返回 at 时刻的值。
+    """
+    base = _latest_checkpoints(session, [user_id], at).get(user_id)
+    conditions = [LedgerEntry.user_id == user_id]
+    if base is not None:
+        conditions.append(LedgerEntry.id > base.ledger_id)
+    if at is not None:
+        conditions.append(LedgerEntry.created_at <= at)
+    sums = session.execute(_entry_sums(conditions)).first()
+    deltas = sums[1:] if sums else (0,) * len(FIELDS)
+    return {
+        name: (getattr(base, name) if base else 0) + delta
+        for name, delta in zip(FIELDS, deltas)
+    }
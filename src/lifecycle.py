@@ -0,0 +1,5 @@
+"""进程生命周期状态"""
+import threading
+
+# 收到 SIGTERM 后置位, 就绪检查随即返回 503, 负载均衡器停止分配新请求
+draining = threading.Event()
@@ -0,0 +1,295 @@
+"""请求和数据库查询指标
+
+Flask 的 before_request/after_request 和异步接口的处理函数记录每个端点的耗时分布、
+状态码和本次请求执行的 SQL 数量与耗时; SQLAlchemy 的 before/after_cursor_execute
+事件挂在 Engine 类上, 同步和异步引擎都会经过。超过 SLOW_QUERY_MS 的查询连同语句写入日志。
+
+指标以 Prometheus 文本格式从 /metrics 输出。每个工作进程各自统计, 多进程部署时
+每次抓取得到的是处理该请求的进程的数据, 指标中带有 pid 标签以便区分。
+记录一次请求只需一次加锁和一次二分查找, 可以在生产环境中常开。
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+# 设置后 /metrics 需要 Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# 慢查询阈值(毫秒)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+# 慢查询日志中语句的最大长度
+SLOW_QUERY_MAX_LENGTH = 1000
+
+# 耗时分布的桶上限(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 每次请求的查询数分布的桶上限
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """累积分布直方图, 调用方负责加锁"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+    """当前请求执行的 SQL 数量和耗时"""
+
+    __slots__ = ('queries', 'db_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# contextvars 在线程和异步任务之间隔离, AsyncSession.run_sync 中同样可见
+current_request = contextvars.ContextVar('metrics_request', default=None)
+
+
+class Registry:
+    """进程内的指标汇总"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)  # (endpoint, method, status) -> 次数
+        self.latency = {}  # (endpoint, method) -> Histogram
+        self.queries_per_request = {}  # endpoint -> Histogram
+        self.db_seconds = defaultdict(float)  # endpoint -> 秒
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.slow_queries = 0
+        self.collectors = {}
+
+    def observe_request(self, endpoint, method, status, seconds, stats):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            histogram = self.latency.get((endpoint, method))
+            if histogram is None:
+                histogram = self.latency[(endpoint, method)] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+            histogram = self.queries_per_request.get(endpoint)
+            if histogram is None:
+                histogram = self.queries_per_request[endpoint] = Histogram(QUERY_COUNT_BUCKETS)
+            histogram.observe(stats.queries)
+            self.db_seconds[endpoint] += stats.db_seconds
+
+    def observe_query(self, seconds, slow):
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += seconds
+            if slow:
+                self.slow_queries += 1
+
+    def register_collector(self, name, collect):
+        """登记额外的统计来源, collect() 返回数值字典, 输出为 doscores_<name>_<key>"""
+        self.collectors[name] = collect
+
+    def render(self):
+        """生成 Prometheus 文本格式"""
+        pid = os.getpid()
+        lines = []
+        with self._lock:
+            lines += [
+                '# HELP doscores_http_requests_total HTTP requests by endpoint, method and status.',
+                '# TYPE doscores_http_requests_total counter',
+            ]
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'doscores_http_requests_total'
+                             f'{_labels(pid=pid, endpoint=endpoint, method=method, status=status)} {count}')
+
+            lines += [
+                '# HELP doscores_http_request_duration_seconds HTTP request latency.',
+                '# TYPE doscores_http_request_duration_seconds histogram',
+            ]
+            for (endpoint, method), histogram in sorted(self.latency.items()):
+                lines += _histogram('doscores_http_request_duration_seconds', histogram,
+                                    pid=pid, endpoint=endpoint, method=method)
+
+            lines += [
+                '# HELP doscores_db_queries_per_request SQL statements executed per request.',
+                '# TYPE doscores_db_queries_per_request histogram',
+            ]
+            for endpoint, histogram in sorted(self.queries_per_request.items()):
+                lines += _histogram('doscores_db_queries_per_request', histogram,
+                                    pid=pid, endpoint=endpoint)
+
+            lines += [
+                '# HELP doscores_db_request_seconds_total Time spent in SQL per endpoint.',
+                '# TYPE doscores_db_request_seconds_total counter',
+            ]
+            for endpoint, seconds in sorted(self.db_seconds.items()):
+                lines.append(f'doscores_db_request_seconds_total'
+                             f'{_labels(pid=pid, endpoint=endpoint)} {seconds:.6f}')
+
+            lines += [
+                '# TYPE doscores_db_queries_total counter',
+                f'doscores_db_queries_total{_labels(pid=pid)} {self.queries}',
+                '# TYPE doscores_db_query_seconds_total counter',
+                f'doscores_db_query_seconds_total{_labels(pid=pid)} {self.query_seconds:.6f}',
+                '# TYPE doscores_db_slow_queries_total counter',
+                f'doscores_db_slow_queries_total{_labels(pid=pid)} {self.slow_queries}',
+            ]
+            collectors = list(self.collectors.items())
+
+        # 统计来源各自加锁, 不在注册表的锁内调用
+        for name, collect in collectors:
+            try:
+                values = collect()
+            except Exception:
+                continue
+            for key, value in _flatten(values):
+                metric = f'doscores_{name}_{key}'
+                lines.append(f'# TYPE {metric} gauge')
+                lines.append(f'{metric}{_labels(pid=pid)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _histogram(name, histogram, **labels):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}')
+    lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {histogram.count}')
+    lines.append(f'{name}_sum{_labels(**labels)} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{_labels(**labels)} {histogram.count}')
+    return lines
+
+
+def _flatten(values, prefix=''):
+    """展开嵌套字典, 只保留数值"""
+    for key, value in values.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            yield from _flatten(value, f'{name}_')
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+registry = Registry()
+# 慢查询日志使用的 logger, 由 init_app 设置
+_logger = None
+
+
+class RequestTimer:
+    """一次请求的计时, 开始时登记当前请求, 结束时写入注册表"""
+
+    __slots__ = ('start', 'stats', 'token')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stats = RequestStats()
+        self.token = current_request.set(self.stats)
+
+    def finish(self, endpoint, method, status):
+        registry.observe_request(endpoint, method, status,
+                                 time.perf_counter() - self.start, self.stats)
+
+    def close(self):
+        try:
+            current_request.reset(self.token)
+        except ValueError:
+            # 在其他上下文中结束的请求(如流式响应), 直接清空
+            current_request.set(None)
+
+
+def instrument(name, handler):
+    """包装异步接口的处理函数, 以 name 作为端点名记录指标"""
+    if not METRICS_ENABLED:
+        return handler
+
+    async def instrumented(request):
+        timer = RequestTimer()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status_code
+            return response
+        finally:
+            timer.finish(name, request.method, status)
+            timer.close()
+
+    instrumented.__name__ = name
+    return instrumented
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    slow = seconds * 1000 >= SLOW_QUERY_MS
+    registry.observe_query(seconds, slow)
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += seconds
+    if slow and _logger is not None:
+        # 语句压缩为一行, 便于按行检索日志
+        statement = ' '.join(statement[:SLOW_QUERY_MAX_LENGTH].split())
+        _logger.warning(f"慢查询 {seconds * 1000:.1f} ms: {statement}")
+
+
+def init_app(flask_app):
+    """注册 Flask 请求钩子和 SQLAlchemy 查询事件"""
+    global _logger
+    if not METRICS_ENABLED:
+        return
+    _logger = flask_app.logger
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    from flask import g, request
+
+    @flask_app.before_request
+    def start_timer():
+        g.metrics_timer = RequestTimer()
+
+    @flask_app.after_request
+    def record_request(response):
+        timer = g.pop('metrics_timer', None)
+        if timer is not None:
+            # 未匹配路由的请求统一记为 unmatched, 避免任意路径产生大量标签
+            timer.finish(request.endpoint or 'unmatched', request.method, response.status_code)
+            g.metrics_closing = timer
+        return response
+
+    @flask_app.teardown_request
+    def reset_request(exc):
+        timer = g.pop('metrics_closing', None) or g.pop('metrics_timer', None)
+        if timer is not None:
+            timer.close()
@@ -1,4 +1,4 @@
-from app import app, db
+from app import create_app, db
 from flask_migrate import Migrate
 import logging
 
@@ -8,6 +8,7 @@ logger = logging.getLogger(__name__)
 
 try:
     logger.info("初始化 Flask-Migrate...")
+    app = create_app()
     migrate = Migrate(app, db)
 
     with app.app_context():
@@ -0,0 +1,28 @@
+"""add admin accounts
+
+Revision ID: add_admin_accounts
+Revises: add_daily_rollups
+Create Date: 2024-02-26 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_admin_accounts'
+down_revision = 'add_daily_rollups'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('admin',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(length=80), nullable=False),
+        sa.Column('password_hash', sa.String(length=256), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username')
+    )
+
+def downgrade():
+    op.drop_table('admin')
@@ -0,0 +1,25 @@
+"""add per-app rate limit quotas
+
+Revision ID: add_app_rate_limits
+Revises: add_idempotency_keys
+Create Date: 2024-02-10 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_app_rate_limits'
+down_revision = 'add_idempotency_keys'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    with op.batch_alter_table('app', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('rate_limit', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('rate_burst', sa.Integer(), nullable=True))
+
+def downgrade():
+    with op.batch_alter_table('app', schema=None) as batch_op:
+        batch_op.drop_column('rate_burst')
+        batch_op.drop_column('rate_limit')
@@ -0,0 +1,40 @@
+"""add batch transfer counters
+
+Revision ID: add_batch_transfer_counters
+Revises: relax_transfer_confirm_token
+Create Date: 2024-02-04 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_batch_transfer_counters'
+down_revision = 'relax_transfer_confirm_token'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # 批量转账批次的汇总与状态字段
+    with op.batch_alter_table('batch_transfer', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('batch_id', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('total_fee', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('total_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('confirmed_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('status', sa.String(length=20), nullable=False, server_default='pending'))
+        batch_op.add_column(sa.Column('confirm_token', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('confirmed_at', sa.DateTime(), nullable=True))
+        batch_op.create_unique_constraint('uq_batch_transfer_batch_id', ['batch_id'])
+        batch_op.create_index('ix_batch_transfer_confirm_token', ['confirm_token'])
+
+def downgrade():
+    with op.batch_alter_table('batch_transfer', schema=None) as batch_op:
+        batch_op.drop_index('ix_batch_transfer_confirm_token')
+        batch_op.drop_constraint('uq_batch_transfer_batch_id', type_='unique')
+        batch_op.drop_column('confirmed_at')
+        batch_op.drop_column('confirm_token')
+        batch_op.drop_column('status')
+        batch_op.drop_column('confirmed_count')
+        batch_op.drop_column('total_count')
+        batch_op.drop_column('total_fee')
+        batch_op.drop_column('batch_id')
@@ -0,0 +1,61 @@
+"""add confirmation token registry
+
+Revision ID: add_confirmation_tokens
+Revises: add_batch_transfer_counters
+Create Date: 2024-02-05 10:00:00.000000
+
+"""
+from datetime import datetime, timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_confirmation_tokens'
+down_revision = 'add_batch_transfer_counters'
+branch_labels = None
+depends_on = None
+
+# 已有的待确认记录登记后的有效期
+BACKFILL_TTL = timedelta(days=1)
+
+# (类型, 表, 所属用户列, 过期时间表达式, 待确认条件)
+BACKFILL = [
+    ('consume', 'score_consumption', 'user_id', ':expires_at', "status = 'pending'"),
+    ('transfer', 'score_transfer', 'from_user_id', ':expires_at',
+     "status = 'pending' AND (type IS NULL OR type != 'batch')"),
+    ('batch', 'batch_transfer', 'from_user_id', ':expires_at',
+     "status = 'pending' AND confirm_token IS NOT NULL"),
+    ('red_packet', 'red_packet', 'from_user_id', 'COALESCE(expires_at, :expires_at)',
+     'remaining_count > 0'),
+    ('payment', 'payment_request', 'from_user_id', 'COALESCE(expires_at, :expires_at)',
+     "status = 'pending'"),
+]
+
+def upgrade():
+    # 所有待确认操作共用的token登记表
+    op.create_table('confirmation_token',
+        sa.Column('token', sa.String(length=64), nullable=False),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('record_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('token')
+    )
+    op.create_index('ix_confirmation_token_expires_at', 'confirmation_token', ['expires_at'])
+
+    # 登记已有的待确认记录, 红包和收款请求的token也使用同一张表
+    now = datetime.utcnow()
+    token_column = {'red_packet': 'token', 'payment_request': 'token'}
+    for kind, table, owner, expires, condition in BACKFILL:
+        column = token_column.get(table, 'confirm_token')
+        op.get_bind().execute(sa.text(
+            f"INSERT INTO confirmation_token (token, kind, record_id, user_id, expires_at, created_at) "
+            f"SELECT {column}, '{kind}', id, {owner}, {expires}, :now FROM {table} WHERE {condition}"
+        ), {'expires_at': now + BACKFILL_TTL, 'now': now})
+
+def downgrade():
+    op.drop_index('ix_confirmation_token_expires_at', table_name='confirmation_token')
+    op.drop_table('confirmation_token')
@@ -0,0 +1,44 @@
+"""add incremental counter reconciliation state
+
+Revision ID: add_counter_reconciliation
+Revises: add_ledger
+Create Date: 2024-02-08 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_counter_reconciliation'
+down_revision = 'add_ledger'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # 核对任务按确认时间顺序读取新确认的记录
+    op.create_index('ix_score_consumption_confirmed', 'score_consumption', ['confirmed_at', 'id'])
+    op.create_index('ix_score_transfer_confirmed', 'score_transfer', ['confirmed_at', 'id'])
+
+    op.create_table('reconcile_watermark',
+        sa.Column('source', sa.String(length=20), nullable=False),
+        sa.Column('confirmed_at', sa.DateTime(), nullable=True),
+        sa.Column('record_id', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('source')
+    )
+    op.create_table('reconciled_counters',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('total_transferred', sa.Integer(), nullable=False),
+        sa.Column('total_received', sa.Integer(), nullable=False),
+        sa.Column('total_consumed', sa.Integer(), nullable=False),
+        sa.Column('total_fee_paid', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('user_id')
+    )
+
+def downgrade():
+    op.drop_table('reconciled_counters')
+    op.drop_table('reconcile_watermark')
+    op.drop_index('ix_score_transfer_confirmed', table_name='score_transfer')
+    op.drop_index('ix_score_consumption_confirmed', table_name='score_consumption')
@@ -0,0 +1,31 @@
+"""add daily per-user rollups for windowed leaderboards
+
+Revision ID: add_daily_rollups
+Revises: add_revoked_tokens
+Create Date: 2024-02-25 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_daily_rollups'
+down_revision = 'add_revoked_tokens'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('daily_rollup',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('transferred', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('received', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('consumed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('fee_paid', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('day', 'user_id')
+    )
+
+def downgrade():
+    op.drop_table('daily_rollup')
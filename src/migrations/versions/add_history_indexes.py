@@ -0,0 +1,26 @@
+"""add history indexes
+
+Revision ID: add_history_indexes
+Revises: add_leaderboard_features
+Create Date: 2024-02-01 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_history_indexes'
+down_revision = 'add_leaderboard_features'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # 仪表板记录按 (用户, 时间) 分页查询所需的复合索引
+    op.create_index('ix_score_consumption_user_created', 'score_consumption', ['user_id', 'created_at'])
+    op.create_index('ix_score_transfer_from_created', 'score_transfer', ['from_user_id', 'created_at'])
+    op.create_index('ix_score_transfer_to_created', 'score_transfer', ['to_user_id', 'created_at'])
+
+def downgrade():
+    op.drop_index('ix_score_transfer_to_created', 'score_transfer')
+    op.drop_index('ix_score_transfer_from_created', 'score_transfer')
+    op.drop_index('ix_score_consumption_user_created', 'score_consumption')
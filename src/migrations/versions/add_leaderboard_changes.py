@@ -0,0 +1,31 @@
+"""add leaderboard membership change feed
+
+Revision ID: add_leaderboard_changes
+Revises: add_admin_accounts
+Create Date: 2024-02-27 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_leaderboard_changes'
+down_revision = 'add_admin_accounts'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('leaderboard_change',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_leaderboard_change_created_at', 'leaderboard_change', ['created_at'])
+    # 显示设置的变化不再写入余额账本
+    op.execute("DELETE FROM ledger_entry WHERE kind = 'visibility'")
+
+def downgrade():
+    op.drop_index('ix_leaderboard_change_created_at', table_name='leaderboard_change')
+    op.drop_table('leaderboard_change')
@@ -0,0 +1,51 @@
+"""add leaderboard snapshots
+
+Revision ID: add_leaderboard_snapshots
+Revises: add_history_indexes
+Create Date: 2024-02-02 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_leaderboard_snapshots'
+down_revision = 'add_history_indexes'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # 创建排行榜快照表
+    op.create_table('leaderboard_entry',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('board', sa.String(length=20), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(length=80), nullable=True),
+        sa.Column('value', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('board', 'user_id', name='uq_leaderboard_entry_board_user')
+    )
+    op.create_index('ix_leaderboard_entry_board_value', 'leaderboard_entry', ['board', 'value'])
+    
+    # 创建排行榜刷新状态表
+    op.create_table('leaderboard_state',
+        sa.Column('board', sa.String(length=20), nullable=False),
+        sa.Column('refreshed_at', sa.DateTime(), nullable=True),
+        sa.Column('dirty', sa.Boolean(), nullable=False, server_default='false'),
+        sa.PrimaryKeyConstraint('board')
+    )
+    
+    # 排行榜排序所需索引
+    op.create_index('ix_user_leaderboard_actual_score', 'user', ['show_in_leaderboard', 'actual_score'])
+    op.create_index('ix_user_leaderboard_total_transferred', 'user', ['show_in_leaderboard', 'total_transferred'])
+    op.create_index('ix_user_leaderboard_total_consumed', 'user', ['show_in_leaderboard', 'total_consumed'])
+
+def downgrade():
+    op.drop_index('ix_user_leaderboard_total_consumed', 'user')
+    op.drop_index('ix_user_leaderboard_total_transferred', 'user')
+    op.drop_index('ix_user_leaderboard_actual_score', 'user')
+    op.drop_table('leaderboard_state')
+    op.drop_index('ix_leaderboard_entry_board_value', 'leaderboard_entry')
+    op.drop_table('leaderboard_entry')
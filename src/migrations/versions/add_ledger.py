@@ -0,0 +1,70 @@
+"""add append-only ledger and balance checkpoints
+
+Revision ID: add_ledger
+Revises: add_pending_archives
+Create Date: 2024-02-07 10:00:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_ledger'
+down_revision = 'add_pending_archives'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('ledger_entry',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('ref_type', sa.String(length=20), nullable=True),
+        sa.Column('ref_id', sa.Integer(), nullable=True),
+        sa.Column('delta', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('transferred', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('received', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('consumed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('fee_paid', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_ledger_entry_user_id_id', 'ledger_entry', ['user_id', 'id'])
+
+    op.create_table('balance_checkpoint',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('ledger_id', sa.Integer(), nullable=False),
+        sa.Column('actual_score', sa.Integer(), nullable=False),
+        sa.Column('total_transferred', sa.Integer(), nullable=False),
+        sa.Column('total_received', sa.Integer(), nullable=False),
+        sa.Column('total_consumed', sa.Integer(), nullable=False),
+        sa.Column('total_fee_paid', sa.Integer(), nullable=False),
+        sa.Column('as_of', sa.DateTime(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_balance_checkpoint_user_ledger', 'balance_checkpoint', ['user_id', 'ledger_id'])
+    op.create_index('ix_balance_checkpoint_ledger_id', 'balance_checkpoint', ['ledger_id'])
+
+    # 以当前余额和统计字段作为每个用户的初始快照, 之后的变化都记入账本
+    op.get_bind().execute(sa.text("""
+        INSERT INTO balance_checkpoint (user_id, ledger_id, actual_score, total_transferred,
+                                        total_received, total_consumed, total_fee_paid,
+                                        as_of, created_at)
+        SELECT id, 0, COALESCE(actual_score, 0), COALESCE(total_transferred, 0),
+               COALESCE(total_received, 0), COALESCE(total_consumed, 0),
+               COALESCE(total_fee_paid, 0), :now, :now
+        FROM "user"
+    """), {'now': datetime.utcnow()})
+
+def downgrade():
+    op.drop_index('ix_balance_checkpoint_ledger_id', table_name='balance_checkpoint')
+    op.drop_index('ix_balance_checkpoint_user_ledger', table_name='balance_checkpoint')
+    op.drop_table('balance_checkpoint')
+    op.drop_index('ix_ledger_entry_user_id_id', table_name='ledger_entry')
+    op.drop_table('ledger_entry')
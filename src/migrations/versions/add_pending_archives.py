@@ -0,0 +1,65 @@
+"""add archives for expired pending records
+
+Revision ID: add_pending_archives
+Revises: add_confirmation_tokens
+Create Date: 2024-02-06 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_pending_archives'
+down_revision = 'add_confirmation_tokens'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # 清理任务按状态和创建时间查找过期的 pending 记录
+    op.create_index('ix_score_consumption_status_created', 'score_consumption', ['status', 'created_at'])
+    op.create_index('ix_score_transfer_status_created', 'score_transfer', ['status', 'created_at'])
+
+    # 过期记录归档表
+    op.create_table('score_consumption_archive',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('app_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False),
+        sa.Column('developer_amount', sa.Integer(), nullable=False),
+        sa.Column('fee_amount', sa.Integer(), nullable=False),
+        sa.Column('purpose', sa.String(length=256), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('confirm_token', sa.String(length=64), nullable=True),
+        sa.Column('confirmed_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('archived_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_score_consumption_archive_user_id', 'score_consumption_archive', ['user_id'])
+
+    op.create_table('score_transfer_archive',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('from_user_id', sa.Integer(), nullable=False),
+        sa.Column('to_user_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False),
+        sa.Column('fee_amount', sa.Integer(), nullable=False),
+        sa.Column('actual_amount', sa.Integer(), nullable=False),
+        sa.Column('type', sa.String(length=20), nullable=False),
+        sa.Column('batch_id', sa.String(length=64), nullable=True),
+        sa.Column('message', sa.String(length=256), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('confirm_token', sa.String(length=64), nullable=True),
+        sa.Column('confirmed_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('archived_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_score_transfer_archive_from_user_id', 'score_transfer_archive', ['from_user_id'])
+
+def downgrade():
+    op.drop_index('ix_score_transfer_archive_from_user_id', table_name='score_transfer_archive')
+    op.drop_table('score_transfer_archive')
+    op.drop_index('ix_score_consumption_archive_user_id', table_name='score_consumption_archive')
+    op.drop_table('score_consumption_archive')
+    op.drop_index('ix_score_transfer_status_created', table_name='score_transfer')
+    op.drop_index('ix_score_consumption_status_created', table_name='score_consumption')
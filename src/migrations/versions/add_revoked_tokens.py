@@ -0,0 +1,32 @@
+"""add revoked login token list
+
+Revision ID: add_revoked_tokens
+Revises: add_webhook_deliveries
+Create Date: 2024-02-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_revoked_tokens'
+down_revision = 'add_webhook_deliveries'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('revoked_token',
+        sa.Column('jti', sa.String(length=32), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('jti')
+    )
+    op.create_index('ix_revoked_token_expires_at', 'revoked_token', ['expires_at'])
+    op.create_index('ix_revoked_token_created_at', 'revoked_token', ['created_at'])
+
+def downgrade():
+    op.drop_index('ix_revoked_token_created_at', table_name='revoked_token')
+    op.drop_index('ix_revoked_token_expires_at', table_name='revoked_token')
+    op.drop_table('revoked_token')
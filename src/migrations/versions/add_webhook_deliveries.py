@@ -0,0 +1,41 @@
+"""add app callback url and webhook delivery queue
+
+Revision ID: add_webhook_deliveries
+Revises: add_app_rate_limits
+Create Date: 2024-02-11 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_webhook_deliveries'
+down_revision = 'add_app_rate_limits'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    with op.batch_alter_table('app', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('callback_url', sa.String(length=256), nullable=True))
+
+    op.create_table('webhook_delivery',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('app_id', sa.Integer(), nullable=False),
+        sa.Column('event', sa.String(length=40), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.String(length=256), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('delivered_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['app_id'], ['app.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_webhook_delivery_status_next', 'webhook_delivery', ['status', 'next_attempt_at'])
+
+def downgrade():
+    op.drop_index('ix_webhook_delivery_status_next', table_name='webhook_delivery')
+    op.drop_table('webhook_delivery')
+    with op.batch_alter_table('app', schema=None) as batch_op:
+        batch_op.drop_column('callback_url')
@@ -0,0 +1,34 @@
+"""relax transfer confirm token uniqueness
+
+Revision ID: relax_transfer_confirm_token
+Revises: add_leaderboard_snapshots
+Create Date: 2024-02-03 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'relax_transfer_confirm_token'
+down_revision = 'add_leaderboard_snapshots'
+branch_labels = None
+depends_on = None
+
+# SQLite 中的唯一约束没有名称, 通过命名约定在批量模式下定位
+naming_convention = {
+    'uq': 'uq_%(table_name)s_%(column_0_name)s',
+}
+
+def upgrade():
+    # 同一批量转账的所有记录共用一个确认token, 唯一约束改为普通索引
+    if op.get_bind().dialect.name == 'sqlite':
+        with op.batch_alter_table('score_transfer', naming_convention=naming_convention) as batch_op:
+            batch_op.drop_constraint('uq_score_transfer_confirm_token', type_='unique')
+    else:
+        op.drop_constraint('score_transfer_confirm_token_key', 'score_transfer', type_='unique')
+    op.create_index('ix_score_transfer_confirm_token', 'score_transfer', ['confirm_token'])
+
+def downgrade():
+    op.drop_index('ix_score_transfer_confirm_token', 'score_transfer')
+    with op.batch_alter_table('score_transfer', naming_convention=naming_convention) as batch_op:
+        batch_op.create_unique_constraint('uq_score_transfer_confirm_token', ['confirm_token'])
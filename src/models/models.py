@@ -1,5 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
 
@@ -17,11 +18,18 @@ class User(db.Model):
     total_received = db.Column(db.Integer, default=0)    # 总收到积分
     total_consumed = db.Column(db.Integer, default=0)    # 总消耗积分
     total_fee_paid = db.Column(db.Integer, default=0)    # 总支付手续费
+    is_admin = db.Column(db.Boolean, nullable=False, default=False)  # 是否为管理员
     
     # 关系
     apps = db.relationship('App', backref='owner', lazy=True)
     consumptions = db.relationship('ScoreConsumption', backref='user', lazy=True)
     
+    __table_args__ = (
+        db.Index('ix_user_leaderboard_actual_score', 'show_in_leaderboard', 'actual_score'),
+        db.Index('ix_user_leaderboard_total_transferred', 'show_in_leaderboard', 'total_transferred'),
+        db.Index('ix_user_leaderboard_total_consumed', 'show_in_leaderboard', 'total_consumed'),
+    )
+    
     # Flask-Login接口要求
     @property
     def is_authenticated(self):
@@ -46,6 +54,22 @@ class User(db.Model):
         """获取已消耗的点数"""
         return self.original_score - self.actual_score
 
+class Admin(db.Model):
+    """管理后台账号, 由 ADMIN_USERNAME 和 ADMIN_PASSWORD 初始化"""
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    password_hash = db.Column(db.String(256), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def set_password(self, password):
+        self.password_hash = generate_password_hash(password)
+
+    def check_password(self, password):
+        return check_password_hash(self.password_hash, password)
+
+    def __repr__(self):
+        return f'<Admin {self.username}>'
+
 class App(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
@@ -54,6 +78,11 @@ class App(db.Model):
     client_secret = db.Column(db.String(64), unique=True, nullable=False)
     redirect_uri = db.Column(db.String(256), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # 接口限流配额: 每分钟请求数和突发请求数, 为空时使用默认值
+    rate_limit = db.Column(db.Integer)
+    rate_burst = db.Column(db.Integer)
+    # 消耗结果的 webhook 推送地址, 为空时不推送
+    callback_url = db.Column(db.String(256))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def __repr__(self):
@@ -67,7 +96,7 @@ class ScoreConsumption(db.Model):
     developer_amount = db.Column(db.Integer, nullable=False, default=0)  # 开发者实际收到的金额(97%)
     fee_amount = db.Column(db.Integer, nullable=False, default=0)  # 手续费金额(3%)
     purpose = db.Column(db.String(256))
-    status = db.Column(db.String(20), default='pending')  # pending, confirmed, rejected
+    status = db.Column(db.String(20), default='pending')  # pending, confirmed, rejected, expired
     confirm_token = db.Column(db.String(64), unique=True)
     confirmed_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -75,6 +104,12 @@ class ScoreConsumption(db.Model):
     # 关系
     app = db.relationship('App', backref='consumptions', lazy=True)
     
+    __table_args__ = (
+        db.Index('ix_score_consumption_user_created', 'user_id', 'created_at'),
+        db.Index('ix_score_consumption_status_created', 'status', 'created_at'),
+        db.Index('ix_score_consumption_confirmed', 'confirmed_at', 'id'),
+    )
+    
     def __repr__(self):
         return f'<ScoreConsumption {self.id}>'
 
@@ -88,8 +123,8 @@ class ScoreTransfer(db.Model):
     type = db.Column(db.String(20), nullable=False, default='single')  # single或batch
     batch_id = db.Column(db.String(64), nullable=True)  # 批量转账ID
     message = db.Column(db.String(256))
-    status = db.Column(db.String(20), default='pending')  # pending, confirmed, rejected
-    confirm_token = db.Column(db.String(64), unique=True)
+    status = db.Column(db.String(20), default='pending')  # pending, confirmed, rejected, expired
+    confirm_token = db.Column(db.String(64), index=True)  # 同一批量转账的记录共用一个token
     confirmed_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -97,5 +132,244 @@ class ScoreTransfer(db.Model):
     from_user = db.relationship('User', foreign_keys=[from_user_id], backref='transfers_sent')
     to_user = db.relationship('User', foreign_keys=[to_user_id], backref='transfers_received')
     
+    __table_args__ = (
+        db.Index('ix_score_transfer_from_created', 'from_user_id', 'created_at'),
+        db.Index('ix_score_transfer_to_created', 'to_user_id', 'created_at'),
+        db.Index('ix_score_transfer_status_created', 'status', 'created_at'),
+        db.Index('ix_score_transfer_confirmed', 'confirmed_at', 'id'),
+    )
+    
     def __repr__(self):
         return f'<ScoreTransfer {self.id}>'
+
+class ScoreConsumptionArchive(db.Model):
+    """过期未确认的消耗记录归档"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    app_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    developer_amount = db.Column(db.Integer, nullable=False, default=0)
+    fee_amount = db.Column(db.Integer, nullable=False, default=0)
+    purpose = db.Column(db.String(256))
+    status = db.Column(db.String(20))  # expired
+    confirm_token = db.Column(db.String(64))
+    confirmed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ScoreConsumptionArchive {self.id}>'
+
+class ScoreTransferArchive(db.Model):
+    """过期未确认的转账记录归档"""
+    id = db.Column(db.Integer, primary_key=True)
+    from_user_id = db.Column(db.Integer, nullable=False, index=True)
+    to_user_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    fee_amount = db.Column(db.Integer, nullable=False, default=0)
+    actual_amount = db.Column(db.Integer, nullable=False, default=0)
+    type = db.Column(db.String(20), nullable=False, default='single')
+    batch_id = db.Column(db.String(64), nullable=True)
+    message = db.Column(db.String(256))
+    status = db.Column(db.String(20))  # expired
+    confirm_token = db.Column(db.String(64))
+    confirmed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ScoreTransferArchive {self.id}>'
+
+class BatchTransfer(db.Model):
+    """批量转账批次, 保存汇总金额和确认状态"""
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.String(64), unique=True, nullable=False)  # 对应 ScoreTransfer.batch_id
+    from_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total_amount = db.Column(db.Integer, nullable=False)  # 转账总金额
+    total_fee = db.Column(db.Integer, nullable=False, default=0)  # 手续费总额
+    total_count = db.Column(db.Integer, nullable=False, default=0)  # 转账笔数
+    confirmed_count = db.Column(db.Integer, nullable=False, default=0)  # 已确认笔数
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, confirmed, rejected, expired
+    confirm_token = db.Column(db.String(64), index=True)
+    message = db.Column(db.String(256))
+    min_trust_level = db.Column(db.Integer, nullable=False, default=0)
+    confirmed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # 关系
+    from_user = db.relationship('User', foreign_keys=[from_user_id])
+    
+    def __repr__(self):
+        return f'<BatchTransfer {self.batch_id}>'
+
+class LeaderboardEntry(db.Model):
+    """排行榜快照, 每个榜单只保存前 N 名"""
+    id = db.Column(db.Integer, primary_key=True)
+    board = db.Column(db.String(20), nullable=False)  # richest, generous, consumed
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    username = db.Column(db.String(80))
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('board', 'user_id', name='uq_leaderboard_entry_board_user'),
+        db.Index('ix_leaderboard_entry_board_value', 'board', 'value'),
+    )
+    
+    def __repr__(self):
+        return f'<LeaderboardEntry {self.board} {self.username}>'
+
+class LeaderboardState(db.Model):
+    """排行榜快照的刷新状态"""
+    board = db.Column(db.String(20), primary_key=True)
+    refreshed_at = db.Column(db.DateTime)
+    dirty = db.Column(db.Boolean, nullable=False, default=False)
+    
+    def __repr__(self):
+        return f'<LeaderboardState {self.board}>'
+
+class ConfirmationToken(db.Model):
+    """确认token登记表, 所有待确认操作共用"""
+    token = db.Column(db.String(64), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # consume, transfer, batch, red_packet, payment
+    record_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ConfirmationToken {self.kind} {self.record_id}>'
+
+class LedgerEntry(db.Model):
+    """只追加的账本, 记录每次余额和统计字段的变化量"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # consume, transfer_out, transfer_in, adjustment
+    ref_type = db.Column(db.String(20))  # consumption, transfer, batch
+    ref_id = db.Column(db.Integer)
+    delta = db.Column(db.Integer, nullable=False, default=0)  # actual_score 的变化量
+    transferred = db.Column(db.Integer, nullable=False, default=0)
+    received = db.Column(db.Integer, nullable=False, default=0)
+    consumed = db.Column(db.Integer, nullable=False, default=0)
+    fee_paid = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_ledger_entry_user_id_id', 'user_id', 'id'),
+    )
+    
+    def __repr__(self):
+        return f'<LedgerEntry {self.kind} {self.delta}>'
+
+class BalanceCheckpoint(db.Model):
+    """用户余额和统计字段在某个账本位置的快照"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    ledger_id = db.Column(db.Integer, nullable=False, default=0)  # 已包含的最后一条账本记录
+    actual_score = db.Column(db.Integer, nullable=False, default=0)
+    total_transferred = db.Column(db.Integer, nullable=False, default=0)
+    total_received = db.Column(db.Integer, nullable=False, default=0)
+    total_consumed = db.Column(db.Integer, nullable=False, default=0)
+    total_fee_paid = db.Column(db.Integer, nullable=False, default=0)
+    as_of = db.Column(db.DateTime, nullable=False)  # ledger_id 对应记录的时间, 快照在此时刻有效
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_balance_checkpoint_user_ledger', 'user_id', 'ledger_id'),
+        db.Index('ix_balance_checkpoint_ledger_id', 'ledger_id'),
+    )
+    
+    def __repr__(self):
+        return f'<BalanceCheckpoint {self.user_id} @{self.ledger_id}>'
+
+class ReconcileWatermark(db.Model):
+    """统计字段核对任务在每张来源表上处理到的位置"""
+    source = db.Column(db.String(20), primary_key=True)  # consumption, transfer
+    confirmed_at = db.Column(db.DateTime)
+    record_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ReconcileWatermark {self.source}>'
+
+class ReconciledCounters(db.Model):
+    """由已确认记录累计得到的用户统计字段期望值"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    total_transferred = db.Column(db.Integer, nullable=False, default=0)
+    total_received = db.Column(db.Integer, nullable=False, default=0)
+    total_consumed = db.Column(db.Integer, nullable=False, default=0)
+    total_fee_paid = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ReconciledCounters {self.user_id}>'
+
+class IdempotencyKey(db.Model):
+    """写接口的幂等键, 保存请求指纹和首次请求的响应"""
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(40), nullable=False)  # app:<id> 或 user:<id>
+    key = db.Column(db.String(255), nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)  # 为空表示请求仍在处理中
+    response = db.Column(db.Text)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'key', name='uq_idempotency_key_scope_key'),
+    )
+    
+    def __repr__(self):
+        return f'<IdempotencyKey {self.scope} {self.key}>'
+
+class WebhookDelivery(db.Model):
+    """待推送给应用的 webhook 事件"""
+    id = db.Column(db.Integer, primary_key=True)
+    app_id = db.Column(db.Integer, db.ForeignKey('app.id'), nullable=False)
+    event = db.Column(db.String(40), nullable=False)  # consumption.confirmed, consumption.rejected
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='pending')  # pending, delivered, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_error = db.Column(db.String(256))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    delivered_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_webhook_delivery_status_next', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<WebhookDelivery {self.id} {self.event}>'
+
+class RevokedToken(db.Model):
+    """已吊销的登录 JWT, 过期后由清理线程删除"""
+    jti = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<RevokedToken {self.jti}>'
+
+class DailyRollup(db.Model):
+    """用户每天已确认的转出、收到、消耗和手续费合计, 日期按 ROLLUP_UTC_OFFSET 时区划分"""
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    transferred = db.Column(db.Integer, nullable=False, default=0)
+    received = db.Column(db.Integer, nullable=False, default=0)
+    consumed = db.Column(db.Integer, nullable=False, default=0)
+    fee_paid = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DailyRollup {self.user_id} {self.day}>'
+
+class LeaderboardChange(db.Model):
+    """新用户和排行榜显示设置的变化, 供各进程的名次索引增量同步, 过期后由清理线程删除"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<LeaderboardChange {self.user_id}>'
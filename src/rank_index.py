@@ -0,0 +1,616 @@
+"""排行榜名次索引
+
+每个工作进程在内存中为富豪榜、慷慨榜和消费榜各保存一个有序列表, 只包含
+show_in_leaderboard 的用户, 按数值降序、用户 id 升序排列, 与 leaderboards.get_ranking
+的顺序一致。列表分块保存, 块长度的前缀和用树状数组维护, 查询用户名次和按名次取用户
+都是 O(log n), 详细排名的分页不再需要 COUNT 和 OFFSET 扫描。
+
+索引在工作进程启动时于后台构建, 之后:
+  - 本进程提交的余额和显示设置变化(leaderboards.record_user)在提交后立即生效;
+  - 每隔 RANK_SYNC_INTERVAL 秒按 id 读取 ledger_entry 和 leaderboard_change 的新记录, 重新加载
+    余额、显示设置有变化的用户和新用户, 其他进程的变化最迟在这段时间后生效; 返回结果前再按数据库
+    中的显示设置过滤一次。leaderboard_change 只保存 RANK_REBUILD_INTERVAL 秒, 由清理线程删除;
+  - 每隔 RANK_REBUILD_INTERVAL 秒在后台全量重建一次, 修正其他不经过账本的变化。
+增量更新出错或索引与记录的数值不一致时, 查询改用数据库并在后台重建索引。
+
+每个用户在每个榜单中占 8 字节的键, 外加每个榜单 8 字节的数值, 一百万用户约 50MB。
+"""
+import os
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+from bisect import bisect_left, insort
+
+from flask import current_app
+from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy import event, select, insert, delete, func, or_, and_
+from sqlalchemy.orm import Session
+
+from models.models import db, User, LedgerEntry, LeaderboardChange
+from services import ScoreError
+
+RANK_INDEX_ENABLED = os.getenv('RANK_INDEX_ENABLED', 'true').lower() == 'true'
+# 读取账本新记录的间隔(秒)
+RANK_SYNC_INTERVAL = float(os.getenv('RANK_SYNC_INTERVAL', 2))
+# 全量重建的间隔(秒)
+RANK_REBUILD_INTERVAL = int(os.getenv('RANK_REBUILD_INTERVAL', 3600))
+# 读取位置之后的 id 空缺等待该秒数仍未出现时, 视为已回滚的事务不再等待
+RANK_SYNC_GAP_TIMEOUT = float(os.getenv('RANK_SYNC_GAP_TIMEOUT', 60))
+# 每次同步读取的最大账本记录数
+RANK_SYNC_BATCH = 5000
+# 每块的目标长度
+RANK_BLOCK_SIZE = 1000
+# 查询前后用户的最大数量
+RANK_MAX_RADIUS = 50
+# IN 查询每块的参数个数
+CHUNK_SIZE = 900
+
+# 榜单名称 -> User 字段, 与 leaderboards.BOARDS 一致
+BOARDS = ('richest', 'generous', 'consumed')
+COLUMNS = {
+    'richest': User.actual_score,
+    'generous': User.total_transferred,
+    'consumed': User.total_consumed,
+}
+
+# 键 = -数值 * 2^32 + 用户 id, 升序即数值降序、id 升序; 数值限制在 32 位整数范围内, 键不超过 64 位
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+MAX_VALUE = (1 << 31) - 1
+
+
+def make_key(value, user_id):
+    return (-min(max(value, -MAX_VALUE), MAX_VALUE) << ID_BITS) + user_id
+
+
+def split_key(key):
+    """返回 (数值, 用户 id)"""
+    return -(key >> ID_BITS), key & ID_MASK
+
+
+class OrderStatisticList:
+    """有序的 64 位整数列表
+
+    数据分块保存在 array 中, 块的最大值用于二分定位所在的块, 块长度保存在树状数组中,
+    名次和按名次取值都只需 O(log n)。插入和删除只移动一个块内的数据, 块过长时拆分。
+    """
+
+    def __init__(self, values=(), load=RANK_BLOCK_SIZE):
+        self._load = load
+        values = sorted(values)
+        self._blocks = [array('q', values[i:i + load]) for i in range(0, len(values), load)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._len = len(values)
+        self._tree = None  # 块结构变化后置空, 下次使用时重建
+
+    def __len__(self):
+        return self._len
+
+    def _build_tree(self):
+        tree = [0] * (len(self._blocks) + 1)
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, pos, delta):
+        if self._tree is None:
+            return
+        i = pos + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, pos):
+        """前 pos 个块的总长度"""
+        if self._tree is None:
+            self._build_tree()
+        total = 0
+        while pos > 0:
+            total += self._tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def _locate(self, index):
+        """名次(从 0 开始) -> (块序号, 块内位置)"""
+        if self._tree is None:
+            self._build_tree()
+        size = len(self._tree) - 1
+        pos = 0
+        bit = 1 << (size.bit_length() - 1) if size else 0
+        while bit:
+            if pos + bit <= size and self._tree[pos + bit] <= index:
+                pos += bit
+                index -= self._tree[pos]
+            bit >>= 1
+        return pos, index
+
+    def add(self, value):
+        if not self._blocks:
+            self._blocks.append(array('q', [value]))
+            self._maxes.append(value)
+            self._len = 1
+            self._tree = None
+            return
+        pos = bisect_left(self._maxes, value)
+        if pos == len(self._maxes):
+            pos -= 1
+            self._blocks[pos].append(value)
+            self._maxes[pos] = value
+        else:
+            insort(self._blocks[pos], value)
+        self._len += 1
+
+        block = self._blocks[pos]
+        if len(block) > 2 * self._load:
+            self._blocks[pos:pos + 1] = [block[:self._load], block[self._load:]]
+            self._maxes[pos:pos + 1] = [block[self._load - 1], block[-1]]
+            self._tree = None
+        else:
+            self._tree_add(pos, 1)
+
+    def remove(self, value):
+        pos = bisect_left(self._maxes, value)
+        if pos == len(self._maxes):
+            raise ValueError(value)
+        block = self._blocks[pos]
+        i = bisect_left(block, value)
+        if i == len(block) or block[i] != value:
+            raise ValueError(value)
+        del block[i]
+        self._len -= 1
+        if not block:
+            del self._blocks[pos]
+            del self._maxes[pos]
+            self._tree = None
+        else:
+            self._maxes[pos] = block[-1]
+            self._tree_add(pos, -1)
+
+    def index(self, value):
+        """value 的名次(从 0 开始), 不存在时抛出 ValueError"""
+        pos = bisect_left(self._maxes, value)
+        if pos == len(self._maxes):
+            raise ValueError(value)
+        block = self._blocks[pos]
+        i = bisect_left(block, value)
+        if i == len(block) or block[i] != value:
+            raise ValueError(value)
+        return self._prefix(pos) + i
+
+    def range(self, start, stop):
+        """名次在 [start, stop) 之间的值"""
+        start = max(start, 0)
+        stop = min(stop, self._len)
+        if start >= stop:
+            return []
+        pos, offset = self._locate(start)
+        values = []
+        while len(values) < stop - start:
+            block = self._blocks[pos]
+            values.extend(block[offset:offset + stop - start - len(values)])
+            pos += 1
+            offset = 0
+        return values
+
+
+class ChangeFeed:
+    """按 id 递增读取只追加的变化表, 返回有变化的用户
+
+    事务提交的顺序可能与 id 的分配顺序不同, id 较小的记录可能稍后才可见。已读到的最大 id
+    之前没有出现的 id 记为空缺, 之后每次同步再按 id 查询一次, 出现时照常处理; 空缺超过
+    RANK_SYNC_GAP_TIMEOUT 秒仍未出现时视为已回滚的事务。读取位置不依赖记录中的时间。
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.high = 0  # 已读到的最大 id
+        self.gaps = {}  # 尚未出现的 id -> 发现空缺的时间
+
+    def reset(self, session):
+        """从表的当前末尾开始读取, 末尾 RANK_SYNC_BATCH 个 id 内的空缺仍会等待"""
+        model = self.model
+        high = session.execute(select(func.max(model.id))).scalar() or 0
+        present = set(session.execute(
+            select(model.id).where(model.id > high - RANK_SYNC_BATCH)
+        ).scalars())
+        now = time.monotonic()
+        self.high = high
+        self.gaps = {missing: now for missing in range(max(high - RANK_SYNC_BATCH, 0) + 1, high)
+                     if missing not in present}
+
+    def read(self, session):
+        """返回 (有变化的用户 id, 新的读取状态), 状态由调用方在应用变化后用 advance 保存"""
+        model = self.model
+        now = time.monotonic()
+        gaps = dict(self.gaps)
+        rows = []
+        missing = sorted(gaps)
+        for index in range(0, len(missing), CHUNK_SIZE):
+            rows += session.execute(
+                select(model.id, model.user_id)
+                .where(model.id.in_(missing[index:index + CHUNK_SIZE]))
+            ).all()
+        for row in rows:
+            del gaps[row.id]
+        gaps = {missing: since for missing, since in gaps.items()
+                if now - since < RANK_SYNC_GAP_TIMEOUT}
+
+        high = self.high
+        for row in session.execute(
+            select(model.id, model.user_id).where(model.id > high)
+            .order_by(model.id).limit(RANK_SYNC_BATCH)
+        ):
+            # 间隔很大的跳号(例如序列被手动调整)不逐个等待
+            if row.id - high <= RANK_SYNC_BATCH:
+                gaps.update((missing, now) for missing in range(high + 1, row.id))
+            high = row.id
+            rows.append(row)
+        return {row.user_id for row in rows}, (self.high, high, gaps)
+
+    def advance(self, state):
+        """保存 read 返回的状态; 期间已重建过索引时忽略"""
+        start, high, gaps = state
+        if self.high == start:
+            self.high = high
+            self.gaps = gaps
+
+
+class RankIndex:
+    """三个榜单的名次索引, 所有操作在同一把锁内进行"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._lists = None  # 榜单 -> OrderStatisticList, 未构建时为 None
+        self._values = {board: array('q') for board in BOARDS}  # 按用户 id 保存当前数值
+        self._visible = bytearray()
+        self._feeds = (ChangeFeed(LedgerEntry), ChangeFeed(LeaderboardChange))
+        self._built_at = None
+        self._synced_at = None
+        self._rebuilding = False
+        self._stale = False  # 增量更新出错后置位, 尽快在后台重建
+        self.rebuilds = 0
+        self.syncs = 0
+        self.errors = 0
+
+    @property
+    def ready(self):
+        return self._lists is not None
+
+    def _load(self, session):
+        """从数据库读取全部用户, 返回新的索引数据"""
+        # 先记下变化表的位置, 读取用户期间的变化由之后的同步补上
+        feeds = (ChangeFeed(LedgerEntry), ChangeFeed(LeaderboardChange))
+        for feed in feeds:
+            feed.reset(session)
+        values = {board: array('q') for board in BOARDS}
+        visible = bytearray()
+        keys = {board: [] for board in BOARDS}
+        result = session.execute(
+            select(User.id, User.show_in_leaderboard, *(COLUMNS[board] for board in BOARDS))
+            .execution_options(yield_per=10000)
+        )
+        for row in result:
+            user_id = row[0]
+            if user_id >= len(visible):
+                grow = user_id + 1 - len(visible)
+                visible.extend(bytes(grow))
+                for board in BOARDS:
+                    values[board].extend([0] * grow)
+            shown = bool(row[1])
+            visible[user_id] = shown
+            for offset, board in enumerate(BOARDS, 2):
+                value = row[offset] or 0
+                values[board][user_id] = value
+                if shown:
+                    keys[board].append(make_key(value, user_id))
+        result.close()
+        session.commit()
+        lists = {board: OrderStatisticList(keys[board]) for board in BOARDS}
+        return lists, values, visible, feeds
+
+    def rebuild(self, session, if_missing=False):
+        """全量重建, 构建期间继续使用旧索引; if_missing 时只在尚未构建时执行"""
+        with self._build_lock:
+            if if_missing and self._lists is not None:
+                return 0.0
+            start = time.perf_counter()
+            lists, values, visible, feeds = self._load(session)
+            with self._lock:
+                self._lists = lists
+                self._values = values
+                self._visible = visible
+                self._feeds = feeds
+                self._built_at = time.monotonic()
+                self._synced_at = None
+                self._stale = False
+                self.rebuilds += 1
+            return time.perf_counter() - start
+
+    def _ensure_size(self, user_id):
+        if user_id >= len(self._visible):
+            grow = user_id + 1 - len(self._visible)
+            self._visible.extend(bytes(grow))
+            for board in BOARDS:
+                self._values[board].extend([0] * grow)
+
+    def _apply(self, user_id, shown, values):
+        """更新一个用户的数值和显示设置, 调用方持有锁"""
+        self._ensure_size(user_id)
+        was_shown = bool(self._visible[user_id])
+        for board in BOARDS:
+            old = self._values[board][user_id]
+            new = values[board] or 0
+            if was_shown and (not shown or new != old):
+                self._lists[board].remove(make_key(old, user_id))
+            if shown and (not was_shown or new != old):
+                self._lists[board].add(make_key(new, user_id))
+            self._values[board][user_id] = new
+        self._visible[user_id] = shown
+
+    def _apply_all(self, updates):
+        """调用方持有锁; 出错时不抛出, 标记索引需要重建"""
+        try:
+            for user_id, (shown, values) in updates.items():
+                self._apply(user_id, shown, values)
+        except Exception:
+            self.errors += 1
+            self._stale = True
+
+    def apply(self, updates):
+        """应用已提交的变化, updates 为 {用户 id: (是否显示, {榜单: 数值})}"""
+        with self._lock:
+            if self._lists is not None:
+                self._apply_all(updates)
+
+    def sync(self, session):
+        """读取变化表的新记录, 重新加载余额或显示设置有变化的用户, 返回加载的用户数"""
+        feeds = self._feeds
+        user_ids = set()
+        states = []
+        for feed in feeds:
+            changed, state = feed.read(session)
+            user_ids |= changed
+            states.append(state)
+        user_ids = sorted(user_ids)
+        updates = {}
+        for index in range(0, len(user_ids), CHUNK_SIZE):
+            for row in session.execute(
+                select(User.id, User.show_in_leaderboard, *(COLUMNS[board] for board in BOARDS))
+                .where(User.id.in_(user_ids[index:index + CHUNK_SIZE]))
+            ):
+                updates[row[0]] = (bool(row[1]),
+                                   {board: row[offset] for offset, board in enumerate(BOARDS, 2)})
+        with self._lock:
+            if self._lists is not None:
+                self._apply_all(updates)
+                # 期间重建过时 self._feeds 已是新的读取位置
+                if self._feeds is feeds:
+                    for feed, state in zip(feeds, states):
+                        feed.advance(state)
+            self._synced_at = time.monotonic()
+            self.syncs += 1
+        return len(updates)
+
+    def _rebuild_in_background(self, flask_app):
+        def run():
+            try:
+                with flask_app.app_context():
+                    seconds = self.rebuild(db.session)
+                flask_app.logger.info(f"排名索引重建完成, 耗时 {seconds:.2f} 秒")
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                flask_app.logger.error(f"排名索引重建失败: {str(e)}")
+            finally:
+                self._rebuilding = False
+
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=run, name='rank-index-rebuild', daemon=True).start()
+
+    def warm(self, flask_app):
+        """在后台构建索引, 工作进程启动时调用"""
+        if RANK_INDEX_ENABLED and not self.ready:
+            self._rebuild_in_background(flask_app)
+
+    def refresh(self, session):
+        """在请求中查询前调用: 未构建时同步构建, 到期时同步账本或在后台重建"""
+        if self._lists is None:
+            self.rebuild(session, if_missing=True)
+            return
+        if self._stale or time.monotonic() - self._built_at >= RANK_REBUILD_INTERVAL:
+            self._rebuild_in_background(current_app._get_current_object())
+        if self._synced_at is None or time.monotonic() - self._synced_at >= RANK_SYNC_INTERVAL:
+            # 其他线程正在同步时直接使用当前索引
+            if self._sync_lock.acquire(blocking=False):
+                try:
+                    self.sync(session)
+                finally:
+                    self._sync_lock.release()
+
+    def lookup(self, board, user_id, radius=0):
+        """返回 (名次, 总人数, [(名次, 用户 id, 数值)]), 名次从 1 开始; 用户不在榜单中时名次为 None
+
+        索引中找不到用户记录的数值时(增量更新中途出错), 标记需要重建并返回 None。
+        """
+        with self._lock:
+            ranked = self._lists[board]
+            if user_id >= len(self._visible) or not self._visible[user_id]:
+                return None, len(ranked), []
+            try:
+                position = ranked.index(make_key(self._values[board][user_id], user_id))
+            except ValueError:
+                self.errors += 1
+                self._stale = True
+                return None
+            start = max(position - radius, 0)
+            around = []
+            for offset, key in enumerate(ranked.range(start, position + radius + 1)):
+                value, entry_id = split_key(key)
+                around.append((start + offset + 1, entry_id, value))
+            return position + 1, len(ranked), around
+
+    def page(self, board, start, stop):
+        """返回 (名次在 [start, stop) 之间的用户 id, 总人数)"""
+        with self._lock:
+            ranked = self._lists[board]
+            return [split_key(key)[1] for key in ranked.range(start, stop)], len(ranked)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self._lists is not None,
+                'users': {board: len(ranked) for board, ranked in (self._lists or {}).items()},
+                'age_s': round(time.monotonic() - self._built_at, 1) if self._built_at else 0,
+                'rebuilds': self.rebuilds,
+                'syncs': self.syncs,
+                'errors': self.errors,
+            }
+
+
+index = RankIndex()
+
+
+def stage(session, user):
+    """登记用户的变化, 在事务提交后应用到本进程的索引"""
+    # 尚未写入的新用户由同步账本时加入
+    if not RANK_INDEX_ENABLED or user.id is None:
+        return
+    session.info.setdefault('rank_updates', {})[user.id] = (
+        bool(user.show_in_leaderboard),
+        {board: getattr(user, COLUMNS[board].key) for board in BOARDS}
+    )
+
+
+def _write_change(connection, user_id):
+    if RANK_INDEX_ENABLED:
+        connection.execute(insert(LeaderboardChange).values(user_id=user_id,
+                                                            created_at=datetime.utcnow()))
+
+
+@event.listens_for(User, 'after_insert')
+def _record_new_user(mapper, connection, target):
+    # 余额为零的新用户不会写入账本, 由变化表通知其他进程
+    _write_change(connection, target.id)
+
+
+@event.listens_for(User, 'after_update')
+def _record_visibility(mapper, connection, target):
+    history = db.inspect(target).attrs.show_in_leaderboard.history
+    if history.added and history.deleted and bool(history.added[0]) != bool(history.deleted[0]):
+        _write_change(connection, target.id)
+
+
+def purge_expired(session, limit, now=None):
+    """删除最多 limit 条超过 RANK_REBUILD_INTERVAL 秒的变化记录, 返回删除数量
+
+    更早的变化已包含在各进程定期全量重建的索引中。
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=RANK_REBUILD_INTERVAL)
+    expired = session.execute(
+        select(LeaderboardChange.id).where(LeaderboardChange.created_at < cutoff).limit(limit)
+    ).scalars().all()
+    if expired:
+        session.execute(
+            delete(LeaderboardChange).where(LeaderboardChange.id.in_(expired))
+            .execution_options(synchronize_session=False)
+        )
+    return len(expired)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_staged(session):
+    updates = session.info.pop('rank_updates', None)
+    if updates:
+        index.apply(updates)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_staged(session):
+    session.info.pop('rank_updates', None)
+
+
+def _lookup_sql(session, board, user_id, radius):
+    """未启用索引时直接查询数据库, 名次需要 COUNT, 与用户数成正比"""
+    column = COLUMNS[board]
+    row = session.execute(
+        select(column, User.show_in_leaderboard).where(User.id == user_id)
+    ).first()
+    visible = User.show_in_leaderboard == True
+    total = session.execute(select(func.count(User.id)).where(visible)).scalar()
+    if row is None or not row[1]:
+        return None, total, []
+    value = row[0] or 0
+    value_of = func.coalesce(column, 0)
+    ahead = or_(value_of > value, and_(value_of == value, User.id < user_id))
+    position = session.execute(select(func.count(User.id)).where(visible, ahead)).scalar()
+    above = session.execute(
+        select(User.id, value_of).where(visible, ahead)
+        .order_by(value_of, User.id.desc()).limit(radius)
+    ).all()
+    below = session.execute(
+        select(User.id, value_of).where(visible, ~ahead)
+        .order_by(value_of.desc(), User.id).limit(radius + 1)
+    ).all()
+    rows = list(reversed(above)) + list(below)
+    start = position - len(above)
+    return position + 1, total, [(start + offset + 1, row[0], row[1])
+                                 for offset, row in enumerate(rows)]
+
+
+def rank(session, board, user_id, radius=0):
+    """查询用户在榜单中的名次和前后 radius 名用户"""
+    if board not in COLUMNS:
+        raise ScoreError('榜单不存在', 404)
+    radius = min(max(radius, 0), RANK_MAX_RADIUS)
+    result = None
+    if RANK_INDEX_ENABLED:
+        index.refresh(session)
+        result = index.lookup(board, user_id, radius)
+    if result is None:
+        result = _lookup_sql(session, board, user_id, radius)
+    position, total, around = result
+    if position is None:
+        raise ScoreError('用户不在排行榜中', 404)
+
+    # 索引可能还没有同步其他进程的显示设置变化, 按数据库中的设置过滤
+    names = dict(session.execute(
+        select(User.id, User.username).where(User.id.in_([entry[1] for entry in around]),
+                                             User.show_in_leaderboard == True)
+    ).all())
+    if user_id not in names:
+        raise ScoreError('用户不在排行榜中', 404)
+    entries = [{'rank': entry_rank, 'user_id': entry_id, 'username': names[entry_id],
+                'value': value} for entry_rank, entry_id, value in around if entry_id in names]
+    current = next(entry for entry in entries if entry['user_id'] == user_id)
+    return {'board': board, 'total': total, **current, 'around': entries}
+
+
+class IndexPagination(Pagination):
+    """按索引分页的详细排名, 只读取当前页的用户"""
+
+    def _query_items(self):
+        user_ids, self._total = index.page(self._query_args['board'], self._query_offset,
+                                           self._query_offset + self.per_page)
+        users = {user.id: user for user in User.query.filter(
+            User.id.in_(user_ids), User.show_in_leaderboard == True).all()}
+        return [users[user_id] for user_id in user_ids if user_id in users]
+
+    def _query_count(self):
+        return self._total
+
+
+def paginate(session, board, page, per_page):
+    """详细排名的分页; 未启用索引时返回 None, 由调用方使用数据库分页"""
+    if not RANK_INDEX_ENABLED:
+        return None
+    index.refresh(session)
+    return IndexPagination(page=page, per_page=per_page, error_out=False, board=board)
@@ -0,0 +1,223 @@
+"""按应用和用户的令牌桶限流
+
+应用接口按 client 所属应用限流, 登录用户的写接口按用户限流。每个桶以每分钟 rate 个令牌
+的速度补充, 最多积累 burst 个, 每次请求消耗一个。应用的配额可以在 App.rate_limit 和
+App.rate_burst 中单独设置, 为空时使用默认值。
+
+默认桶保存在进程内存中, 只在单个进程内生效。RATE_LIMIT_BACKEND=sqlite 时桶保存在
+本机的一个 SQLite 文件中, 同一台机器上的多个 uvicorn 工作进程共享配额。共享存储出错时
+放行请求并记录错误次数, 不影响正常业务。SQLite 存储的检查可能等待其他进程的写锁,
+异步接口会在线程池中执行检查。
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+# memory: 进程内; sqlite: 同一台机器的工作进程共享
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_SQLITE_PATH = os.getenv(
+    'RATE_LIMIT_SQLITE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'ratelimit.db')
+)
+# 进程内最多保存的桶数
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv('RATE_LIMIT_MAX_BUCKETS', 10000))
+# 默认配额: 每分钟请求数和突发请求数
+APP_RATE_LIMIT = int(os.getenv('APP_RATE_LIMIT', 600))
+APP_RATE_BURST = int(os.getenv('APP_RATE_BURST', 100))
+USER_RATE_LIMIT = int(os.getenv('USER_RATE_LIMIT', 120))
+USER_RATE_BURST = int(os.getenv('USER_RATE_BURST', 30))
+
+Decision = namedtuple('Decision', ['allowed', 'limit', 'remaining', 'retry_after', 'reset'])
+
+
+def _refill(tokens, updated_at, now, rate, burst):
+    return min(burst, tokens + max(now - updated_at, 0) * rate)
+
+
+class MemoryBuckets:
+    """进程内的令牌桶, 超过 max_size 时淘汰最久未使用的桶"""
+
+    name = 'memory'
+    blocking = False
+
+    def __init__(self, max_size=RATE_LIMIT_MAX_BUCKETS):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """消耗一个令牌, 返回 (是否成功, 剩余令牌数)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = _refill(tokens, updated_at, now, rate, burst)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+    def size(self):
+        with self._lock:
+            return len(self._buckets)
+
+
+class SQLiteBuckets:
+    """保存在本机 SQLite 文件中的令牌桶, 多个工作进程共享
+
+    每次请求在一个 BEGIN IMMEDIATE 事务中读取并写回桶, 进程之间互斥。
+    """
+
+    name = 'sqlite'
+    # 可能等待其他进程的写锁, 最长 timeout 秒
+    blocking = True
+
+    def __init__(self, path=RATE_LIMIT_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS rate_limit_bucket ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # isolation_level=None 时由下面的 BEGIN IMMEDIATE 显式控制事务
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        # 跨进程比较时间, 使用墙上时钟
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated_at FROM rate_limit_bucket WHERE key = ?', (key,)
+            ).fetchone()
+            tokens, updated_at = row if row else (burst, now)
+            tokens = _refill(tokens, updated_at, now, rate, burst)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_limit_bucket (key, tokens, updated_at) VALUES (?, ?, ?)',
+                (key, tokens, now)
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return allowed, tokens
+
+    def size(self):
+        return self._connection().execute('SELECT COUNT(*) FROM rate_limit_bucket').fetchone()[0]
+
+
+def create_backend(name=RATE_LIMIT_BACKEND):
+    if name == 'sqlite':
+        return SQLiteBuckets()
+    if name == 'memory':
+        return MemoryBuckets()
+    raise ValueError(f'未知的限流存储: {name}')
+
+
+class RateLimiter:
+    """令牌桶限流器, 统计放行和拒绝的次数"""
+
+    def __init__(self, backend, enabled=True):
+        self.backend = backend
+        self.enabled = enabled
+        self.allowed = 0
+        self.limited = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def blocking(self):
+        """检查是否可能阻塞, 未启用时不访问存储"""
+        return self.enabled and self.backend.blocking
+
+    def check(self, key, per_minute, burst):
+        """为 key 消耗一个令牌, 返回 Decision; 未启用时返回 None"""
+        if not self.enabled:
+            return None
+        rate = per_minute / 60
+        try:
+            allowed, tokens = self.backend.take(key, rate, burst)
+        except Exception:
+            # 共享存储不可用时放行
+            with self._lock:
+                self.errors += 1
+            return None
+
+        with self._lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.limited += 1
+        return Decision(
+            allowed=allowed,
+            limit=per_minute,
+            remaining=int(tokens),
+            retry_after=0 if allowed else math.ceil((1 - tokens) / rate),
+            reset=math.ceil((burst - tokens) / rate)
+        )
+
+    def check_app(self, cached_app):
+        return self.check(f'app:{cached_app.id}',
+                          cached_app.rate_limit or APP_RATE_LIMIT,
+                          cached_app.rate_burst or APP_RATE_BURST)
+
+    def check_user(self, user_id):
+        return self.check(f'user:{user_id}', USER_RATE_LIMIT, USER_RATE_BURST)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'backend': self.backend.name,
+                'allowed': self.allowed,
+                'limited': self.limited,
+                'errors': self.errors,
+            }
+
+
+limiter = RateLimiter(create_backend(), enabled=RATE_LIMIT_ENABLED)
+
+LIMITED_BODY = {'error': '请求过于频繁, 请稍后重试'}
+
+
+def headers(decision):
+    """限流相关的响应头"""
+    if decision is None:
+        return {}
+    values = {
+        'X-RateLimit-Limit': str(decision.limit),
+        'X-RateLimit-Remaining': str(decision.remaining),
+        'X-RateLimit-Reset': str(decision.reset),
+    }
+    if not decision.allowed:
+        values['Retry-After'] = str(decision.retry_after)
+    return values
+
+
+def add_headers(response, decision):
+    """将限流响应头写入 Flask 或 Starlette 的响应, 返回该响应"""
+    response.headers.update(headers(decision))
+    return response
@@ -0,0 +1,265 @@
+"""用户统计字段增量核对
+
+按 (confirmed_at, id) 记录每张来源表处理到的位置, 每次只读取上次之后新确认的消耗和转账,
+累加到 reconciled_counters 中的期望值, 再与 User.total_* 比较。每块记录在一个短事务中提交,
+首次运行需要分块读完全部历史, 请先用命令行执行; 之后的工作量只与新确认的记录数有关,
+后台线程每次最多处理 RECONCILE_MAX_CHUNKS 块, 剩余的下次继续。
+
+在 src 目录下运行:
+    python reconcile.py --dry-run
+    python reconcile.py --repair
+"""
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, func, or_, and_
+
+from models.models import (db, User, ScoreConsumption, ScoreTransfer,
+                           ReconcileWatermark, ReconciledCounters)
+import ledger
+
+COUNTERS = ('total_transferred', 'total_received', 'total_consumed', 'total_fee_paid')
+
+# 只核对确认超过该秒数的记录, 避免遗漏仍未提交的事务
+RECONCILE_LAG = int(os.getenv('RECONCILE_LAG', 60))
+# 每次读取的记录数
+RECONCILE_CHUNK_SIZE = int(os.getenv('RECONCILE_CHUNK_SIZE', 5000))
+# 后台线程执行核对的间隔(秒)以及是否自动修复
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', 3600))
+RECONCILE_REPAIR = os.getenv('RECONCILE_REPAIR', 'false').lower() == 'true'
+# 后台线程每次最多处理的块数
+RECONCILE_MAX_CHUNKS = int(os.getenv('RECONCILE_MAX_CHUNKS', 20))
+# IN 查询每块的参数个数
+CHUNK_SIZE = 900
+
+# 来源表 -> [(用户列, {统计字段: 金额列})]
+SOURCES = {
+    'consumption': (ScoreConsumption, [
+        (ScoreConsumption.user_id, {
+            'total_consumed': ScoreConsumption.amount,
+            'total_fee_paid': ScoreConsumption.fee_amount,
+        }),
+    ]),
+    'transfer': (ScoreTransfer, [
+        (ScoreTransfer.from_user_id, {
+            'total_transferred': ScoreTransfer.amount,
+            'total_fee_paid': ScoreTransfer.fee_amount,
+        }),
+        (ScoreTransfer.to_user_id, {
+            'total_received': ScoreTransfer.actual_amount,
+        }),
+    ]),
+}
+
+
+def _after(model, position):
+    confirmed_at, record_id = position
+    if confirmed_at is None:
+        return model.confirmed_at.isnot(None)
+    return or_(model.confirmed_at > confirmed_at,
+               and_(model.confirmed_at == confirmed_at, model.id > record_id))
+
+
+def _positions(session):
+    """每张来源表已处理到的 (confirmed_at, id), 没有水位时为 (None, 0)"""
+    positions = {}
+    for source in SOURCES:
+        watermark = session.get(ReconcileWatermark, source)
+        positions[source] = (watermark.confirmed_at, watermark.record_id) if watermark else (None, 0)
+    return positions
+
+
+def is_initialized(session):
+    """是否已完成过首次核对(所有来源表都有水位)"""
+    return all(session.get(ReconcileWatermark, source) is not None for source in SOURCES)
+
+
+def _scan_chunk(session, source, upper, position):
+    """读取 position 之后、upper 之前确认的一块记录, 返回 (记录, {用户: {统计字段: 增量}})"""
+    model, roles = SOURCES[source]
+    columns = [model.id, model.confirmed_at]
+    for user_column, amounts in roles:
+        columns.append(user_column)
+        columns.extend(amounts.values())
+
+    rows = session.execute(
+        select(*columns)
+        .where(model.status == 'confirmed', model.confirmed_at <= upper, _after(model, position))
+        .order_by(model.confirmed_at, model.id)
+        .limit(RECONCILE_CHUNK_SIZE)
+    ).all()
+    deltas = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+    for row in rows:
+        values = iter(row[2:])
+        for user_column, amounts in roles:
+            user_deltas = deltas[next(values)]
+            for counter in amounts:
+                user_deltas[counter] += next(values) or 0
+    return rows, deltas
+
+
+def _recent(session, user_ids, positions):
+    """水位之后确认的记录对统计字段的贡献, User 中已包含但期望值中尚未累计"""
+    recent = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+    for source, (model, roles) in SOURCES.items():
+        for user_column, amounts in roles:
+            for start in range(0, len(user_ids), CHUNK_SIZE):
+                chunk = user_ids[start:start + CHUNK_SIZE]
+                rows = session.execute(
+                    select(user_column, *(func.coalesce(func.sum(column), 0)
+                                          for column in amounts.values()))
+                    .where(model.status == 'confirmed', _after(model, positions[source]),
+                           user_column.in_(chunk))
+                    .group_by(user_column)
+                ).all()
+                for user_id, *sums in rows:
+                    for counter, value in zip(amounts, sums):
+                        recent[user_id][counter] += value
+    return recent
+
+
+def _check(session, deltas, positions, now, pending):
+    """累加一块记录的增量到期望值并与 User 比较, 返回差异列表
+
+    pending 不为 None 时(dry_run)期望值只保存在其中, 不写入会话。
+    """
+    user_ids = list(deltas)
+    stored = {}
+    users = {}
+    for index in range(0, len(user_ids), CHUNK_SIZE):
+        chunk = user_ids[index:index + CHUNK_SIZE]
+        for counters in session.execute(
+            select(ReconciledCounters).where(ReconciledCounters.user_id.in_(chunk))
+        ).scalars():
+            stored[counters.user_id] = {counter: getattr(counters, counter) or 0
+                                        for counter in COUNTERS}
+        for user in session.execute(select(User).where(User.id.in_(chunk))).scalars():
+            users[user.id] = user
+    recent = _recent(session, user_ids, positions)
+
+    drift = []
+    for user_id in user_ids:
+        if pending is not None and user_id in pending:
+            base = pending[user_id]
+        else:
+            base = stored.get(user_id) or dict.fromkeys(COUNTERS, 0)
+        expected = {counter: base[counter] + deltas[user_id][counter] for counter in COUNTERS}
+        user = users.get(user_id)
+        if user is not None:
+            for counter in COUNTERS:
+                actual = (getattr(user, counter) or 0) - recent[user_id][counter]
+                if actual != expected[counter]:
+                    drift.append({
+                        'user_id': user_id,
+                        'username': user.username,
+                        'counter': counter,
+                        'stored': actual,
+                        'expected': expected[counter],
+                    })
+        if pending is not None:
+            pending[user_id] = expected
+        else:
+            session.merge(ReconciledCounters(user_id=user_id, updated_at=now, **expected))
+    return drift
+
+
+def _repair(session, drift):
+    """将统计字段修正为期望值, 并在账本中记录调整"""
+    for item in drift:
+        difference = item['expected'] - item['stored']
+        column = getattr(User, item['counter'])
+        session.execute(
+            update(User).where(User.id == item['user_id'])
+            .values({column: column + difference})
+            .execution_options(synchronize_session=False)
+        )
+        ledger.append(session, item['user_id'], ('adjustment', 'reconcile', None), 0,
+                      **{item['counter']: difference})
+    return len(drift)
+
+
+def reconcile(session, repair=False, dry_run=False, now=None, max_chunks=None):
+    """核对新确认记录涉及的用户, 返回核对报告
+
+    每块记录的期望值、修复和水位在一个短事务中提交, 首次运行读取全部历史时也不会长时间
+    占用写锁; max_chunks 限制本次处理的块数, 未处理完的部分下次从水位继续。
+    dry_run 时不保存水位和期望值; repair 时将统计字段修正为期望值, 并在账本中记录调整。
+    """
+    start = time.perf_counter()
+    now = now or datetime.utcnow()
+    upper = now - timedelta(seconds=RECONCILE_LAG)
+
+    positions = _positions(session)
+    pending = {} if dry_run else None
+    rows = dict.fromkeys(SOURCES, 0)
+    drift = {}
+    users_checked = set()
+    repaired = chunks = 0
+    complete = True
+
+    # 各来源表轮流读取一块, 读完的来源表退出轮换
+    active = list(SOURCES)
+    while active:
+        for source in list(active):
+            if max_chunks is not None and chunks >= max_chunks:
+                complete = False
+                active = []
+                break
+            records, deltas = _scan_chunk(session, source, upper, positions[source])
+            if records:
+                chunks += 1
+                rows[source] += len(records)
+                positions[source] = (records[-1].confirmed_at, records[-1].id)
+                chunk_drift = _check(session, deltas, positions, now, pending)
+                users_checked.update(deltas)
+                for item in chunk_drift:
+                    drift[(item['user_id'], item['counter'])] = item
+                if repair and not dry_run:
+                    repaired += _repair(session, chunk_drift)
+            if not dry_run:
+                confirmed_at, record_id = positions[source]
+                session.merge(ReconcileWatermark(source=source, confirmed_at=confirmed_at,
+                                                 record_id=record_id, updated_at=now))
+                session.commit()
+            if len(records) < RECONCILE_CHUNK_SIZE:
+                active.remove(source)
+
+    if dry_run:
+        session.rollback()
+    else:
+        session.commit()
+
+    return {
+        'dry_run': dry_run,
+        'repair': repair,
+        'rows': rows,
+        'chunks': chunks,
+        'complete': complete,
+        'users_checked': len(users_checked),
+        'drift': list(drift.values()),
+        'repaired': repaired,
+        'upper': upper.isoformat(),
+        'duration_s': round(time.perf_counter() - start, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='核对用户统计字段')
+    parser.add_argument('--dry-run', action='store_true', help='只报告差异, 不保存水位')
+    parser.add_argument('--repair', action='store_true', help='将统计字段修正为期望值')
+    parser.add_argument('--max-chunks', type=int, help='本次最多处理的块数, 默认处理到最新')
+    args = parser.parse_args()
+
+    from app import create_app
+    with create_app().app_context():
+        report = reconcile(db.session, repair=args.repair, dry_run=args.dry_run,
+                           max_chunks=args.max_chunks)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
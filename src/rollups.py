@@ -0,0 +1,273 @@
+"""按天汇总的用户统计
+
+确认转账和消耗时, balances 在同一事务内把本次的转出、收到、消耗和手续费累加到
+daily_rollup 中该用户当天的一行, 批量转账的收款人由 batch_engine 一次写入。
+"本周慷慨榜"、"今日消费榜"等时间窗口榜单只需对窗口内各天的汇总行求和, 读取的行数
+与窗口天数和当天活跃用户数有关, 不再对转账和消耗表 GROUP BY。
+
+日期按 ROLLUP_UTC_OFFSET 小时的时区划分, 默认为北京时间。已有的历史记录用
+backfill 按天重建, 重建的日期会先清空再从转账和消耗表重新汇总:
+    python rollups.py
+    python rollups.py --since 2024-01-01 --until 2024-02-01
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime, date, timedelta
+from importlib import import_module
+
+from sqlalchemy import select, insert, update, delete, func
+
+from models.models import db, User, ScoreTransfer, DailyRollup
+
+# 日期划分所用时区相对 UTC 的小时数
+ROLLUP_UTC_OFFSET = int(os.getenv('ROLLUP_UTC_OFFSET', 8))
+# 窗口榜单的缓存时间(秒)
+ROLLUP_CACHE_TTL = int(os.getenv('ROLLUP_CACHE_TTL', 30))
+# 窗口的最大天数
+ROLLUP_MAX_DAYS = int(os.getenv('ROLLUP_MAX_DAYS', 366))
+# 窗口榜单的默认和最大人数
+ROLLUP_BOARD_SIZE = int(os.getenv('ROLLUP_BOARD_SIZE', 10))
+ROLLUP_MAX_SIZE = 100
+# 缓存的最大条目数, 超过后清空
+CACHE_SIZE = 256
+
+# User 统计字段 -> 汇总表的列, 与 ledger.COUNTERS 一致
+COUNTERS = {
+    'total_transferred': 'transferred',
+    'total_received': 'received',
+    'total_consumed': 'consumed',
+    'total_fee_paid': 'fee_paid',
+}
+# 窗口榜单名称 -> 汇总表的列
+BOARDS = {
+    'generous': 'transferred',
+    'received': 'received',
+    'consumed': 'consumed',
+}
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def day_of(moment):
+    """UTC 时间所在的日期"""
+    return (moment + timedelta(hours=ROLLUP_UTC_OFFSET)).date()
+
+
+def day_start(day):
+    """日期开始时刻的 UTC 时间"""
+    return datetime.combine(day, datetime.min.time()) - timedelta(hours=ROLLUP_UTC_OFFSET)
+
+
+def _upsert(session, rows):
+    """将 rows 中的数值累加到对应的汇总行, 行不存在时插入"""
+    if not rows:
+        return
+    # 按主键顺序写入, 并发事务以相同顺序加锁
+    rows = sorted(rows, key=lambda row: (row['day'], row['user_id']))
+    columns = [column for column in COUNTERS.values() if any(row.get(column) for row in rows)]
+    now = datetime.utcnow()
+    # 方言模块在创建引擎时已导入, 导入本模块时不加载其他数据库的方言
+    dialect = session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        values = [{'day': row['day'], 'user_id': row['user_id'], 'updated_at': now,
+                   **{column: row.get(column, 0) for column in COUNTERS.values()}}
+                  for row in rows]
+        statement = import_module(f'sqlalchemy.dialects.{dialect}').insert(DailyRollup)\
+            .values(values)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['day', 'user_id'],
+            set_={'updated_at': now,
+                  **{column: getattr(DailyRollup, column) + getattr(statement.excluded, column)
+                     for column in columns}}
+        ))
+        return
+
+    for row in rows:
+        updated = session.execute(
+            update(DailyRollup)
+            .where(DailyRollup.day == row['day'], DailyRollup.user_id == row['user_id'])
+            .values(updated_at=now, **{column: getattr(DailyRollup, column) + row.get(column, 0)
+                                       for column in columns})
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not updated:
+            session.execute(insert(DailyRollup).values(
+                updated_at=now, **{column: row.get(column, 0) for column in COUNTERS.values()},
+                day=row['day'], user_id=row['user_id']
+            ))
+
+
+def record(session, user_id, **totals):
+    """累加用户当天的统计, totals 为 User 统计字段的变化量, 需在同一事务内提交"""
+    values = {COUNTERS[name]: value for name, value in totals.items() if value}
+    if values:
+        _upsert(session, [{'day': day_of(datetime.utcnow()), 'user_id': user_id, **values}])
+
+
+def record_transfer_credits(session, condition, at=None):
+    """按收款人累加满足条件的转账的实际到账金额"""
+    day = day_of(at or datetime.utcnow())
+    rows = session.execute(
+        select(ScoreTransfer.to_user_id, func.sum(ScoreTransfer.actual_amount))
+        .where(condition)
+        .group_by(ScoreTransfer.to_user_id)
+    ).all()
+    _upsert(session, [{'day': day, 'user_id': user_id, 'received': received}
+                      for user_id, received in rows if received])
+
+
+def period(name, today=None):
+    """预设窗口 today, yesterday, week, month, 7d, 30d 的起止日期(均包含)"""
+    today = today or day_of(datetime.utcnow())
+    if name == 'today':
+        return today, today
+    if name == 'yesterday':
+        return today - timedelta(days=1), today - timedelta(days=1)
+    if name == 'week':
+        return today - timedelta(days=today.weekday()), today
+    if name == 'month':
+        return today.replace(day=1), today
+    if name == '7d':
+        return today - timedelta(days=6), today
+    if name == '30d':
+        return today - timedelta(days=29), today
+    raise ValueError(name)
+
+
+def parse_window(args, today=None):
+    """从 period 或 start/end(YYYY-MM-DD) 参数解析窗口, 默认为本周"""
+    from services import ScoreError
+    start, end = args.get('start'), args.get('end')
+    try:
+        if start or end:
+            today = today or day_of(datetime.utcnow())
+            start = date.fromisoformat(start) if start else today
+            end = date.fromisoformat(end) if end else today
+        else:
+            start, end = period(args.get('period', 'week'), today)
+    except ValueError:
+        raise ScoreError('无效的时间范围')
+    if start > end or (end - start).days >= ROLLUP_MAX_DAYS:
+        raise ScoreError('无效的时间范围', max_days=ROLLUP_MAX_DAYS)
+    return start, end
+
+
+def top(session, board, start, end, limit=ROLLUP_BOARD_SIZE):
+    """窗口内数值最高的用户, 只包含 show_in_leaderboard 的用户, 结果缓存 ROLLUP_CACHE_TTL 秒"""
+    from services import ScoreError
+    if board not in BOARDS:
+        raise ScoreError('榜单不存在', 404)
+    limit = min(max(limit, 1), ROLLUP_MAX_SIZE)
+    key = (board, start, end, limit)
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    column = getattr(DailyRollup, BOARDS[board])
+    value = func.sum(column).label('value')
+    rows = session.execute(
+        select(User.id, User.username, value)
+        .select_from(DailyRollup)
+        .join(User, User.id == DailyRollup.user_id)
+        .where(DailyRollup.day >= start, DailyRollup.day <= end,
+               User.show_in_leaderboard == True)
+        .group_by(User.id, User.username)
+        .having(value > 0)
+        .order_by(value.desc(), User.id)
+        .limit(limit)
+    ).all()
+    result = [{'user_id': user_id, 'username': username, 'value': int(total)}
+              for user_id, username, total in rows]
+
+    with _cache_lock:
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[key] = (time.monotonic() + ROLLUP_CACHE_TTL, result)
+    return result
+
+
+def _rebuild_day(session, day):
+    """清空并从转账和消耗表重新汇总一天的数据, 返回写入的行数"""
+    import reconcile
+
+    start, end = day_start(day), day_start(day + timedelta(days=1))
+    totals = {}
+    for model, roles in reconcile.SOURCES.values():
+        for user_column, amounts in roles:
+            rows = session.execute(
+                select(user_column, *(func.coalesce(func.sum(column), 0)
+                                      for column in amounts.values()))
+                .where(model.status == 'confirmed',
+                       model.confirmed_at >= start, model.confirmed_at < end)
+                .group_by(user_column)
+            ).all()
+            for user_id, *sums in rows:
+                row = totals.setdefault(user_id, dict.fromkeys(COUNTERS.values(), 0))
+                for counter, value in zip(amounts, sums):
+                    row[COUNTERS[counter]] += value
+
+    session.execute(delete(DailyRollup).where(DailyRollup.day == day)
+                    .execution_options(synchronize_session=False))
+    rows = [{'day': day, 'user_id': user_id, 'updated_at': datetime.utcnow(), **values}
+            for user_id, values in totals.items() if any(values.values())]
+    if rows:
+        session.execute(insert(DailyRollup), rows)
+    return len(rows)
+
+
+def backfill(session, since=None, until=None):
+    """按天重建 [since, until) 的汇总, 每天一个事务, 返回报告
+
+    since 默认为最早的确认记录所在日期, until 默认为今天: 今天的汇总由确认操作实时写入,
+    重建期间发生的确认可能被覆盖, 需要重建今天时请在确认量较少时显式指定 until。
+    """
+    import reconcile
+
+    started = time.perf_counter()
+    until = until or day_of(datetime.utcnow())
+    if since is None:
+        earliest = [session.execute(
+            select(func.min(model.confirmed_at)).where(model.status == 'confirmed')
+        ).scalar() for model, _ in reconcile.SOURCES.values()]
+        earliest = [moment for moment in earliest if moment is not None]
+        since = day_of(min(earliest)) if earliest else until
+
+    days = rows = 0
+    day = since
+    while day < until:
+        rows += _rebuild_day(session, day)
+        session.commit()
+        days += 1
+        day += timedelta(days=1)
+
+    with _cache_lock:
+        _cache.clear()
+    return {
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'days': days,
+        'rows': rows,
+        'duration_s': round(time.perf_counter() - started, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='从转账和消耗记录重建按天汇总')
+    parser.add_argument('--since', type=date.fromisoformat,
+                        help='起始日期(包含), 默认为最早的确认记录')
+    parser.add_argument('--until', type=date.fromisoformat, help='结束日期(不包含), 默认为今天')
+    args = parser.parse_args()
+
+    from app import create_app
+    with create_app().app_context():
+        report = backfill(db.session, since=args.since, until=args.until)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
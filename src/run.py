@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 import os
 import sys
+import signal
+import argparse
+import asyncio
 import logging
 import uvicorn
 from logging.handlers import RotatingFileHandler
-from app import app, db, asgi_app
 
-def setup_logging():
+from app import create_app, create_asgi_app, db
+from admin import init_admin
+import lifecycle
+import metrics
+
+def setup_logging(app):
     """配置日志系统"""
     if not os.path.exists('logs'):
         os.makedirs('logs')
@@ -34,18 +41,104 @@ def setup_logging():
     app.logger.setLevel(logging.INFO)
     app.logger.info('DoScores 启动')
 
-def init_db():
-    """初始化数据库"""
+def init_db(app, migrate=False):
+    """建表和迁移, 导入和创建应用时都不会访问数据库"""
     try:
         with app.app_context():
             db.create_all()
+            if migrate:
+                from flask_migrate import Migrate, upgrade
+                Migrate(app, db)
+                upgrade()
+            init_admin(app)
             app.logger.info("数据库初始化完成")
     except Exception as e:
         app.logger.error(f"数据库初始化失败: {str(e)}")
         sys.exit(1)
 
+class DrainingServer(uvicorn.Server):
+    """收到 SIGTERM 后先标记为排空, 等待 drain_seconds 再开始优雅关闭"""
+
+    def __init__(self, config, drain_seconds=0):
+        super().__init__(config)
+        # 实例属性会随 server.run 一起传给工作进程
+        self.drain_seconds = drain_seconds
+
+    def handle_exit(self, sig, frame):
+        if sig == signal.SIGTERM and not lifecycle.draining.is_set() and self.drain_seconds > 0:
+            lifecycle.draining.set()
+            logging.getLogger('uvicorn.error').info(
+                f"进程 {os.getpid()} 开始排空, {self.drain_seconds} 秒后关闭"
+            )
+            asyncio.get_event_loop().call_later(
+                self.drain_seconds, super().handle_exit, sig, frame
+            )
+            return
+        lifecycle.draining.set()
+        super().handle_exit(sig, frame)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DoScores 启动脚本')
+    parser.add_argument('--production', action='store_true',
+                        default=os.getenv('FLASK_ENV') == 'production',
+                        help='生产模式: 多工作进程、优雅关闭')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1)),
+                        help='工作进程数(生产模式)')
+    parser.add_argument('--migrate', action='store_true',
+                        default=os.getenv('DB_AUTO_MIGRATE', 'false').lower() == 'true',
+                        help='启动前执行数据库迁移')
+    parser.add_argument('--drain-seconds', type=int,
+                        default=int(os.getenv('DRAIN_SECONDS', 5)),
+                        help='收到 SIGTERM 后继续服务的秒数, 供负载均衡器摘除节点')
+    parser.add_argument('--graceful-timeout', type=int,
+                        default=int(os.getenv('GRACEFUL_TIMEOUT', 30)),
+                        help='等待进行中请求完成的最长秒数')
+    parser.add_argument('--sweeper', action=argparse.BooleanOptionalAction,
+                        default=os.getenv('SWEEPER_ENABLED', 'true').lower() == 'true',
+                        help='在本进程中运行过期记录清理线程')
+    parser.add_argument('--webhooks', action=argparse.BooleanOptionalAction,
+                        default=os.getenv('WEBHOOKS_ENABLED', 'true').lower() == 'true',
+                        help='在本进程中运行 webhook 推送线程')
+    return parser.parse_args()
+
+def configure_pool(app, workers):
+    """按工作进程数均分数据库连接预算"""
+    total = os.getenv('DB_MAX_CONNECTIONS')
+    if total and not os.getenv('DB_POOL_SIZE'):
+        os.environ['DB_POOL_SIZE'] = str(max(1, int(total) // workers))
+        app.logger.info(f"每个工作进程的连接池大小: {os.environ['DB_POOL_SIZE']}")
+
+def run_production(app, args, port):
+    """以多工作进程方式运行"""
+    from uvicorn.supervisors import Multiprocess
+
+    workers = max(1, args.workers)
+    configure_pool(app, workers)
+
+    # 每个工作进程调用 create_asgi_app 创建自己的应用
+    config = uvicorn.Config(
+        'app:create_asgi_app',
+        factory=True,
+        host='0.0.0.0',
+        port=port,
+        workers=workers,
+        log_level='info',
+        timeout_graceful_shutdown=args.graceful_timeout
+    )
+    server = DrainingServer(config, drain_seconds=args.drain_seconds)
+
+    app.logger.info(f"生产模式启动 {workers} 个工作进程于 http://0.0.0.0:{port}")
+    if workers == 1:
+        server.run()
+        return
+    sock = config.bind_socket()
+    Multiprocess(config, target=server.run, sockets=[sock]).run()
+
 def main():
     """主函数"""
+    args = parse_args()
+    app = create_app()
     try:
         # 确保必要的目录存在
         for directory in ['instance', 'logs']:
@@ -54,18 +147,37 @@ def main():
                 app.logger.info(f"创建目录: {directory}")
         
         # 设置日志
-        setup_logging()
+        setup_logging(app)
         
-        # 初始化数据库
-        init_db()
+        # 初始化数据库, 在启动工作进程之前只执行一次
+        init_db(app, migrate=args.migrate)
+        
+        # 过期记录清理和 webhook 推送只在主进程中运行一份
+        # 单进程运行时 /metrics 同时输出后台线程的统计
+        # 生产模式的工作进程会重新导入本模块, 这两个模块在这里才导入
+        if args.sweeper:
+            from sweeper import Sweeper
+            sweeper = Sweeper(app)
+            sweeper.start()
+            metrics.registry.register_collector('sweeper', sweeper.stats)
+        if args.webhooks:
+            from webhooks import WebhookDispatcher
+            dispatcher = WebhookDispatcher(app)
+            dispatcher.start()
+            metrics.registry.register_collector('webhooks', dispatcher.stats)
         
         # 运行应用
         port = int(os.getenv('PORT', 8181))
+
+        if args.production:
+            run_production(app, args, port)
+            return
+
         debug = os.getenv('FLASK_DEBUG', 'True').lower() == 'true'
         
         app.logger.info(f"启动服务器于 http://localhost:{port}")
         uvicorn.run(
-            asgi_app,
+            create_asgi_app(app),
             host='0.0.0.0',
             port=port,
             log_level='debug' if debug else 'info'
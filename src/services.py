@@ -0,0 +1,256 @@
+"""点数业务逻辑
+
+所有函数都接收一个 SQLAlchemy Session 作为第一个参数, Flask 视图传入 db.session,
+异步接口通过 AsyncSession.run_sync 传入同步会话, 两条路径共用同一套逻辑。
+"""
+import secrets
+from datetime import datetime
+
+from sqlalchemy import select
+
+from models.models import User, ScoreConsumption, ScoreTransfer, BatchTransfer
+import leaderboards
+import balances
+import tokens
+
+
+class ScoreError(Exception):
+    """业务错误, 携带返回给客户端的 HTTP 状态码和附加字段"""
+
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.extra = extra
+
+    def to_dict(self):
+        return {'error': self.message, **self.extra}
+
+
+def generate_confirm_token():
+    """生成确认token"""
+    return secrets.token_urlsafe(32)
+
+
+def consumption_fee(amount):
+    """消耗手续费(3%)"""
+    return int(amount * 0.03)
+
+
+def transfer_fee(amount):
+    """转账手续费(>1000时收取7%)"""
+    return int(amount * 0.07) if amount > 1000 else 0
+
+
+def parse_amount(value, message):
+    try:
+        amount = int(value)
+    except (TypeError, ValueError):
+        raise ScoreError('无效的点数值')
+    if amount <= 0:
+        raise ScoreError(message)
+    return amount
+
+
+def get_user_by_username(session, username):
+    return session.execute(select(User).filter_by(username=username)).scalars().first()
+
+
+def create_consumption(session, app_id, data):
+    """创建待确认的消耗记录"""
+    if not data or 'username' not in data or 'amount' not in data:
+        raise ScoreError('缺少必要参数')
+
+    user = get_user_by_username(session, data['username'])
+    if not user:
+        raise ScoreError('用户不存在', 404)
+
+    amount = parse_amount(data['amount'], '消耗点数必须大于0')
+    if user.actual_score < amount:
+        raise ScoreError('用户点数不足', current_score=user.actual_score)
+
+    # 计算开发者实际收到的金额和手续费(3%)
+    fee_amount = consumption_fee(amount)
+    consumption = ScoreConsumption(
+        user_id=user.id,
+        app_id=app_id,
+        amount=amount,
+        developer_amount=amount - fee_amount,
+        fee_amount=fee_amount,
+        purpose=data.get('purpose', '未说明用途'),
+        confirm_token=generate_confirm_token()
+    )
+    session.add(consumption)
+    session.flush()
+    tokens.issue(session, consumption.confirm_token, 'consume', consumption.id, user.id)
+    session.commit()
+    return consumption
+
+
+def create_transfer(session, from_user, data):
+    """创建待确认的转账记录"""
+    if not data or 'username' not in data or 'amount' not in data:
+        raise ScoreError('缺少必要参数')
+
+    if data['username'] == from_user.username:
+        raise ScoreError('不能转账给自己')
+
+    to_user = get_user_by_username(session, data['username'])
+    if not to_user:
+        raise ScoreError('用户不存在', 404)
+
+    amount = parse_amount(data['amount'], '转账点数必须大于0')
+    if from_user.actual_score < amount:
+        raise ScoreError('点数不足', current_score=from_user.actual_score)
+
+    fee_amount = transfer_fee(amount)
+    transfer = ScoreTransfer(
+        from_user_id=from_user.id,
+        to_user_id=to_user.id,
+        amount=amount,
+        fee_amount=fee_amount,
+        actual_amount=amount - fee_amount,
+        message=data.get('message'),
+        confirm_token=generate_confirm_token()
+    )
+    session.add(transfer)
+    session.flush()
+    tokens.issue(session, transfer.confirm_token, 'transfer', transfer.id, from_user.id)
+    session.commit()
+    return transfer
+
+
+def resolve_token(session, token, kinds, user_id):
+    """通过登记表解析确认token, 无效、不属于该用户或已过期时抛出 ScoreError"""
+    entry = tokens.lookup(session, token)
+    if entry is None or entry.kind not in kinds or entry.user_id != user_id:
+        raise ScoreError('无效或已使用的确认链接', 404)
+    if tokens.is_expired(entry):
+        raise ScoreError('确认链接已过期', 410)
+    return entry
+
+
+def _settle_consumption(session, consumption, status):
+    """提交消耗的处理结果, 登记 webhook 并唤醒本进程内等待该请求的状态查询"""
+    import consumption_status
+    import webhooks
+    # claim 使用不同步会话的 UPDATE, 这里刷新对象以取得最新状态
+    session.refresh(consumption)
+    webhooks.enqueue(session, consumption.app_id, f'consumption.{status}',
+                     consumption_status.serialize(consumption))
+    session.commit()
+    consumption_status.waiters.notify(consumption.id)
+
+
+def confirm_consumption(session, user, token, action):
+    """确认或拒绝点数消耗"""
+    entry = resolve_token(session, token, ('consume',), user.id)
+    consumption = session.get(ScoreConsumption, entry.record_id)
+    if not consumption or consumption.status != 'pending':
+        raise ScoreError('无效或已使用的确认链接', 404)
+
+    if action == 'confirm':
+        # 先占用记录, 并发的重复确认只有一个能成功
+        if not balances.claim(session, ScoreConsumption, consumption.id, 'confirmed',
+                              confirmed_at=datetime.utcnow()):
+            session.rollback()
+            raise ScoreError('无效或已使用的确认链接', 404)
+        tokens.revoke(session, token)
+
+        updated = balances.debit(session, user.id, consumption.amount,
+                                 ('consume', 'consumption', consumption.id),
+                                 total_consumed=consumption.amount,
+                                 total_fee_paid=consumption.fee_amount)
+        if updated is None:
+            session.rollback()
+            raise ScoreError('点数不足', current_score=user.actual_score)
+
+        leaderboards.record_user(updated, session)
+        _settle_consumption(session, consumption, 'confirmed')
+
+        return {
+            'success': True,
+            'username': updated.username,
+            'consumed': consumption.amount,
+            'remaining_score': updated.actual_score
+        }
+    elif action == 'reject':
+        if not balances.claim(session, ScoreConsumption, consumption.id, 'rejected'):
+            session.rollback()
+            raise ScoreError('无效或已使用的确认链接', 404)
+        tokens.revoke(session, token)
+        _settle_consumption(session, consumption, 'rejected')
+        return {
+            'success': False,
+            'error': '用户拒绝了操作'
+        }
+
+    raise ScoreError('无效的操作')
+
+
+def confirm_transfer(session, user, token, action):
+    """确认或拒绝点数转账
+
+    返回 (结果, 批量转账是否已全部完成)。
+    """
+    entry = resolve_token(session, token, ('transfer', 'batch'), user.id)
+
+    if entry.kind == 'batch':
+        # 批量转账整体确认, 同一token下的所有转账一并处理
+        import batch_engine
+        batch = session.get(BatchTransfer, entry.record_id)
+        if not batch or batch.status != 'pending':
+            raise ScoreError('无效或已使用的确认链接', 404)
+        result = batch_engine.confirm_batch(session, user, batch, action)
+        return result, result['success']
+
+    transfer = session.get(ScoreTransfer, entry.record_id)
+    if not transfer or transfer.status != 'pending':
+        raise ScoreError('无效或已使用的确认链接', 404)
+
+    if action == 'confirm':
+        if not balances.claim(session, ScoreTransfer, transfer.id, 'confirmed',
+                              confirmed_at=datetime.utcnow()):
+            session.rollback()
+            raise ScoreError('无效或已使用的确认链接', 404)
+        tokens.revoke(session, token)
+
+        from_user = balances.debit(session, user.id, transfer.amount,
+                                   ('transfer_out', 'transfer', transfer.id),
+                                   total_transferred=transfer.amount,
+                                   total_fee_paid=transfer.fee_amount)
+        if from_user is None:
+            session.rollback()
+            raise ScoreError('点数不足', current_score=user.actual_score)
+
+        to_user = balances.credit(session, transfer.to_user_id, transfer.actual_amount,
+                                  ('transfer_in', 'transfer', transfer.id),
+                                  total_received=transfer.actual_amount)
+        if to_user is None:
+            # 收款人在发起转账后被删除, 扣款随事务一起回滚
+            session.rollback()
+            raise ScoreError('收款用户不存在', 404)
+        leaderboards.record_user(from_user, session)
+        leaderboards.record_user(to_user, session)
+
+        session.commit()
+
+        return {
+            'success': True,
+            'from_username': from_user.username,
+            'to_username': to_user.username,
+            'amount': transfer.amount,
+            'remaining_score': from_user.actual_score
+        }, False
+    elif action == 'reject':
+        if not balances.claim(session, ScoreTransfer, transfer.id, 'rejected'):
+            session.rollback()
+            raise ScoreError('无效或已使用的确认链接', 404)
+        tokens.revoke(session, token)
+        session.commit()
+        return {
+            'success': False,
+            'error': '用户拒绝了操作'
+        }, False
+
+    raise ScoreError('无效的操作')
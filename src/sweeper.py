@@ -0,0 +1,254 @@
+"""过期待确认记录清理
+
+消耗、转账和批量转账接口每次调用都会留下一条 pending 记录, 用户不处理就会一直留在热表中。
+后台任务定期将超过 PENDING_TTL 的 pending 记录标记为 expired, 分块移入归档表,
+并清理已过期的确认 token、幂等键、吊销的 JWT 和排行榜变化记录。热表的大小只与活跃请求量相关。
+此外每隔 LEADERBOARD_REFRESH_INTERVAL 秒重建已失效或过期的排行榜快照, 每隔
+LEDGER_CHECKPOINT_INTERVAL 秒写入一次账本快照, 每隔 RECONCILE_INTERVAL 秒增量核对一次用户统计字段。
+
+每个任务在自己的线程中按自己的间隔运行, 一个任务变慢或出错不会推迟其他任务。
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, delete, exists, literal, DateTime
+
+from models.models import (db, ScoreConsumption, ScoreTransfer, BatchTransfer,
+                           ScoreConsumptionArchive, ScoreTransferArchive)
+import idempotency
+import jwt_auth
+import leaderboards
+import ledger
+import rank_index
+import reconcile
+import tokens
+
+# pending 记录的保留时间(秒), 默认与确认链接的有效期一致
+PENDING_TTL = int(os.getenv('PENDING_TTL', tokens.CONFIRM_TOKEN_TTL))
+# 清理间隔(秒)
+SWEEP_INTERVAL = int(os.getenv('SWEEP_INTERVAL', 60))
+# 每个事务处理的记录数
+SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', 500))
+
+
+def _archive_chunk(session, model, archive, conditions, now):
+    """将一块过期记录移入归档表, 返回处理的记录数"""
+    ids = session.execute(
+        select(model.id).where(model.status == 'pending', *conditions)
+        .order_by(model.id).limit(SWEEP_BATCH_SIZE)
+    ).scalars().all()
+    if not ids:
+        return 0
+
+    # 先以条件更新占用记录, 与同时进行的确认操作互斥
+    swept = session.execute(
+        update(model).where(model.id.in_(ids), model.status == 'pending')
+        .values(status='expired')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    expired = model.id.in_(ids) & (model.status == 'expired')
+
+    columns = [column.name for column in model.__table__.columns]
+    session.execute(
+        insert(archive).from_select(
+            columns + ['archived_at'],
+            select(*model.__table__.columns, literal(now, DateTime)).where(expired)
+        )
+    )
+    confirm_tokens = session.execute(select(model.confirm_token).where(expired)).scalars().all()
+    tokens.revoke_many(session, list(set(confirm_tokens)))
+    session.execute(delete(model).where(expired).execution_options(synchronize_session=False))
+    session.commit()
+    return swept
+
+
+def _expire_batches(session, cutoff):
+    """将过期的批量转账批次标记为 expired, 其中的转账记录随后按普通记录归档"""
+    batches = session.execute(
+        select(BatchTransfer.id, BatchTransfer.confirm_token)
+        .where(BatchTransfer.status == 'pending', BatchTransfer.created_at < cutoff)
+        .limit(SWEEP_BATCH_SIZE)
+    ).all()
+    if not batches:
+        return 0
+    expired = session.execute(
+        update(BatchTransfer)
+        .where(BatchTransfer.id.in_([batch_id for batch_id, _ in batches]),
+               BatchTransfer.status == 'pending')
+        .values(status='expired')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    tokens.revoke_many(session, [token for _, token in batches if token])
+    session.commit()
+    return expired
+
+
+def _drain(session, step):
+    """重复执行 step 直到某一块不足 SWEEP_BATCH_SIZE 条, 每块提交一次, 返回处理的总数"""
+    total = 0
+    while True:
+        count = step()
+        session.commit()
+        total += count
+        if count < SWEEP_BATCH_SIZE:
+            return total
+
+
+class Sweeper:
+    """在 run.py 进程中运行的后台任务, 每个任务有自己的线程、间隔和统计"""
+
+    def __init__(self, flask_app, interval=SWEEP_INTERVAL, ttl=PENDING_TTL):
+        self.flask_app = flask_app
+        self.interval = interval
+        self.ttl = ttl
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        # 任务名 -> (间隔秒数, 执行函数), 执行函数接收 (session, now), 返回各类记录的处理数量
+        self.jobs = {
+            'expire': (interval, self._expire),
+            'token': (interval, self._purge('token', tokens.purge_expired)),
+            'idempotency': (interval, self._purge('idempotency', idempotency.purge_expired)),
+            'revoked_token': (interval, self._purge('revoked_token', jwt_auth.purge_expired)),
+            'leaderboard_change': (interval, self._purge('leaderboard_change',
+                                                         rank_index.purge_expired)),
+            'leaderboard': (leaderboards.LEADERBOARD_REFRESH_INTERVAL, self._leaderboard),
+            'checkpoint': (ledger.CHECKPOINT_INTERVAL, self._checkpoint),
+            'reconcile': (reconcile.RECONCILE_INTERVAL, self._reconcile),
+        }
+        self._stats = {
+            'errors': 0,
+            'swept': {'consumption': 0, 'transfer': 0, 'batch': 0, 'token': 0, 'idempotency': 0,
+                      'revoked_token': 0, 'leaderboard_change': 0, 'leaderboard': 0,
+                      'checkpoint': 0},
+            'jobs': {name: {'runs': 0, 'errors': 0, 'last_duration_s': 0.0,
+                            'total_duration_s': 0.0, 'last_run_at': None}
+                     for name in self.jobs},
+            'last_reconcile': None,
+        }
+
+    def _expire(self, session, now):
+        """过期的批次和 pending 记录"""
+        cutoff = now - timedelta(seconds=self.ttl)
+        # 批次仍待确认的转账记录由批次整体处理, 不单独归档
+        pending_batch = exists().where(BatchTransfer.batch_id == ScoreTransfer.batch_id,
+                                       BatchTransfer.status == 'pending')
+        return {
+            'batch': _drain(session, lambda: _expire_batches(session, cutoff)),
+            'consumption': _drain(session, lambda: _archive_chunk(
+                session, ScoreConsumption, ScoreConsumptionArchive,
+                [ScoreConsumption.created_at < cutoff], now)),
+            'transfer': _drain(session, lambda: _archive_chunk(
+                session, ScoreTransfer, ScoreTransferArchive,
+                [ScoreTransfer.created_at < cutoff, ~pending_batch], now)),
+        }
+
+    @staticmethod
+    def _purge(name, purge):
+        """分块执行 purge(session, limit, now) 的任务"""
+        def run(session, now):
+            return {name: _drain(session, lambda: purge(session, SWEEP_BATCH_SIZE, now))}
+        return run
+
+    @staticmethod
+    def _leaderboard(session, now):
+        return {'leaderboard': leaderboards.rebuild_due(session, now)}
+
+    @staticmethod
+    def _checkpoint(session, now):
+        count = ledger.checkpoint(session, now)
+        session.commit()
+        return {'checkpoint': count}
+
+    def _reconcile(self, session, now):
+        # 首次核对需要读取全部历史, 由命令行执行, 后台线程只做之后的增量核对
+        if reconcile.is_initialized(session):
+            self._record_reconcile(reconcile.reconcile(
+                session, repair=reconcile.RECONCILE_REPAIR,
+                max_chunks=reconcile.RECONCILE_MAX_CHUNKS))
+        else:
+            self.flask_app.logger.warning("统计字段尚未完成首次核对, 请运行 python reconcile.py")
+        return {}
+
+    def run_job(self, name):
+        """执行一次任务, 返回各类记录的处理数量; 出错时记录错误并返回空结果"""
+        _, run = self.jobs[name]
+        now = datetime.utcnow()
+        start = time.perf_counter()
+        try:
+            with self.flask_app.app_context():
+                counts = run(db.session, now)
+        except Exception as e:
+            with self._lock:
+                self._stats['errors'] += 1
+                self._stats['jobs'][name]['errors'] += 1
+            self.flask_app.logger.error(f"后台任务 {name} 失败: {str(e)}")
+            return {}
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            for key, count in counts.items():
+                self._stats['swept'][key] += count
+            job = self._stats['jobs'][name]
+            job['runs'] += 1
+            job['last_duration_s'] = round(elapsed, 3)
+            job['total_duration_s'] = round(job['total_duration_s'] + elapsed, 3)
+            job['last_run_at'] = now.isoformat()
+        if any(counts.values()):
+            self.flask_app.logger.info(f"后台任务 {name}: {counts}, 耗时 {elapsed:.3f} 秒")
+        return counts
+
+    def sweep(self):
+        """依次执行每个任务一次, 返回各类记录的处理数量"""
+        swept = dict.fromkeys(self._stats['swept'], 0)
+        for name in self.jobs:
+            swept.update(self.run_job(name))
+        return swept
+
+    def _record_reconcile(self, report):
+        with self._lock:
+            self._stats['last_reconcile'] = {
+                'rows': report['rows'],
+                'complete': report['complete'],
+                'users_checked': report['users_checked'],
+                'drift': len(report['drift']),
+                'repaired': report['repaired'],
+                'duration_s': report['duration_s'],
+            }
+        for item in report['drift'][:20]:
+            self.flask_app.logger.warning(
+                f"统计字段不一致: 用户 {item['username']} {item['counter']} "
+                f"当前 {item['stored']}, 期望 {item['expected']}"
+            )
+
+    def _run(self, name, interval):
+        # 间隔较长的任务在启动后一个清理间隔先执行一次, 之后按自己的间隔执行
+        wait = min(interval, self.interval)
+        while not self._stop.wait(wait):
+            self.run_job(name)
+            wait = interval
+
+    def start(self):
+        if not self._threads:
+            for name, (interval, _) in self.jobs.items():
+                thread = threading.Thread(target=self._run, args=(name, interval),
+                                          name=f'sweeper-{name}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self.flask_app.logger.info(
+                f"过期记录清理已启动: 保留 {self.ttl} 秒, 每 {self.interval} 秒执行一次"
+            )
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=self.interval)
+        self._threads = []
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats,
+                    'swept': dict(self._stats['swept']),
+                    'jobs': {name: dict(job) for name, job in self._stats['jobs'].items()}}
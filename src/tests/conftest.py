@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+# 测试从 src 目录导入模块, 与 python run.py 的运行方式一致
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def flask_app(tmp_path):
+    """使用临时 SQLite 数据库的应用, 测试期间保持应用上下文"""
+    from app import create_app
+    from models.models import db
+
+    flask_app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "test.db"}'})
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def owner(flask_app):
+    """统计字段为零的用户, 返回其 id"""
+    from models.models import db, User
+
+    user = User(username='owner', forum_id=1, trust_level=1, actual_score=0,
+                original_score=0, total_transferred=0, total_received=0,
+                total_consumed=0, total_fee_paid=0)
+    db.session.add(user)
+    db.session.commit()
+    return user.id
@@ -0,0 +1,126 @@
+"""管理后台的登录、列表分页、汇总和导出"""
+import csv
+import gzip
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+import admin
+from models.models import db, Admin, User, App, ScoreConsumption, ScoreTransfer
+
+
+@pytest.fixture
+def flask_app(flask_app, owner):
+    """一个管理员账号, 一个应用, 以及 owner 和 other 之间的消耗和转账记录"""
+    account = Admin(username='root')
+    account.set_password('secret')
+    other = User(username='other', forum_id=2, trust_level=1, actual_score=0)
+    db.session.add_all([account, other])
+    db.session.flush()
+    application = App(name='app', client_id='id', client_secret='secret',
+                      redirect_uri='http://localhost', user_id=owner)
+    db.session.add(application)
+    db.session.flush()
+    for amount, status in ((100, 'confirmed'), (300, 'confirmed'), (50, 'rejected')):
+        db.session.add(ScoreConsumption(user_id=owner, app_id=application.id, amount=amount,
+                                        status=status, confirmed_at=datetime.utcnow()))
+        db.session.add(ScoreTransfer(from_user_id=owner, to_user_id=other.id, amount=amount,
+                                     actual_amount=amount, status=status,
+                                     confirmed_at=datetime.utcnow()))
+    db.session.commit()
+    admin._summary_cache['data'] = None
+    return flask_app
+
+
+@pytest.fixture
+def client(flask_app):
+    client = flask_app.test_client()
+    response = client.post('/admin/login', data={'username': 'root', 'password': 'secret'})
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/admin/dashboard')
+    return client
+
+
+def test_login_requires_admin_password(flask_app):
+    client = flask_app.test_client()
+    client.post('/admin/login', data={'username': 'root', 'password': 'wrong'})
+    assert client.get('/admin/users').status_code == 302
+
+    client.post('/admin/login', data={'username': 'root', 'password': 'secret'})
+    assert client.get('/admin/users').status_code == 200
+    assert db.session.execute(db.select(User.is_admin).where(User.username == 'root')).scalar()
+
+
+def test_non_admin_user_is_redirected(flask_app, owner):
+    client = flask_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(owner)
+    response = client.get('/admin/users')
+    assert response.status_code == 302
+    assert '/admin/login' in response.headers['Location']
+
+
+def test_pages_render(client):
+    for path in ('/admin/dashboard', '/admin/users?page=1&per_page=1', '/admin/apps',
+                 '/admin/consumptions?status=confirmed', '/admin/transfers?username=other'):
+        assert client.get(path).status_code == 200, path
+    # 管理员登录时创建的用户也能渲染站点页面
+    assert client.get('/admin/user/999').status_code == 404
+
+
+def test_list_sorting_and_pagination(flask_app):
+    with flask_app.test_request_context('/admin/transfers?sort=amount&order=asc&per_page=2'):
+        pagination = admin.paginate(ScoreTransfer.query, {'id': ScoreTransfer.id,
+                                                          'amount': ScoreTransfer.amount}, 'id')
+        assert [transfer.amount for transfer in pagination.items] == [50, 100]
+        assert pagination.pages == 2
+
+    # 不支持的排序列使用默认排序
+    with flask_app.test_request_context('/admin/transfers?sort=-amount'):
+        pagination = admin.paginate(ScoreTransfer.query, {'id': ScoreTransfer.id}, 'id')
+        assert [transfer.id for transfer in pagination.items] == [3, 2, 1]
+
+
+def test_status_totals_and_summary(flask_app):
+    totals = admin.status_totals(ScoreConsumption, [])
+    assert totals['confirmed'] == {'count': 2, 'amount': 400}
+    assert totals['all'] == {'count': 3, 'amount': 450}
+
+    summary = admin.dashboard_summary()
+    assert summary['users'] == 2
+    assert summary['consumptions'] == 3
+    assert summary['consumed_amount'] == 400
+    assert summary['today_transferred'] == 400
+
+
+def test_export_streams_csv_in_chunks(client, monkeypatch):
+    monkeypatch.setattr(admin, 'EXPORT_CHUNK_SIZE', 1)
+    response = client.get('/admin/export/transfers?status=confirmed', buffered=False)
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'text/csv'
+    chunks = list(response.response)
+    response.close()
+    # 每块一次输出, 表头随第一块一起发送
+    assert len([chunk for chunk in chunks if chunk]) == 2
+
+    rows = list(csv.DictReader(io.StringIO(b''.join(chunks).decode())))
+    assert [(row['amount'], row['from_username'], row['to_username']) for row in rows] == [
+        ('100', 'owner', 'other'), ('300', 'owner', 'other')]
+
+
+def test_export_ndjson_with_gzip(client):
+    response = client.get('/admin/export/consumptions?format=ndjson&gzip=1')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/gzip'
+    assert response.headers['Content-Disposition'].endswith('.ndjson.gz')
+    records = [json.loads(line) for line in gzip.decompress(response.data).decode().splitlines()]
+    assert [(record['amount'], record['status'], record['username']) for record in records] == [
+        (100, 'confirmed', 'owner'), (300, 'confirmed', 'owner'), (50, 'rejected', 'owner')]
+
+
+def test_export_rejects_unknown_kind_and_format(client):
+    assert client.get('/admin/export/users').status_code == 404
+    assert client.get('/admin/export/transfers?format=xml').status_code == 400
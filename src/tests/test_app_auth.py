@@ -0,0 +1,46 @@
+"""应用凭据缓存在修改应用的事务提交后失效"""
+import pytest
+
+from app_auth import AppCredentialCache, app_credentials
+from models.models import db, App
+
+
+@pytest.fixture
+def application(flask_app, owner):
+    application = App(name='app', client_id='id', client_secret='old',
+                      redirect_uri='http://localhost', user_id=owner)
+    db.session.add(application)
+    db.session.commit()
+    app_credentials.invalidate()
+    return application
+
+
+def test_rotated_secret_takes_effect_at_commit(application):
+    assert app_credentials.verify('id', 'old')
+
+    application.client_secret = 'new'
+    db.session.flush()
+    # 提交前其他请求读到的仍是旧数据, 重新缓存也会在提交时丢弃
+    assert app_credentials.verify('id', 'old')
+    db.session.commit()
+
+    assert not app_credentials.verify('id', 'old')
+    assert app_credentials.verify('id', 'new')
+
+
+def test_rolled_back_change_keeps_cache(application):
+    assert app_credentials.verify('id', 'old')
+    application.client_secret = 'new'
+    db.session.flush()
+    db.session.rollback()
+    assert app_credentials.stats()['size'] == 1
+    assert app_credentials.verify('id', 'old')
+
+
+def test_lookup_racing_invalidation_is_not_cached(application):
+    cache = AppCredentialCache()
+    generation = cache._generation
+    cache.invalidate('id')
+    # 失效之前开始的查询读到的可能是旧数据, 不写入缓存
+    assert cache._store(application, generation)
+    assert cache.stats()['size'] == 0
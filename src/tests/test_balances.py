@@ -0,0 +1,166 @@
+"""消耗和转账确认: 条件扣款、入账、账本和重复确认"""
+import threading
+
+import pytest
+
+import balances
+import services
+from models.models import db, User, App, LedgerEntry, ScoreConsumption, ScoreTransfer
+
+
+@pytest.fixture
+def flask_app(flask_app):
+    """alice 有 1000 点, bob 有 100 点, alice 名下一个应用"""
+    alice = User(username='alice', forum_id=1, trust_level=1, actual_score=1000)
+    bob = User(username='bob', forum_id=2, trust_level=1, actual_score=100)
+    db.session.add_all([alice, bob])
+    db.session.flush()
+    db.session.add(App(name='app', client_id='id', client_secret='secret',
+                       redirect_uri='http://localhost', user_id=alice.id))
+    db.session.commit()
+    return flask_app
+
+
+def user(username):
+    return db.session.execute(db.select(User).filter_by(username=username)).scalar_one()
+
+
+def ledger_sum(username):
+    return db.session.execute(
+        db.select(db.func.coalesce(db.func.sum(LedgerEntry.delta), 0))
+        .where(LedgerEntry.user_id == user(username).id)
+    ).scalar()
+
+
+def assert_ledger_matches(*usernames):
+    db.session.expire_all()
+    for username in usernames:
+        assert ledger_sum(username) == user(username).actual_score, username
+
+
+def create_transfer(amount, to='bob'):
+    return services.create_transfer(db.session, user('alice'), {'username': to, 'amount': amount})
+
+
+def test_confirm_transfer_moves_balance_and_writes_ledger(flask_app):
+    transfer = create_transfer(1000)
+    result, _ = services.confirm_transfer(db.session, user('alice'), transfer.confirm_token,
+                                          'confirm')
+
+    assert result['remaining_score'] == 0
+    alice, bob = user('alice'), user('bob')
+    assert (alice.actual_score, alice.total_transferred) == (0, 1000)
+    assert (bob.actual_score, bob.total_received) == (1100, 1000)
+    assert db.session.get(ScoreTransfer, transfer.id).status == 'confirmed'
+    assert_ledger_matches('alice', 'bob')
+
+
+def test_confirm_transfer_charges_fee_above_threshold(flask_app):
+    user('alice').actual_score = 5000
+    db.session.commit()
+    transfer = create_transfer(2000)
+    services.confirm_transfer(db.session, user('alice'), transfer.confirm_token, 'confirm')
+
+    assert user('alice').actual_score == 3000
+    assert user('bob').actual_score == 100 + 2000 - services.transfer_fee(2000)
+    assert user('alice').total_fee_paid == services.transfer_fee(2000)
+    assert_ledger_matches('alice', 'bob')
+
+
+def test_reject_leaves_balances_unchanged(flask_app):
+    transfer = create_transfer(300)
+    entries = db.session.execute(db.select(db.func.count(LedgerEntry.id))).scalar()
+    result, _ = services.confirm_transfer(db.session, user('alice'), transfer.confirm_token,
+                                          'reject')
+
+    assert result['success'] is False
+    assert (user('alice').actual_score, user('bob').actual_score) == (1000, 100)
+    assert db.session.get(ScoreTransfer, transfer.id).status == 'rejected'
+    assert db.session.execute(db.select(db.func.count(LedgerEntry.id))).scalar() == entries
+    with pytest.raises(services.ScoreError) as error:
+        services.confirm_transfer(db.session, user('alice'), transfer.confirm_token, 'confirm')
+    assert error.value.status == 404
+
+
+def test_insufficient_funds_rolls_back_the_claim(flask_app):
+    transfer = create_transfer(800)
+    # 创建后余额被其他操作花掉
+    user('alice').actual_score = 500
+    db.session.commit()
+
+    with pytest.raises(services.ScoreError) as error:
+        services.confirm_transfer(db.session, user('alice'), transfer.confirm_token, 'confirm')
+    assert error.value.message == '点数不足'
+    db.session.expire_all()
+    assert (user('alice').actual_score, user('bob').actual_score) == (500, 100)
+    assert db.session.get(ScoreTransfer, transfer.id).status == 'pending'
+    assert_ledger_matches('alice', 'bob')
+
+
+def test_missing_recipient_rolls_back_the_debit(flask_app):
+    transfer = create_transfer(300)
+    db.session.execute(db.update(ScoreTransfer).values(to_user_id=999))
+    db.session.commit()
+
+    with pytest.raises(services.ScoreError) as error:
+        services.confirm_transfer(db.session, user('alice'), transfer.confirm_token, 'confirm')
+    assert error.value.status == 404
+    db.session.expire_all()
+    assert user('alice').actual_score == 1000
+    assert db.session.get(ScoreTransfer, transfer.id).status == 'pending'
+    assert not db.session.execute(db.select(LedgerEntry).filter_by(user_id=999)).first()
+
+
+def test_credit_unknown_user_writes_nothing(flask_app):
+    assert balances.credit(db.session, 999, 10, ('transfer_in', 'transfer', 1),
+                           total_received=10) is None
+    assert not db.session.execute(db.select(LedgerEntry).filter_by(user_id=999)).first()
+
+
+def test_confirm_consumption_debits_once(flask_app):
+    consumption = services.create_consumption(
+        db.session, db.session.execute(db.select(App.id)).scalar(),
+        {'username': 'bob', 'amount': 100})
+    result = services.confirm_consumption(db.session, user('bob'), consumption.confirm_token,
+                                          'confirm')
+
+    assert result['remaining_score'] == 0
+    bob = user('bob')
+    assert (bob.total_consumed, bob.total_fee_paid) == (100, services.consumption_fee(100))
+    assert db.session.get(ScoreConsumption, consumption.id).status == 'confirmed'
+    assert_ledger_matches('bob')
+    with pytest.raises(services.ScoreError):
+        services.confirm_consumption(db.session, user('bob'), consumption.confirm_token,
+                                     'confirm')
+
+
+def test_concurrent_double_confirm_moves_money_once(flask_app):
+    transfer = create_transfer(600)
+    token = transfer.confirm_token
+    alice_id = user('alice').id
+    barrier = threading.Barrier(2)
+    outcomes = []
+
+    def confirm():
+        with flask_app.app_context():
+            payer = db.session.get(User, alice_id)
+            barrier.wait()
+            try:
+                balances.retrying(db.session, services.confirm_transfer, payer, token, 'confirm')
+                outcomes.append('confirmed')
+            except services.ScoreError as e:
+                db.session.rollback()
+                outcomes.append(e.status)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=confirm) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert sorted(outcomes, key=str) == [404, 'confirmed']
+    db.session.expire_all()
+    assert (user('alice').actual_score, user('bob').actual_score) == (400, 700)
+    assert_ledger_matches('alice', 'bob')
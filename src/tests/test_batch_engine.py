@@ -0,0 +1,184 @@
+"""批量转账和批量消耗的创建, 以及批量转账的整体确认"""
+import threading
+
+import pytest
+
+import balances
+import batch_engine
+import services
+from models.models import (db, User, App, BatchTransfer, ScoreTransfer, ScoreConsumption,
+                           LedgerEntry)
+
+
+@pytest.fixture
+def flask_app(flask_app):
+    """alice 有 10000 点, 收款人 bob、carol 各 100 点, alice 名下一个应用"""
+    db.session.add_all([
+        User(username='alice', forum_id=1, trust_level=1, actual_score=10000),
+        User(username='bob', forum_id=2, trust_level=1, actual_score=100),
+        User(username='carol', forum_id=3, trust_level=1, actual_score=100),
+    ])
+    db.session.flush()
+    db.session.add(App(name='app', client_id='id', client_secret='secret',
+                       redirect_uri='http://localhost', user_id=user('alice').id))
+    db.session.commit()
+    return flask_app
+
+
+def user(username):
+    return db.session.execute(db.select(User).filter_by(username=username)).scalar_one()
+
+
+def assert_ledger_matches(*usernames):
+    db.session.expire_all()
+    for username in usernames:
+        total = db.session.execute(
+            db.select(db.func.coalesce(db.func.sum(LedgerEntry.delta), 0))
+            .where(LedgerEntry.user_id == user(username).id)
+        ).scalar()
+        assert total == user(username).actual_score, username
+
+
+def confirm(token, action='confirm'):
+    return services.confirm_transfer(db.session, user('alice'), token, action)
+
+
+def statuses(batch_id):
+    return db.session.execute(
+        db.select(ScoreTransfer.status).where(ScoreTransfer.batch_id == batch_id).distinct()
+    ).scalars().all()
+
+
+def create_batch(*transfers):
+    return batch_engine.create_batch_transfer(db.session, user('alice'), {
+        'transfers': [{'username': username, 'amount': amount} for username, amount in transfers]
+    })
+
+
+def test_create_batch_writes_rows_and_skip_report(flask_app):
+    result = create_batch(('bob', 2000), ('alice', 10), ('nobody', 10), ('carol', 0),
+                          ('carol', 'x'), ('carol', 300))
+
+    assert result['count'] == 2
+    assert result['total_amount'] == 2300
+    assert result['total_fee'] == services.transfer_fee(2000)
+    assert [(entry['index'], entry['reason']) for entry in result['skipped']] == [
+        (1, '不能转账给自己'), (2, '用户不存在'), (3, '转账点数必须大于0'), (4, '无效的点数值')]
+
+    batch = db.session.execute(db.select(BatchTransfer)).scalar_one()
+    assert (batch.status, batch.total_count, batch.confirm_token) == (
+        'pending', 2, result['confirm_token'])
+    rows = db.session.execute(
+        db.select(ScoreTransfer.to_user_id, ScoreTransfer.actual_amount, ScoreTransfer.status)
+        .where(ScoreTransfer.batch_id == result['batch_id']).order_by(ScoreTransfer.id)
+    ).all()
+    assert rows == [(user('bob').id, 2000 - services.transfer_fee(2000), 'pending'),
+                    (user('carol').id, 300, 'pending')]
+    # 创建时不扣款
+    assert user('alice').actual_score == 10000
+
+
+def test_create_batch_rejects_insufficient_funds_and_empty_plans(flask_app):
+    with pytest.raises(services.ScoreError) as error:
+        create_batch(('bob', 6000), ('carol', 6000))
+    assert error.value.extra['total_amount'] == 12000
+
+    with pytest.raises(services.ScoreError) as error:
+        create_batch(('nobody', 10))
+    assert error.value.message == '没有有效的转账记录'
+    assert db.session.execute(db.select(db.func.count(ScoreTransfer.id))).scalar() == 0
+
+
+def test_batch_consumption_reports_each_item(flask_app):
+    app_id = db.session.execute(db.select(App.id)).scalar()
+    result = batch_engine.create_batch_consumption(db.session, app_id, {'consumptions': [
+        {'username': 'bob', 'amount': 50},
+        {'username': 'carol', 'amount': 500},
+        {'username': 'nobody', 'amount': 1},
+        {'username': 'carol', 'amount': 100, 'purpose': 'test'},
+    ]})
+
+    assert (result['count'], result['failed']) == (2, 2)
+    assert [entry.get('error') for entry in result['results']] == [
+        None, '用户点数不足', '用户不存在', None]
+    consumption = db.session.get(ScoreConsumption, result['results'][3]['consumption_id'])
+    assert (consumption.amount, consumption.fee_amount, consumption.purpose) == (
+        100, services.consumption_fee(100), 'test')
+    assert consumption.confirm_token == result['results'][3]['confirm_token']
+
+
+def test_confirm_batch_moves_all_balances_at_once(flask_app):
+    batch = create_batch(('bob', 2000), ('carol', 300), ('bob', 500))
+    result, completed = confirm(batch['confirm_token'])
+
+    assert completed
+    assert (result['count'], result['remaining_score']) == (3, 10000 - 2800)
+    fee = services.transfer_fee(2000)
+    alice, bob, carol = user('alice'), user('bob'), user('carol')
+    assert (alice.total_transferred, alice.total_fee_paid) == (2800, fee)
+    assert (bob.actual_score, bob.total_received) == (100 + 2500 - fee, 2500 - fee)
+    assert (carol.actual_score, carol.total_received) == (400, 300)
+    assert statuses(batch['batch_id']) == ['confirmed']
+    stored = db.session.execute(db.select(BatchTransfer)).scalar_one()
+    assert (stored.status, stored.confirmed_count) == ('confirmed', 3)
+    assert_ledger_matches('alice', 'bob', 'carol')
+
+
+def test_reject_batch_rejects_every_transfer(flask_app):
+    batch = create_batch(('bob', 200), ('carol', 300))
+    result, completed = confirm(batch['confirm_token'], 'reject')
+
+    assert not completed and result['success'] is False
+    assert statuses(batch['batch_id']) == ['rejected']
+    assert [user(name).actual_score for name in ('alice', 'bob', 'carol')] == [10000, 100, 100]
+    with pytest.raises(services.ScoreError) as error:
+        confirm(batch['confirm_token'])
+    assert error.value.status == 404
+
+
+def test_confirm_batch_with_insufficient_funds_changes_nothing(flask_app):
+    batch = create_batch(('bob', 3000), ('carol', 3000))
+    user('alice').actual_score = 5000
+    db.session.commit()
+
+    with pytest.raises(services.ScoreError) as error:
+        confirm(batch['confirm_token'])
+    assert error.value.message == '点数不足'
+    db.session.expire_all()
+    assert [user(name).actual_score for name in ('alice', 'bob', 'carol')] == [5000, 100, 100]
+    assert statuses(batch['batch_id']) == ['pending']
+    assert db.session.execute(db.select(BatchTransfer.status)).scalar() == 'pending'
+    assert_ledger_matches('alice', 'bob', 'carol')
+
+
+def test_concurrent_double_confirm_pays_once(flask_app):
+    batch = create_batch(('bob', 200), ('carol', 300))
+    alice_id = user('alice').id
+    barrier = threading.Barrier(2)
+    outcomes = []
+
+    def run():
+        with flask_app.app_context():
+            payer = db.session.get(User, alice_id)
+            barrier.wait()
+            try:
+                balances.retrying(db.session, services.confirm_transfer, payer,
+                                  batch['confirm_token'], 'confirm')
+                outcomes.append('confirmed')
+            except services.ScoreError as e:
+                db.session.rollback()
+                outcomes.append(e.status)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert sorted(outcomes, key=str) == [404, 'confirmed']
+    db.session.expire_all()
+    assert [user(name).actual_score for name in ('alice', 'bob', 'carol')] == [9500, 300, 400]
+    assert db.session.execute(db.select(BatchTransfer.confirmed_count)).scalar() == 2
+    assert_ledger_matches('alice', 'bob', 'carol')
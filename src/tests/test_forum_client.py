@@ -0,0 +1,164 @@
+"""ForumScoreFetcher 与本地模拟论坛服务器的交互"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from forum_client import ForumScoreFetcher
+
+
+class StandInForum:
+    """模拟论坛的 /u/<username>.json 接口
+
+    用户名以 slow 开头时延迟 delay 秒再响应, 以 broken 开头时返回 500,
+    记录每个用户的请求次数和同时处理中的最大请求数。
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.requests = {}
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        forum = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                username = self.path.rsplit('/', 1)[-1].removesuffix('.json')
+                with forum._lock:
+                    forum.requests[username] = forum.requests.get(username, 0) + 1
+                    forum.active += 1
+                    forum.max_active = max(forum.max_active, forum.active)
+                try:
+                    time.sleep(1.0 if username.startswith('slow') else forum.delay)
+                    if username.startswith('broken'):
+                        self.send_response(500)
+                        self.end_headers()
+                        return
+                    body = json.dumps({'user': {'username': username,
+                                                'gamification_score': len(username) * 100}})
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body.encode())
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with forum._lock:
+                        forum.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def forum():
+    server = StandInForum()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def make_fetcher(forum):
+    fetchers = []
+
+    def make(**options):
+        fetcher = ForumScoreFetcher(base_url=forum.url, **options)
+        fetchers.append(fetcher)
+        return fetcher
+
+    yield make
+    for fetcher in fetchers:
+        fetcher.close()
+
+
+def test_fetch_saves_score_and_calls_back(make_fetcher, forum):
+    fetcher = make_fetcher()
+    saved = []
+    assert fetcher.refresh('alice', saved.append).result(timeout=5) == 500
+    assert saved == [500]
+    assert fetcher.get_cached('alice') == 500
+    assert forum.requests == {'alice': 1}
+
+
+def test_concurrency_is_limited(make_fetcher, forum):
+    forum.delay = 0.2
+    fetcher = make_fetcher(max_concurrency=2)
+    futures = [fetcher.refresh(f'user{i}') for i in range(6)]
+    assert [future.result(timeout=10) for future in futures] == [500] * 6
+    assert forum.max_active == 2
+
+
+def test_concurrent_refreshes_of_one_user_are_merged(make_fetcher, forum):
+    forum.delay = 0.2
+    fetcher = make_fetcher()
+    first = fetcher.refresh('bob')
+    second = fetcher.refresh('bob')
+    assert first is second
+    assert first.result(timeout=5) == 300
+    assert forum.requests == {'bob': 1}
+
+
+def test_timeout_falls_back_without_caching(make_fetcher):
+    fetcher = make_fetcher(timeout=0.2)
+    saved = []
+    assert fetcher.refresh('slow-carol', saved.append).result(timeout=5) is None
+    assert saved == []
+    assert fetcher.get_cached('slow-carol') is None
+    # 失败后可以重新发起刷新
+    assert fetcher.refresh('dave').result(timeout=5) == 400
+
+
+def test_server_error_falls_back_without_caching(make_fetcher, forum):
+    fetcher = make_fetcher()
+    saved = []
+    assert fetcher.refresh('broken-erin', saved.append).result(timeout=5) is None
+    assert saved == []
+    assert fetcher.get_cached('broken-erin') is None
+    assert forum.requests == {'broken-erin': 1}
+
+
+def test_callback_error_does_not_break_refresh(make_fetcher):
+    fetcher = make_fetcher()
+
+    def fail(score):
+        raise RuntimeError('db down')
+
+    assert fetcher.refresh('frank', fail).result(timeout=5) == 500
+    assert fetcher.get_cached('frank') == 500
+
+
+def test_cache_expires_after_ttl(make_fetcher, forum):
+    fetcher = make_fetcher(ttl=0.2)
+    fetcher.refresh('grace').result(timeout=5)
+    assert fetcher.get_cached('grace') == 500
+    time.sleep(0.3)
+    assert fetcher.get_cached('grace') is None
+    fetcher.refresh('grace').result(timeout=5)
+    assert forum.requests == {'grace': 2}
+
+
+def test_cache_is_bounded_lru(make_fetcher):
+    fetcher = make_fetcher(cache_size=2)
+    fetcher.refresh('a1').result(timeout=5)
+    fetcher.refresh('b22').result(timeout=5)
+    # 访问 a1 后 b22 成为最久未使用的用户
+    assert fetcher.get_cached('a1') == 200
+    fetcher.refresh('c333').result(timeout=5)
+    assert fetcher.get_cached('b22') is None
+    assert fetcher.get_cached('a1') == 200
+    assert fetcher.get_cached('c333') == 400
+    assert len(fetcher._cache) == 2
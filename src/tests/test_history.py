@@ -0,0 +1,78 @@
+"""消耗和转账记录的游标分页"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import history
+from models.models import db, User, App, ScoreConsumption, ScoreTransfer
+
+
+@pytest.fixture
+def flask_app(flask_app, owner):
+    """owner 的消耗、转出和转入记录, 部分记录的时间相同"""
+    other = User(username='other', forum_id=2, trust_level=1, actual_score=0)
+    db.session.add(other)
+    db.session.flush()
+    application = App(name='app', client_id='id', client_secret='secret',
+                      redirect_uri='http://localhost', user_id=owner)
+    db.session.add(application)
+    db.session.flush()
+    start = datetime(2024, 1, 1)
+    for minute in (0, 1, 1, 2, 3, 3, 3):
+        created_at = start + timedelta(minutes=minute)
+        db.session.add(ScoreConsumption(user_id=owner, app_id=application.id, amount=minute + 1,
+                                        created_at=created_at))
+        db.session.add(ScoreTransfer(from_user_id=owner, to_user_id=other.id, amount=10,
+                                     actual_amount=10, created_at=created_at))
+        db.session.add(ScoreTransfer(from_user_id=other.id, to_user_id=owner, amount=20,
+                                     actual_amount=20, created_at=created_at))
+    # 其他用户之间的记录不出现在 owner 的历史中
+    db.session.add(ScoreTransfer(from_user_id=other.id, to_user_id=other.id, amount=1,
+                                 actual_amount=1, created_at=start))
+    db.session.commit()
+    return flask_app
+
+
+def walk(user_id, limit):
+    keys = []
+    cursor = None
+    while True:
+        records, cursor = history.fetch_history(user_id, limit=limit, cursor=cursor)
+        assert len(records) <= limit
+        keys += [(record.created_at, serialized['kind'], record.id)
+                 for record, serialized in ((record, history.serialize_record(record, user_id))
+                                            for record in records)]
+        if cursor is None:
+            return keys
+
+
+def test_pages_cover_every_record_once_in_order(flask_app, owner):
+    everything = walk(owner, history.HISTORY_MAX_PAGE_SIZE)
+    assert len(everything) == 21
+    assert everything == sorted(everything, reverse=True)
+
+    for limit in (1, 2, 4, 20):
+        assert walk(owner, limit) == everything
+
+
+def test_serialized_amounts_follow_direction(flask_app, owner):
+    records, _ = history.fetch_history(owner, limit=9)
+    serialized = [history.serialize_record(record, owner) for record in records]
+    # 同一时间的记录按类型倒序
+    assert [(entry['kind'], entry['amount']) for entry in serialized] == (
+        [('transfer_out', -10)] * 3 + [('transfer_in', 20)] * 3 + [('consume', -4)] * 3)
+    assert {entry.get('counterparty') for entry in serialized} == {'other', None}
+
+
+def test_invalid_cursor_is_rejected(flask_app, owner):
+    for cursor in ('not-a-cursor', history.encode_cursor(datetime(2024, 1, 1), 'bogus', 1)):
+        with pytest.raises(ValueError):
+            history.fetch_history(owner, cursor=cursor)
+
+    client = flask_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(owner)
+    assert client.get('/api/history?cursor=not-a-cursor').status_code == 400
+    response = client.get('/api/history?limit=5')
+    assert len(response.get_json()['records']) == 5
+    assert response.get_json()['next_cursor']
@@ -0,0 +1,85 @@
+"""Idempotency-Key: 重放保存的响应, 拒绝不同请求和处理中的重复请求"""
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import idempotency
+import services
+from models.models import db, User, App, IdempotencyKey, ScoreConsumption
+
+
+@pytest.fixture
+def flask_app(flask_app, owner):
+    db.session.add(User(username='alice', forum_id=2, trust_level=1, actual_score=1000))
+    db.session.add(App(name='app', client_id='id', client_secret='secret',
+                       redirect_uri='http://localhost', user_id=owner))
+    db.session.commit()
+    return flask_app
+
+
+def consume(client, body, key='retry-1'):
+    return client.post('/api/score/consume', data=body, content_type='application/json',
+                       headers={'Authorization': 'id:secret', idempotency.HEADER: key})
+
+
+def consumptions():
+    return db.session.execute(db.select(db.func.count(ScoreConsumption.id))).scalar()
+
+
+def test_retry_replays_stored_response(flask_app):
+    client = flask_app.test_client()
+    first = consume(client, '{"username": "alice", "amount": 10}')
+    # 字段顺序和空白不同的重试视为同一请求
+    retry = consume(client, '{"amount":10,"username":"alice"}')
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.headers[idempotency.REPLAYED_HEADER] == 'true'
+    assert idempotency.REPLAYED_HEADER not in first.headers
+    assert retry.get_json() == first.get_json()
+    assert consumptions() == 1
+
+    assert consume(client, json.dumps({'username': 'alice', 'amount': 10}),
+                   key='retry-2').get_json()['consumption_id'] != first.get_json()['consumption_id']
+    assert consumptions() == 2
+
+
+def test_business_errors_are_replayed_too(flask_app):
+    client = flask_app.test_client()
+    body = json.dumps({'username': 'alice', 'amount': 5000})
+    assert consume(client, body).status_code == 400
+    retry = consume(client, body)
+    assert retry.status_code == 400
+    assert retry.headers[idempotency.REPLAYED_HEADER] == 'true'
+
+
+def test_same_key_with_different_body_is_rejected(flask_app):
+    client = flask_app.test_client()
+    consume(client, json.dumps({'username': 'alice', 'amount': 10}))
+    response = consume(client, json.dumps({'username': 'alice', 'amount': 20}))
+    assert response.status_code == 422
+    assert consumptions() == 1
+
+
+def test_in_progress_and_released_keys(flask_app):
+    request_fingerprint = idempotency.fingerprint('POST', '/api/score/consume', b'{}')
+    assert idempotency.begin(db.session, 'app:1', 'key', request_fingerprint) is None
+    with pytest.raises(services.ScoreError) as error:
+        idempotency.begin(db.session, 'app:1', 'key', request_fingerprint)
+    assert error.value.status == 409
+
+    # 服务器错误不保存响应, 释放键以便重试
+    idempotency.complete(db.session, 'app:1', 'key', 500, '{}')
+    assert idempotency.begin(db.session, 'app:1', 'key', request_fingerprint) is None
+
+    # 处理中断的键在锁超时后可以重新占用
+    db.session.execute(db.update(IdempotencyKey).values(
+        expires_at=datetime.utcnow() - timedelta(seconds=1)))
+    db.session.commit()
+    assert idempotency.begin(db.session, 'app:1', 'key', request_fingerprint) is None
+
+    idempotency.complete(db.session, 'app:1', 'key', 200, '{"ok": true}')
+    stored = idempotency.begin(db.session, 'app:1', 'key', request_fingerprint)
+    assert stored == (200, '{"ok": true}')
+    later = datetime.utcnow() + timedelta(seconds=idempotency.IDEMPOTENCY_TTL + 1)
+    assert idempotency.purge_expired(db.session, 10, later) == 1
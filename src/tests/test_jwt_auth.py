@@ -0,0 +1,93 @@
+"""登录会话与 JWT cookie 的组合, 特别是已吊销的 JWT"""
+import asyncio
+
+import httpx
+import pytest
+
+import jwt_auth
+from app import create_asgi_app
+from models.models import db, User
+
+
+@pytest.fixture
+def token(flask_app, owner):
+    return jwt_auth.encode(flask_app.config['JWT_KEYS'], db.session.get(User, owner))
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+
+def revoke(flask_app, token):
+    jwt_auth.revocations.revoke(db.session, jwt_auth.decode(flask_app.config['JWT_KEYS'], token))
+    db.session.commit()
+
+
+def issued_jwt(response):
+    return any(header.startswith(f'{jwt_auth.JWT_COOKIE}=')
+               for header in response.headers.getlist('Set-Cookie'))
+
+
+def test_session_without_jwt_is_reissued(flask_app, owner):
+    client = flask_app.test_client()
+    login(client, owner)
+    response = client.get('/api/history')
+    assert response.status_code == 200
+    assert issued_jwt(response)
+
+
+def test_session_with_valid_jwt_uses_it(flask_app, owner, token):
+    client = flask_app.test_client()
+    login(client, owner)
+    client.set_cookie(jwt_auth.JWT_COOKIE, token)
+    response = client.get('/api/history')
+    assert response.status_code == 200
+    assert not issued_jwt(response)
+
+
+def test_revoked_jwt_is_not_reissued_from_session(flask_app, owner, token):
+    client = flask_app.test_client()
+    login(client, owner)
+    client.set_cookie(jwt_auth.JWT_COOKIE, token)
+    revoke(flask_app, token)
+
+    response = client.get('/api/history')
+    assert response.status_code == 302
+    assert not issued_jwt(response)
+
+    # 会话已清除, 不带 JWT 也不能凭会话重新登录
+    client.delete_cookie(jwt_auth.JWT_COOKIE)
+    response = client.get('/api/history')
+    assert response.status_code == 302
+    assert not issued_jwt(response)
+
+
+def test_invalid_jwt_is_not_replaced(flask_app, owner, token):
+    client = flask_app.test_client()
+    login(client, owner)
+    client.set_cookie(jwt_auth.JWT_COOKIE, token + 'x')
+    response = client.get('/api/history')
+    assert response.status_code == 302
+    assert not issued_jwt(response)
+
+
+def test_fastpath_rejects_revoked_jwt_with_session(flask_app, owner, token):
+    client = flask_app.test_client()
+    login(client, owner)
+    session_cookie = client.get_cookie(flask_app.config['SESSION_COOKIE_NAME']).value
+    revoke(flask_app, token)
+
+    async def transfer(cookies):
+        transport = httpx.ASGITransport(app=create_asgi_app(flask_app))
+        async with httpx.AsyncClient(transport=transport, base_url='http://test',
+                                     cookies=cookies) as http:
+            response = await http.post('/api/score/transfer',
+                                       json={'username': 'nobody', 'amount': 1})
+            return response.status_code
+
+    name = flask_app.config['SESSION_COOKIE_NAME']
+    assert asyncio.run(transfer({name: session_cookie, jwt_auth.JWT_COOKIE: token})) == 302
+    # 只有会话时照常处理, 收款人不存在返回业务错误而不是跳转登录
+    assert asyncio.run(transfer({name: session_cookie})) != 302
@@ -0,0 +1,66 @@
+"""排行榜快照: 读取只使用快照, 重建由后台任务完成"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import leaderboards
+import sweeper
+from models.models import db, User, LeaderboardEntry, LeaderboardState
+
+
+@pytest.fixture
+def flask_app(flask_app):
+    """三个用户, 余额依次为 10 到 30, 榜单快照已构建"""
+    for number in range(1, 4):
+        db.session.add(User(username=f'user{number}', forum_id=number, trust_level=1,
+                            actual_score=number * 10, total_transferred=0, total_consumed=0))
+    db.session.commit()
+    leaderboards.rebuild_all()
+    return flask_app
+
+
+def names(board):
+    return [entry.username for entry in leaderboards.get_board(board)]
+
+
+def test_read_serves_snapshot_without_rebuilding(flask_app):
+    db.session.add(User(username='rich', forum_id=9, trust_level=1, actual_score=100))
+    leaderboards.mark_dirty('richest')
+    db.session.execute(db.update(LeaderboardState).values(
+        refreshed_at=datetime.utcnow() - timedelta(days=1)))
+    db.session.commit()
+
+    assert names('richest') == ['user3', 'user2', 'user1']
+    assert db.session.get(LeaderboardState, 'richest').dirty
+
+
+def test_sweeper_rebuilds_dirty_and_expired_boards(flask_app):
+    db.session.add(User(username='rich', forum_id=9, trust_level=1, actual_score=100))
+    leaderboards.mark_dirty('richest')
+    db.session.commit()
+
+    instance = sweeper.Sweeper(flask_app)
+    assert instance.run_job('leaderboard') == {'leaderboard': 1}
+    assert names('richest') == ['rich', 'user3', 'user2', 'user1']
+    assert not db.session.get(LeaderboardState, 'richest').dirty
+    # 未失效的榜单不重复重建
+    assert instance.run_job('leaderboard') == {'leaderboard': 0}
+
+    later = datetime.utcnow() + timedelta(seconds=leaderboards.LEADERBOARD_REBUILD_INTERVAL + 1)
+    assert leaderboards.rebuild_due(db.session, later) == len(leaderboards.BOARDS)
+
+
+def test_record_user_updates_snapshot_in_place(flask_app):
+    user = db.session.execute(db.select(User).filter_by(username='user1')).scalar_one()
+    user.actual_score = 50
+    leaderboards.record_user(user)
+    db.session.commit()
+    assert names('richest') == ['user1', 'user3', 'user2']
+
+    user.show_in_leaderboard = False
+    leaderboards.record_user(user)
+    db.session.commit()
+    assert names('richest') == ['user3', 'user2']
+    assert db.session.get(LeaderboardState, 'richest').dirty
+    assert db.session.execute(db.select(db.func.count(LeaderboardEntry.id))
+                              .where(LeaderboardEntry.board == 'richest')).scalar() == 2
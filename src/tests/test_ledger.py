@@ -0,0 +1,85 @@
+"""账本记录、余额快照和任意时刻的余额"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import ledger
+import services
+from models.models import db, User, LedgerEntry, BalanceCheckpoint
+
+
+@pytest.fixture
+def flask_app(flask_app):
+    db.session.add_all([User(username='alice', forum_id=1, trust_level=1, actual_score=1000),
+                        User(username='bob', forum_id=2, trust_level=1, actual_score=100)])
+    db.session.commit()
+    return flask_app
+
+
+def user(username):
+    return db.session.execute(db.select(User).filter_by(username=username)).scalar_one()
+
+
+def transfer(amount):
+    record = services.create_transfer(db.session, user('alice'),
+                                      {'username': 'bob', 'amount': amount})
+    services.confirm_transfer(db.session, user('alice'), record.confirm_token, 'confirm')
+
+
+def current(username):
+    return {name: getattr(user(username), name) or 0 for name in ledger.FIELDS}
+
+
+def later():
+    return datetime.utcnow() + timedelta(seconds=ledger.CHECKPOINT_LAG + 1)
+
+
+def test_snapshot_matches_user_after_checkpoint_and_new_entries(flask_app):
+    transfer(300)
+    assert ledger.checkpoint(db.session, later()) == 2
+    db.session.commit()
+    checkpoint = db.session.execute(
+        db.select(BalanceCheckpoint).filter_by(user_id=user('bob').id)).scalar_one()
+    assert (checkpoint.actual_score, checkpoint.total_received) == (400, 300)
+
+    transfer(200)
+    # 直接修改 User 时写入 adjustment 记录
+    user('bob').actual_score += 50
+    db.session.commit()
+    assert db.session.execute(db.select(LedgerEntry.delta).filter_by(
+        user_id=user('bob').id, kind='adjustment').order_by(LedgerEntry.id.desc())).scalar() == 50
+
+    for username in ('alice', 'bob'):
+        assert ledger.snapshot(db.session, user(username).id) == current(username)
+
+
+def test_checkpoint_is_incremental(flask_app):
+    assert ledger.checkpoint(db.session, later()) == 2
+    db.session.commit()
+    assert ledger.checkpoint(db.session, later()) == 0
+
+    transfer(100)
+    # 写入不足 CHECKPOINT_LAG 秒的记录留到下一次
+    assert ledger.checkpoint(db.session, datetime.utcnow()) == 0
+    assert ledger.checkpoint(db.session, later()) == 2
+    db.session.commit()
+    latest = db.session.execute(
+        db.select(BalanceCheckpoint).filter_by(user_id=user('alice').id)
+        .order_by(BalanceCheckpoint.ledger_id.desc())).scalars().first()
+    assert (latest.actual_score, latest.total_transferred) == (900, 100)
+
+
+def test_snapshot_at_past_time(flask_app):
+    transfer(100)
+    middle = datetime.utcnow()
+    db.session.execute(db.update(LedgerEntry).values(created_at=middle - timedelta(seconds=1)))
+    db.session.commit()
+    ledger.checkpoint(db.session, later())
+    db.session.commit()
+    transfer(200)
+
+    assert ledger.snapshot(db.session, user('alice').id, middle)['actual_score'] == 900
+    assert ledger.snapshot(db.session, user('bob').id, middle)['total_received'] == 100
+    assert ledger.snapshot(db.session, user('alice').id)['actual_score'] == 700
+    before = middle - timedelta(days=1)
+    assert ledger.snapshot(db.session, user('alice').id, before)['actual_score'] == 0
@@ -0,0 +1,123 @@
+"""名次索引的增量同步和出错时的回退"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert, update
+
+import rank_index
+from models.models import db, User, LedgerEntry, LeaderboardChange
+
+
+@pytest.fixture
+def index(flask_app, monkeypatch):
+    """五个用户, 余额依次为 10 到 50, 以及一个新建的索引"""
+    for number in range(1, 6):
+        db.session.add(User(username=f'user{number}', forum_id=number, trust_level=1,
+                            actual_score=number * 10, original_score=0, total_transferred=0,
+                            total_received=0, total_consumed=0, total_fee_paid=0))
+    db.session.commit()
+    index = rank_index.RankIndex()
+    monkeypatch.setattr(rank_index, 'index', index)
+    index.rebuild(db.session)
+    return index
+
+
+def user_id(number):
+    return db.session.execute(db.select(User.id).where(User.username == f'user{number}')).scalar()
+
+
+def add_entry(entry_id, user, created_at=None):
+    db.session.execute(insert(LedgerEntry).values(
+        id=entry_id, user_id=user, kind='adjustment', ref_type='user', ref_id=user, delta=0,
+        created_at=created_at or datetime.utcnow()))
+    db.session.commit()
+
+
+def set_score(number, score):
+    """不经过 ORM 直接修改余额, 不会写入账本"""
+    db.session.execute(update(User).where(User.id == user_id(number)).values(actual_score=score))
+    db.session.commit()
+
+
+def test_feed_waits_for_ids_committed_out_of_order(index):
+    feed = rank_index.ChangeFeed(LedgerEntry)
+    feed.reset(db.session)
+    start = feed.high
+    add_entry(start + 1, user_id(1))
+    add_entry(start + 3, user_id(3))
+
+    users, state = feed.read(db.session)
+    feed.advance(state)
+    assert users == {user_id(1), user_id(3)}
+    assert set(feed.gaps) == {start + 2}
+
+    # id 较小的事务稍后才提交
+    add_entry(start + 2, user_id(2))
+    users, state = feed.read(db.session)
+    feed.advance(state)
+    assert users == {user_id(2)}
+    assert feed.gaps == {}
+    assert feed.high == start + 3
+
+
+def test_feed_gives_up_on_rolled_back_ids(index, monkeypatch):
+    feed = rank_index.ChangeFeed(LedgerEntry)
+    feed.reset(db.session)
+    add_entry(feed.high + 2, user_id(1))
+    feed.advance(feed.read(db.session)[1])
+    assert len(feed.gaps) == 1
+
+    monkeypatch.setattr(rank_index, 'RANK_SYNC_GAP_TIMEOUT', 0)
+    feed.advance(feed.read(db.session)[1])
+    assert feed.gaps == {}
+
+
+def test_sync_picks_up_late_commits_with_old_timestamps(index):
+    start = index._feeds[0].high
+    add_entry(start + 2, user_id(5))
+    index.sync(db.session)
+
+    # id 更小、写入时间更早的事务在同步之后才提交
+    set_score(1, 1000)
+    add_entry(start + 1, user_id(1), created_at=datetime.utcnow() - timedelta(hours=1))
+    assert index.sync(db.session) == 1
+    position, total, _ = index.lookup('richest', user_id(1))
+    assert (position, total) == (1, 5)
+
+
+def test_rank_falls_back_to_sql_when_index_is_inconsistent(index):
+    # 模拟增量更新中途出错: 记录的数值与列表中的键不一致
+    index._values['richest'][user_id(2)] = 999
+    result = rank_index.rank(db.session, 'richest', user_id(2), radius=1)
+
+    assert result['rank'] == 4
+    assert [entry['user_id'] for entry in result['around']] == [user_id(3), user_id(2), user_id(1)]
+    assert index.stats()['errors'] == 1
+
+
+def test_visibility_changes_reach_other_indexes_without_ledger_rows(index):
+    other = rank_index.RankIndex()
+    other.rebuild(db.session)
+    entries = db.session.execute(db.select(db.func.count(LedgerEntry.id))).scalar()
+    changes = db.session.execute(db.select(db.func.count(LeaderboardChange.id))).scalar()
+
+    user = db.session.get(User, user_id(5))
+    user.show_in_leaderboard = False
+    db.session.add(User(username='user6', forum_id=6, trust_level=1, actual_score=0))
+    db.session.commit()
+
+    assert db.session.execute(db.select(db.func.count(LedgerEntry.id))).scalar() == entries
+    assert db.session.execute(db.select(db.func.count(LeaderboardChange.id))).scalar() == changes + 2
+    assert other.sync(db.session) == 2
+    assert other.lookup('richest', user_id(5)) == (None, 5, [])
+    assert other.lookup('richest', user_id(6))[:2] == (5, 5)
+
+
+def test_expired_changes_are_purged(index):
+    db.session.execute(db.delete(LeaderboardChange))
+    db.session.add(LeaderboardChange(user_id=user_id(1), created_at=datetime.utcnow() - timedelta(
+        seconds=rank_index.RANK_REBUILD_INTERVAL + 60)))
+    db.session.add(LeaderboardChange(user_id=user_id(2)))
+    db.session.commit()
+    assert rank_index.purge_expired(db.session, 100) == 1
+    assert db.session.execute(db.select(LeaderboardChange.user_id)).scalars().all() == [user_id(2)]
@@ -0,0 +1,94 @@
+"""统计字段的增量核对和修复"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import reconcile
+import services
+from models.models import db, User, App, LedgerEntry, ReconcileWatermark
+
+
+@pytest.fixture
+def flask_app(flask_app):
+    for number, name in enumerate(('alice', 'bob'), 1):
+        db.session.add(User(username=name, forum_id=number, trust_level=1, actual_score=5000,
+                            total_transferred=0, total_received=0, total_consumed=0,
+                            total_fee_paid=0))
+    db.session.flush()
+    db.session.add(App(name='app', client_id='id', client_secret='secret',
+                       redirect_uri='http://localhost', user_id=user('alice').id))
+    db.session.commit()
+    return flask_app
+
+
+def user(username):
+    return db.session.execute(db.select(User).filter_by(username=username)).scalar_one()
+
+
+def transfer(amount):
+    record = services.create_transfer(db.session, user('alice'),
+                                      {'username': 'bob', 'amount': amount})
+    services.confirm_transfer(db.session, user('alice'), record.confirm_token, 'confirm')
+
+
+def consume(amount):
+    record = services.create_consumption(db.session, db.session.execute(db.select(App.id)).scalar(),
+                                         {'username': 'alice', 'amount': amount})
+    services.confirm_consumption(db.session, user('alice'), record.confirm_token, 'confirm')
+
+
+def run(**options):
+    later = datetime.utcnow() + timedelta(seconds=reconcile.RECONCILE_LAG + 1)
+    return reconcile.reconcile(db.session, now=later, **options)
+
+
+def test_consistent_counters_have_no_drift(flask_app):
+    transfer(2000)
+    consume(100)
+    report = run()
+
+    assert report['rows'] == {'consumption': 1, 'transfer': 1}
+    assert (report['users_checked'], report['drift'], report['complete']) == (2, [], True)
+    assert reconcile.is_initialized(db.session)
+    # 没有新记录时不再读取
+    assert run()['rows'] == {'consumption': 0, 'transfer': 0}
+
+
+def test_drift_is_reported_and_repaired(flask_app):
+    transfer(300)
+    run()
+    # 绕过 ORM 直接修改统计字段, 不写入账本
+    db.session.execute(db.update(User).where(User.username == 'bob')
+                       .values(total_received=User.total_received + 7))
+    db.session.commit()
+    transfer(200)
+    watermark = db.session.get(ReconcileWatermark, 'transfer').record_id
+
+    report = run(dry_run=True)
+    assert [(item['username'], item['counter'], item['stored'], item['expected'])
+            for item in report['drift']] == [('bob', 'total_received', 507, 500)]
+    db.session.expire_all()
+    assert user('bob').total_received == 507
+    assert db.session.get(ReconcileWatermark, 'transfer').record_id == watermark
+
+    report = run(repair=True)
+    assert report['repaired'] == 1
+    db.session.expire_all()
+    assert user('bob').total_received == 500
+    adjustment = db.session.execute(
+        db.select(LedgerEntry).filter_by(ref_type='reconcile')).scalar_one()
+    assert (adjustment.delta, adjustment.received) == (0, -7)
+
+    transfer(100)
+    assert run()['drift'] == []
+
+
+def test_max_chunks_resumes_from_watermark(flask_app, monkeypatch):
+    monkeypatch.setattr(reconcile, 'RECONCILE_CHUNK_SIZE', 1)
+    for amount in (10, 20, 30):
+        transfer(amount)
+
+    report = run(max_chunks=2)
+    assert (report['rows']['transfer'], report['complete']) == (2, False)
+    report = run()
+    assert (report['rows']['transfer'], report['complete'], report['drift']) == (1, True, [])
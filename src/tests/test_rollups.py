@@ -0,0 +1,119 @@
+"""按天汇总: 确认时累加、窗口榜单和历史重建"""
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import batch_engine
+import rollups
+import services
+from models.models import db, User, App, DailyRollup, ScoreTransfer, ScoreConsumption
+
+
+@pytest.fixture
+def flask_app(flask_app):
+    for number, name in enumerate(('alice', 'bob', 'carol'), 1):
+        db.session.add(User(username=name, forum_id=number, trust_level=1, actual_score=10000))
+    db.session.flush()
+    db.session.add(App(name='app', client_id='id', client_secret='secret',
+                       redirect_uri='http://localhost', user_id=user('alice').id))
+    db.session.commit()
+    rollups._cache.clear()
+    return flask_app
+
+
+def user(username):
+    return db.session.execute(db.select(User).filter_by(username=username)).scalar_one()
+
+
+def transfer(sender, recipient, amount):
+    record = services.create_transfer(db.session, user(sender),
+                                      {'username': recipient, 'amount': amount})
+    services.confirm_transfer(db.session, user(sender), record.confirm_token, 'confirm')
+
+
+def consume(username, amount):
+    record = services.create_consumption(db.session, db.session.execute(db.select(App.id)).scalar(),
+                                         {'username': username, 'amount': amount})
+    services.confirm_consumption(db.session, user(username), record.confirm_token, 'confirm')
+
+
+def rollup_rows():
+    return {(row.day, row.user_id): (row.transferred, row.received, row.consumed, row.fee_paid)
+            for row in db.session.execute(db.select(DailyRollup)).scalars()}
+
+
+def test_confirms_accumulate_into_today(flask_app):
+    transfer('alice', 'bob', 2000)
+    transfer('alice', 'bob', 100)
+    consume('bob', 300)
+    batch = batch_engine.create_batch_transfer(db.session, user('carol'), {'transfers': [
+        {'username': 'alice', 'amount': 50}, {'username': 'bob', 'amount': 70}]})
+    services.confirm_transfer(db.session, user('carol'), batch['confirm_token'], 'confirm')
+
+    today = rollups.day_of(datetime.utcnow())
+    fee = services.transfer_fee(2000)
+    assert rollup_rows() == {
+        (today, user('alice').id): (2100, 50, 0, fee),
+        (today, user('bob').id): (0, 2100 - fee + 70, 300, services.consumption_fee(300)),
+        (today, user('carol').id): (120, 0, 0, 0),
+    }
+    # 汇总与用户统计字段一致
+    for name in ('alice', 'bob', 'carol'):
+        account = user(name)
+        assert rollup_rows()[(today, account.id)] == (
+            account.total_transferred or 0, account.total_received or 0,
+            account.total_consumed or 0, account.total_fee_paid or 0)
+
+
+def test_window_board_sums_days_and_hides_opted_out_users(flask_app):
+    today = rollups.day_of(datetime.utcnow())
+    db.session.add_all([
+        DailyRollup(day=today, user_id=user('alice').id, transferred=100),
+        DailyRollup(day=today - timedelta(days=3), user_id=user('alice').id, transferred=100),
+        DailyRollup(day=today, user_id=user('bob').id, transferred=150),
+        DailyRollup(day=today - timedelta(days=10), user_id=user('carol').id, transferred=999),
+    ])
+    db.session.commit()
+
+    board = rollups.top(db.session, 'generous', *rollups.period('7d', today))
+    assert [(entry['username'], entry['value']) for entry in board] == [
+        ('alice', 200), ('bob', 150)]
+    assert [entry['username'] for entry in rollups.top(
+        db.session, 'generous', *rollups.period('30d', today))] == ['carol', 'alice', 'bob']
+
+    user('carol').show_in_leaderboard = False
+    db.session.commit()
+    rollups._cache.clear()
+    assert 'carol' not in [entry['username'] for entry in rollups.top(
+        db.session, 'generous', *rollups.period('30d', today))]
+
+
+def test_parse_window(flask_app):
+    today = date(2024, 3, 13)  # 星期三
+    assert rollups.parse_window({}, today) == (date(2024, 3, 11), today)
+    assert rollups.parse_window({'period': 'month'}, today) == (date(2024, 3, 1), today)
+    assert rollups.parse_window({'start': '2024-03-01', 'end': '2024-03-02'}, today) == (
+        date(2024, 3, 1), date(2024, 3, 2))
+    for args in ({'period': 'decade'}, {'start': '2024-03-05', 'end': '2024-03-01'},
+                 {'start': '2020-01-01'}, {'start': 'yesterday'}):
+        with pytest.raises(services.ScoreError):
+            rollups.parse_window(args, today)
+
+
+def test_backfill_rebuilds_days_from_confirmed_records(flask_app):
+    transfer('alice', 'bob', 400)
+    consume('bob', 100)
+    # 把确认时间移到前一天, 清空汇总后重建
+    yesterday = rollups.day_of(datetime.utcnow()) - timedelta(days=1)
+    moment = rollups.day_start(yesterday) + timedelta(hours=12)
+    for model in (ScoreTransfer, ScoreConsumption):
+        db.session.execute(db.update(model).values(confirmed_at=moment))
+    db.session.execute(db.delete(DailyRollup))
+    db.session.commit()
+
+    report = rollups.backfill(db.session)
+    assert (report['since'], report['days'], report['rows']) == (yesterday.isoformat(), 1, 2)
+    assert rollup_rows() == {
+        (yesterday, user('alice').id): (400, 0, 0, 0),
+        (yesterday, user('bob').id): (0, 400, 100, services.consumption_fee(100)),
+    }
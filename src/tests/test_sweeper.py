@@ -0,0 +1,84 @@
+"""后台任务之间的隔离"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import ledger
+import reconcile
+import sweeper
+from models.models import db, User, App, ScoreConsumption, ScoreConsumptionArchive
+
+
+@pytest.fixture
+def flask_app(flask_app, owner):
+    db.session.add(App(name='app', client_id='id', client_secret='secret',
+                       redirect_uri='http://localhost', user_id=owner))
+    db.session.commit()
+    return flask_app
+
+
+def add_expired_consumption(count=1):
+    """添加 count 条已超过保留时间的 pending 消耗记录"""
+    user_id = db.session.execute(db.select(User.id)).scalar()
+    app_id = db.session.execute(db.select(App.id)).scalar()
+    created_at = datetime.utcnow() - timedelta(seconds=sweeper.PENDING_TTL + 60)
+    for _ in range(count):
+        db.session.add(ScoreConsumption(user_id=user_id, app_id=app_id, amount=1,
+                                        created_at=created_at))
+    db.session.commit()
+
+
+def archived():
+    return db.session.execute(db.select(db.func.count(ScoreConsumptionArchive.id))).scalar()
+
+
+def test_failing_job_does_not_affect_others(flask_app, monkeypatch):
+    def broken(session, now):
+        raise RuntimeError('checkpoint failed')
+
+    monkeypatch.setattr(ledger, 'checkpoint', broken)
+    with flask_app.app_context():
+        add_expired_consumption(3)
+        swept = sweeper.Sweeper(flask_app).sweep()
+
+        assert swept['consumption'] == 3
+        assert archived() == 3
+
+    # 新建的实例统计从零开始, 只有失败的任务记录错误
+    instance = sweeper.Sweeper(flask_app)
+    instance.sweep()
+    stats = instance.stats()
+    assert stats['errors'] == 1
+    assert stats['jobs']['checkpoint'] == {**stats['jobs']['checkpoint'], 'runs': 0, 'errors': 1}
+    assert all(job['errors'] == 0 and job['runs'] == 1
+               for name, job in stats['jobs'].items() if name != 'checkpoint')
+
+
+def test_slow_job_does_not_delay_expiry(flask_app, monkeypatch):
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_reconcile(session, **options):
+        started.set()
+        release.wait(10)
+        return {'rows': {}, 'complete': True, 'users_checked': 0, 'drift': [], 'repaired': 0,
+                'duration_s': 0.0}
+
+    monkeypatch.setattr(reconcile, 'is_initialized', lambda session: True)
+    monkeypatch.setattr(reconcile, 'reconcile', slow_reconcile)
+    instance = sweeper.Sweeper(flask_app, interval=0.05)
+    instance.start()
+    try:
+        assert started.wait(5)
+        with flask_app.app_context():
+            add_expired_consumption()
+            deadline = time.monotonic() + 5
+            while archived() == 0 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert archived() == 1
+        assert instance.stats()['jobs']['reconcile']['runs'] == 0
+    finally:
+        release.set()
+        instance.stop()
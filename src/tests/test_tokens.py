@@ -0,0 +1,85 @@
+"""确认 token 登记表: 解析、过期、使用后吊销和清理"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import services
+import tokens
+from models.models import db, User, ConfirmationToken
+
+
+@pytest.fixture
+def flask_app(flask_app):
+    db.session.add_all([User(username='alice', forum_id=1, trust_level=1, actual_score=1000),
+                        User(username='bob', forum_id=2, trust_level=1, actual_score=0)])
+    db.session.commit()
+    tokens.token_cache.invalidate()
+    return flask_app
+
+
+def user(username):
+    return db.session.execute(db.select(User).filter_by(username=username)).scalar_one()
+
+
+def registered(token):
+    return db.session.get(ConfirmationToken, token) is not None
+
+
+def test_resolve_checks_kind_owner_and_expiry(flask_app):
+    alice = user('alice')
+    tokens.issue(db.session, 'fresh', 'transfer', 1, alice.id)
+    tokens.issue(db.session, 'old', 'transfer', 2, alice.id, ttl=60)
+    db.session.commit()
+    db.session.execute(db.update(ConfirmationToken).where(ConfirmationToken.token == 'old')
+                       .values(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+    db.session.commit()
+
+    entry = services.resolve_token(db.session, 'fresh', ('transfer',), alice.id)
+    assert (entry.kind, entry.record_id, entry.user_id) == ('transfer', 1, alice.id)
+    for token, kinds, user_id in (('fresh', ('consume',), alice.id),
+                                  ('fresh', ('transfer',), user('bob').id),
+                                  ('missing', ('transfer',), alice.id)):
+        with pytest.raises(services.ScoreError) as error:
+            services.resolve_token(db.session, token, kinds, user_id)
+        assert error.value.status == 404
+    with pytest.raises(services.ScoreError) as error:
+        services.resolve_token(db.session, 'old', ('transfer',), alice.id)
+    assert error.value.status == 410
+
+
+def test_confirm_revokes_token_and_rollback_keeps_it(flask_app):
+    transfer = services.create_transfer(db.session, user('alice'),
+                                        {'username': 'bob', 'amount': 100})
+    token = transfer.confirm_token
+    assert tokens.lookup(db.session, token).record_id == transfer.id
+
+    # 确认失败回滚时 token 仍然有效
+    user('alice').actual_score = 0
+    db.session.commit()
+    with pytest.raises(services.ScoreError):
+        services.confirm_transfer(db.session, user('alice'), token, 'confirm')
+    assert registered(token)
+
+    user('alice').actual_score = 1000
+    db.session.commit()
+    services.confirm_transfer(db.session, user('alice'), token, 'confirm')
+    assert not registered(token)
+    assert tokens.lookup(db.session, token) is None
+
+
+def test_purge_expired_only_removes_expired_tokens(flask_app):
+    alice = user('alice')
+    tokens.issue_many(db.session, 'consume', [(f'token{i}', i, alice.id) for i in range(5)])
+    tokens.issue(db.session, 'kept', 'consume', 9, alice.id)
+    db.session.commit()
+    assert tokens.lookup(db.session, 'token0').kind == 'consume'
+
+    later = datetime.utcnow() + timedelta(seconds=tokens.CONFIRM_TOKEN_TTL + 1)
+    db.session.execute(db.update(ConfirmationToken).where(ConfirmationToken.token == 'kept')
+                       .values(expires_at=later + timedelta(days=1)))
+    assert tokens.purge_expired(db.session, 3, later) == 3
+    assert tokens.purge_expired(db.session, 3, later) == 2
+    db.session.commit()
+    assert db.session.execute(db.select(ConfirmationToken.token)).scalars().all() == ['kept']
+    # 缓存中的记录随删除一起失效
+    assert tokens.lookup(db.session, 'token0') is None
@@ -0,0 +1,175 @@
+"""webhook 推送与本地 HTTP 接收端的交互"""
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import webhooks
+from models.models import db, App, WebhookDelivery
+
+
+class Sink:
+    """记录收到的 POST 请求, 按 statuses 依次返回状态码, 用完后返回 200"""
+
+    def __init__(self):
+        self.received = []
+        self.statuses = []
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                sink.received.append({'path': self.path, 'headers': dict(self.headers),
+                                      'body': body})
+                status = sink.statuses.pop(0) if sink.statuses else 200
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def events(self, request):
+        return json.loads(request['body'])['events']
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def sink():
+    server = Sink()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def flask_app(flask_app, owner, sink):
+    """两个应用, 回调地址分别为接收端的 /one 和 /two"""
+    for name in ('one', 'two'):
+        db.session.add(App(name=name, client_id=f'id-{name}', client_secret=f'secret-{name}',
+                           redirect_uri='http://localhost', user_id=owner,
+                           callback_url=f'{sink.url}/{name}'))
+    db.session.commit()
+    return flask_app
+
+
+@pytest.fixture
+def client():
+    with httpx.Client(timeout=5) as client:
+        yield client
+
+
+def app_id(name):
+    return db.session.execute(db.select(App.id).where(App.name == name)).scalar()
+
+
+def enqueue(name, count):
+    for index in range(count):
+        webhooks.enqueue(db.session, app_id(name), 'consumption.confirmed',
+                         {'consumption_id': index, 'app': name})
+    db.session.commit()
+
+
+def deliveries():
+    db.session.expire_all()
+    return db.session.execute(db.select(WebhookDelivery).order_by(WebhookDelivery.id)).scalars().all()
+
+
+def test_events_are_batched_per_app(flask_app, sink, client, monkeypatch):
+    monkeypatch.setattr(webhooks, 'WEBHOOK_BATCH_SIZE', 2)
+    with flask_app.app_context():
+        enqueue('one', 3)
+        enqueue('two', 1)
+        counts = webhooks.deliver_pending(db.session, client)
+
+        assert counts == {'requests': 3, 'delivered': 4, 'retried': 0, 'failed': 0}
+        assert [(request['path'], len(sink.events(request))) for request in sink.received] == [
+            ('/one', 2), ('/one', 1), ('/two', 1)]
+        for request in sink.received:
+            name = request['path'].lstrip('/')
+            assert {event['data']['app'] for event in sink.events(request)} == {name}
+        assert {delivery.status for delivery in deliveries()} == {'delivered'}
+        # 已送达的事件不会再次发送
+        assert webhooks.deliver_pending(db.session, client)['requests'] == 0
+
+
+def test_requests_are_signed_with_app_secret(flask_app, sink, client):
+    with flask_app.app_context():
+        enqueue('one', 1)
+        webhooks.deliver_pending(db.session, client)
+
+    request = sink.received[0]
+    headers = {key.lower(): value for key, value in request['headers'].items()}
+    timestamp = headers[webhooks.TIMESTAMP_HEADER.lower()]
+    signature = headers[webhooks.SIGNATURE_HEADER.lower()]
+    assert abs(int(timestamp) - time.time()) < 60
+    assert signature == webhooks.sign('secret-one', timestamp, request['body'])
+    assert signature != webhooks.sign('secret-two', timestamp, request['body'])
+    assert signature != webhooks.sign('secret-one', str(int(timestamp) + 1), request['body'])
+
+
+def test_failed_deliveries_back_off_until_max_attempts(flask_app, sink, client, monkeypatch):
+    monkeypatch.setattr(webhooks, 'WEBHOOK_MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(webhooks, 'WEBHOOK_RETRY_DELAY', 10)
+    sink.statuses = [500] * 10
+    now = datetime.utcnow() + timedelta(seconds=1)
+    with flask_app.app_context():
+        enqueue('one', 2)
+
+        assert webhooks.deliver_pending(db.session, client, now)['retried'] == 2
+        delivery = deliveries()[0]
+        assert (delivery.status, delivery.attempts, delivery.last_error) == ('pending', 1, 'HTTP 500')
+        assert delivery.next_attempt_at == now + timedelta(seconds=10)
+
+        # 未到重试时间时不发送
+        assert webhooks.deliver_pending(db.session, client, now + timedelta(seconds=9))['requests'] == 0
+
+        now += timedelta(seconds=10)
+        assert webhooks.deliver_pending(db.session, client, now)['retried'] == 2
+        assert deliveries()[0].next_attempt_at == now + timedelta(seconds=20)
+
+        now += timedelta(seconds=20)
+        assert webhooks.deliver_pending(db.session, client, now)['failed'] == 2
+        assert [(d.status, d.attempts) for d in deliveries()] == [('failed', 3), ('failed', 3)]
+
+        assert webhooks.deliver_pending(db.session, client, now + timedelta(days=1))['requests'] == 0
+    assert len(sink.received) == 3
+
+
+def test_event_ids_are_stable_across_retries(flask_app, sink, client, monkeypatch):
+    monkeypatch.setattr(webhooks, 'WEBHOOK_RETRY_DELAY', 1)
+    sink.statuses = [503]
+    now = datetime.utcnow() + timedelta(seconds=1)
+    with flask_app.app_context():
+        enqueue('one', 3)
+        assert webhooks.deliver_pending(db.session, client, now)['retried'] == 3
+        counts = webhooks.deliver_pending(db.session, client, now + timedelta(seconds=1))
+        assert counts['delivered'] == 3
+
+    first, second = ([event['id'] for event in sink.events(request)] for request in sink.received)
+    assert first == second
+    assert len(set(first)) == 3
+
+
+def test_dispatcher_runs_one_round(flask_app, sink):
+    dispatcher = webhooks.WebhookDispatcher(flask_app)
+    try:
+        with flask_app.app_context():
+            enqueue('two', 2)
+        counts = dispatcher.dispatch()
+    finally:
+        dispatcher.stop()
+    assert counts['delivered'] == 2
+    assert dispatcher.stats()['delivered'] == 2
+    assert [request['path'] for request in sink.received] == ['/two']
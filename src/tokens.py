@@ -0,0 +1,150 @@
+"""确认token登记表
+
+token -> (类型, 记录id, 所属用户, 过期时间) 统一记录在 confirmation_token 表中,
+确认页和确认接口只需按主键查询一次。查询结果放在进程内的小缓存里, 过期的
+token 直接拒绝, 不再访问消耗、转账等业务表。token 使用后从登记表中删除。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+
+from models.models import ConfirmationToken
+
+# 待确认 token 的有效期(秒)
+CONFIRM_TOKEN_TTL = int(os.getenv('CONFIRM_TOKEN_TTL', 86400))
+
+TokenEntry = namedtuple('TokenEntry', ['token', 'kind', 'record_id', 'user_id', 'expires_at'])
+
+
+class TokenCache:
+    """token 查询结果的 TTL/LRU 缓存"""
+
+    def __init__(self, ttl=60, max_size=4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            item = self._entries.get(token)
+            if item is None or item[0] < time.monotonic():
+                self._entries.pop(token, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return item[1]
+
+    def put(self, entry):
+        with self._lock:
+            self._entries[entry.token] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(entry.token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token=None):
+        with self._lock:
+            if token is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(token, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+            }
+
+
+token_cache = TokenCache(
+    ttl=int(os.getenv('CONFIRM_TOKEN_CACHE_TTL', 60)),
+    max_size=int(os.getenv('CONFIRM_TOKEN_CACHE_SIZE', 4096))
+)
+
+
+def _entry(row):
+    return TokenEntry(row.token, row.kind, row.record_id, row.user_id, row.expires_at)
+
+
+def issue(session, token, kind, record_id, user_id, ttl=None):
+    """登记新的待确认 token, 与业务记录在同一事务中提交"""
+    row = ConfirmationToken(
+        token=token,
+        kind=kind,
+        record_id=record_id,
+        user_id=user_id,
+        expires_at=datetime.utcnow() + timedelta(seconds=ttl or CONFIRM_TOKEN_TTL)
+    )
+    session.add(row)
+    return row
+
+
+def issue_many(session, kind, entries, ttl=None):
+    """批量登记 token, entries 为 (token, 记录id, 所属用户) 列表"""
+    if not entries:
+        return
+    expires_at = datetime.utcnow() + timedelta(seconds=ttl or CONFIRM_TOKEN_TTL)
+    session.execute(insert(ConfirmationToken), [
+        {'token': token, 'kind': kind, 'record_id': record_id, 'user_id': user_id,
+         'expires_at': expires_at}
+        for token, record_id, user_id in entries
+    ])
+
+
+def lookup(session, token):
+    """按 token 查询登记信息, 不存在时返回 None"""
+    entry = token_cache.get(token)
+    if entry is None:
+        row = session.get(ConfirmationToken, token)
+        if row is None:
+            return None
+        entry = _entry(row)
+        token_cache.put(entry)
+    return entry
+
+
+def is_expired(entry, now=None):
+    return entry.expires_at < (now or datetime.utcnow())
+
+
+def revoke(session, token):
+    """token 已使用, 从登记表和缓存中删除"""
+    session.execute(
+        delete(ConfirmationToken).where(ConfirmationToken.token == token)
+        .execution_options(synchronize_session=False)
+    )
+    token_cache.invalidate(token)
+
+
+def revoke_many(session, token_list):
+    """批量删除 token"""
+    if not token_list:
+        return
+    session.execute(
+        delete(ConfirmationToken).where(ConfirmationToken.token.in_(token_list))
+        .execution_options(synchronize_session=False)
+    )
+    for token in token_list:
+        token_cache.invalidate(token)
+
+
+def purge_expired(session, limit, now=None):
+    """删除最多 limit 个已过期的 token, 返回删除数量"""
+    expired = session.execute(
+        select(ConfirmationToken.token)
+        .where(ConfirmationToken.expires_at < (now or datetime.utcnow()))
+        .limit(limit)
+    ).scalars().all()
+    revoke_many(session, expired)
+    return len(expired)
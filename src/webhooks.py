@@ -0,0 +1,220 @@
+"""消耗结果的 webhook 推送
+
+确认或拒绝消耗时, 如果应用设置了 callback_url, 就在同一事务中写入一条 webhook_delivery。
+后台线程按应用分组, 把最多 WEBHOOK_BATCH_SIZE 个事件合并为一次 POST 请求发送,
+请求体用应用的 client_secret 做 HMAC-SHA256 签名:
+
+    X-DoScores-Timestamp: <unix 时间戳>
+    X-DoScores-Signature: sha256=<hex(hmac(client_secret, "<时间戳>." + 请求体))>
+
+返回 2xx 视为送达; 否则按指数退避重试, 超过 WEBHOOK_MAX_ATTEMPTS 次后标记为 failed。
+每个事件带有唯一的 id, 重试时不变, 接收方据此去重。
+"""
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import select, update, delete
+
+from models.models import db, App, WebhookDelivery
+
+# 发送间隔(秒)
+WEBHOOK_INTERVAL = int(os.getenv('WEBHOOK_INTERVAL', 5))
+# 每个请求合并的最大事件数, 以及每轮读取的最大事件数
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 50))
+WEBHOOK_SCAN_SIZE = int(os.getenv('WEBHOOK_SCAN_SIZE', 1000))
+# 最大尝试次数和首次重试的等待时间(秒)
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 8))
+WEBHOOK_RETRY_DELAY = int(os.getenv('WEBHOOK_RETRY_DELAY', 30))
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', 10))
+# 已送达或失败的记录保留天数
+WEBHOOK_RETENTION_DAYS = int(os.getenv('WEBHOOK_RETENTION_DAYS', 7))
+
+SIGNATURE_HEADER = 'X-DoScores-Signature'
+TIMESTAMP_HEADER = 'X-DoScores-Timestamp'
+
+
+def sign(secret, timestamp, body):
+    """计算请求签名, 接收方用同样的方法校验"""
+    message = f'{timestamp}.'.encode() + body
+    return 'sha256=' + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def enqueue(session, app_id, event, data):
+    """应用设置了 callback_url 时登记一个待推送事件, 随调用方的事务提交"""
+    callback_url = session.execute(
+        select(App.callback_url).where(App.id == app_id)
+    ).scalar()
+    if not callback_url:
+        return None
+    delivery = WebhookDelivery(app_id=app_id, event=event,
+                               payload=json.dumps(data, ensure_ascii=False))
+    session.add(delivery)
+    return delivery
+
+
+def _retry_at(now, attempts):
+    return now + timedelta(seconds=WEBHOOK_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def _post(client, url, secret, events):
+    body = json.dumps({'events': events}, ensure_ascii=False).encode()
+    timestamp = str(int(time.time()))
+    try:
+        response = client.post(url, content=body, headers={
+            'Content-Type': 'application/json',
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: sign(secret, timestamp, body),
+        })
+    except httpx.HTTPError as e:
+        return f'{type(e).__name__}: {e}'[:256]
+    if 200 <= response.status_code < 300:
+        return None
+    return f'HTTP {response.status_code}'
+
+
+def deliver_pending(session, client, now=None):
+    """发送到期的待推送事件, 返回 {'requests', 'delivered', 'retried', 'failed'}"""
+    now = now or datetime.utcnow()
+    rows = session.execute(
+        select(WebhookDelivery.id, WebhookDelivery.app_id, WebhookDelivery.event,
+               WebhookDelivery.payload, WebhookDelivery.attempts, WebhookDelivery.created_at,
+               App.callback_url, App.client_secret)
+        .join(App, App.id == WebhookDelivery.app_id)
+        .where(WebhookDelivery.status == 'pending', WebhookDelivery.next_attempt_at <= now)
+        .order_by(WebhookDelivery.id)
+        .limit(WEBHOOK_SCAN_SIZE)
+    ).all()
+    # 发送请求期间不持有事务
+    session.commit()
+
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault(row.app_id, []).append(row)
+
+    counts = {'requests': 0, 'delivered': 0, 'retried': 0, 'failed': 0}
+    for app_rows in groups.values():
+        for start in range(0, len(app_rows), WEBHOOK_BATCH_SIZE):
+            chunk = app_rows[start:start + WEBHOOK_BATCH_SIZE]
+            url, secret = chunk[0].callback_url, chunk[0].client_secret
+            if url:
+                error = _post(client, url, secret, [
+                    {'id': row.id, 'type': row.event, 'created_at': row.created_at.isoformat(),
+                     'data': json.loads(row.payload)}
+                    for row in chunk
+                ])
+                counts['requests'] += 1
+            else:
+                # 应用在事件登记后删除了推送地址
+                error = '应用未设置 callback_url'
+            ids = [row.id for row in chunk]
+
+            if error is None:
+                session.execute(
+                    update(WebhookDelivery).where(WebhookDelivery.id.in_(ids))
+                    .values(status='delivered', delivered_at=datetime.utcnow(),
+                            attempts=WebhookDelivery.attempts + 1, last_error=None)
+                    .execution_options(synchronize_session=False)
+                )
+                counts['delivered'] += len(chunk)
+            else:
+                for row in chunk:
+                    attempts = row.attempts + 1
+                    failed = attempts >= WEBHOOK_MAX_ATTEMPTS
+                    session.execute(
+                        update(WebhookDelivery).where(WebhookDelivery.id == row.id)
+                        .values(status='failed' if failed else 'pending', attempts=attempts,
+                                next_attempt_at=_retry_at(now, attempts), last_error=error)
+                        .execution_options(synchronize_session=False)
+                    )
+                    counts['failed' if failed else 'retried'] += 1
+            session.commit()
+    return counts
+
+
+def purge_finished(session, now=None, limit=WEBHOOK_SCAN_SIZE):
+    """删除超过保留期的已送达和失败记录, 返回删除数量"""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=WEBHOOK_RETENTION_DAYS)
+    ids = session.execute(
+        select(WebhookDelivery.id)
+        .where(WebhookDelivery.status != 'pending', WebhookDelivery.created_at < cutoff)
+        .limit(limit)
+    ).scalars().all()
+    if ids:
+        session.execute(
+            delete(WebhookDelivery).where(WebhookDelivery.id.in_(ids))
+            .execution_options(synchronize_session=False)
+        )
+    session.commit()
+    return len(ids)
+
+
+class WebhookDispatcher:
+    """在 run.py 进程中运行的 webhook 发送线程"""
+
+    def __init__(self, flask_app, interval=WEBHOOK_INTERVAL):
+        self.flask_app = flask_app
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._client = httpx.Client(timeout=WEBHOOK_TIMEOUT)
+        self._stats = {
+            'runs': 0,
+            'errors': 0,
+            'requests': 0,
+            'delivered': 0,
+            'retried': 0,
+            'failed': 0,
+            'purged': 0,
+            'last_run_at': None,
+        }
+
+    def dispatch(self):
+        """执行一轮发送, 返回本轮的统计"""
+        now = datetime.utcnow()
+        with self.flask_app.app_context():
+            counts = deliver_pending(db.session, self._client, now)
+            counts['purged'] = purge_finished(db.session, now)
+
+        with self._lock:
+            self._stats['runs'] += 1
+            for key, count in counts.items():
+                self._stats[key] += count
+            self._stats['last_run_at'] = now.isoformat()
+        if counts['retried'] or counts['failed']:
+            self.flask_app.logger.warning(f"webhook 推送失败: {counts}")
+        return counts
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.dispatch()
+            except Exception as e:
+                with self._lock:
+                    self._stats['errors'] += 1
+                self.flask_app.logger.error(f"webhook 推送出错: {str(e)}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='webhook-dispatcher',
+                                            daemon=True)
+            self._thread.start()
+            self.flask_app.logger.info(f"webhook 推送已启动: 每 {self.interval} 秒执行一次")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + WEBHOOK_TIMEOUT)
+            self._thread = None
+        self._client.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)